@@ -0,0 +1,77 @@
+import re
+from bisect import bisect_left
+from vocabulary import load_vocabulary
+
+# 每次返回给下拉框的候选数
+top_k = 50
+
+token_pattern = re.compile(r'\w+')
+
+# dbName -> (数据版本, {'gene': PrefixIndex, 'cell': PrefixIndex})，进程内缓存
+_index_cache = {}
+
+
+class PrefixIndex():
+    """
+    前缀搜索：把 (小写的键, 取值) 按键排序，用二分查找定位前缀的起点，依次取出不重复的取值。
+    一个取值可以有多个键，例如细胞名的每个单词都是一个键，输入 "T" 能找到 "CD4-positive, alpha-beta T cell"。
+    """
+    def __init__(self, entries):
+        entries = sorted(set(entries))
+        self.keys = [key for key, _ in entries]
+        self.values = [value for _, value in entries]
+
+    def search(self, prefix, k=top_k):
+        prefix = prefix.strip().lower()
+        matches = []
+        seen = set()
+        start = bisect_left(self.keys, prefix)
+        for i in range(start, len(self.keys)):
+            if not self.keys[i].startswith(prefix) or len(matches) >= k:
+                break
+            if self.values[i] not in seen:
+                seen.add(self.values[i])
+                matches.append(self.values[i])
+        return matches
+
+
+def split_cell_names(names):
+    """
+    细胞名按逗号拆开作为下拉框中的选项，与原来 main.py 中的处理一致。
+    """
+    return sorted(set([c for cell in names for c in cell.split(",")]))
+
+
+def build_prefix_indexes(vocabulary):
+    genes = vocabulary['symbol']
+    cells = split_cell_names(vocabulary['cell_name'])
+    cell_entries = [(cell.lower(), cell) for cell in cells]
+    cell_entries += [(token, cell) for cell in cells for token in token_pattern.findall(cell.lower())]
+    return {
+        'gene': PrefixIndex([(gene.lower(), gene) for gene in genes]),
+        'cell': PrefixIndex(cell_entries),
+    }
+
+
+def load_prefix_indexes(db):
+    """
+    返回按数据版本缓存的基因和细胞前缀索引，上传或增删数据后自动重建。
+    """
+    version = db.get_data_version()
+    cached = _index_cache.get(db.dbName)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    indexes = build_prefix_indexes(load_vocabulary(db))
+    _index_cache[db.dbName] = (version, indexes)
+    return indexes
+
+
+def suggest(db, kind, prefix, selected=None, k=top_k):
+    """
+    返回下拉框的候选：已选中的值在前（否则下拉框会丢掉它们），再加上前缀匹配的前 k 个。
+
+    :param kind: 'gene' 或 'cell'
+    """
+    selected = list(selected or [])
+    matches = load_prefix_indexes(db)[kind].search(prefix, k)
+    return selected + [value for value in matches if value not in selected]
@@ -0,0 +1,124 @@
+import re
+import sys
+from sqlite_tool import SqliteTool
+
+token_pattern = re.compile(r'\w+')
+
+# dbName -> (数据版本, CellNameIndex)，进程内缓存
+_index_cache = {}
+
+
+def tokenize(text):
+    return set(token_pattern.findall(text.lower()))
+
+
+def build_cell_name_index(db):
+    """
+    重建细胞名倒排索引：cell_names 保存所有不同的细胞名，
+    cell_name_tokens 保存小写单词 -> 细胞名的映射。
+    """
+    db._cur.execute("DROP TABLE IF EXISTS cell_names")
+    db._cur.execute("DROP TABLE IF EXISTS cell_name_tokens")
+    db._cur.execute("CREATE TABLE cell_names (cell_name TEXT PRIMARY KEY)")
+    db._cur.execute("""
+        CREATE TABLE cell_name_tokens (
+            token TEXT,
+            cell_name TEXT,
+            PRIMARY KEY (token, cell_name)
+        ) WITHOUT ROWID
+    """)
+    sync_cell_name_index(db, commit=False)
+    db._conn.commit()
+    print("Cell name token index has been built.")
+
+
+def ensure_cell_name_index(db):
+    """
+    索引表不存在时（旧版本建立的数据库）建立它，需要可写的连接：
+    由 db_versions.adopt 和写队列启动时调用，读取路径上不再建表。
+    """
+    if not has_cell_name_index(db):
+        build_cell_name_index(db)
+
+
+def has_cell_name_index(db):
+    db._cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='cell_name_tokens'")
+    return db._cur.fetchone() is not None
+
+
+def sync_cell_name_index(db, commit=True):
+    """
+    让倒排索引与 unique_csv_data 中的细胞名保持一致，只处理新增和消失的名称。
+    """
+    db._cur.execute("""
+        SELECT DISTINCT cell_name FROM unique_csv_data
+        WHERE cell_name IS NOT NULL AND cell_name NOT IN (SELECT cell_name FROM cell_names)
+    """)
+    new_names = [row[0] for row in db._cur.fetchall()]
+    db._cur.executemany("INSERT INTO cell_names VALUES (?)", [(name,) for name in new_names])
+    db._cur.executemany("INSERT OR IGNORE INTO cell_name_tokens VALUES (?, ?)",
+                        [(token, name) for name in new_names for token in tokenize(name)])
+
+    db._cur.execute("""
+        DELETE FROM cell_names
+        WHERE cell_name NOT IN (SELECT cell_name FROM unique_csv_data WHERE cell_name IS NOT NULL)
+    """)
+    db._cur.execute("DELETE FROM cell_name_tokens WHERE cell_name NOT IN (SELECT cell_name FROM cell_names)")
+    if commit:
+        db._conn.commit()
+
+
+class CellNameIndex():
+    """
+    内存中的细胞名倒排索引，匹配结果与逐行 re.search(r'\\bkeyword\\b', IGNORECASE) 相同：
+    先用关键词中的单词求交集得到候选细胞名，再用原来的正则在候选集合上确认。
+    """
+    def __init__(self, names, token_rows):
+        self.names = names
+        self.postings = {}
+        for token, cell_name in token_rows:
+            self.postings.setdefault(token, set()).add(cell_name)
+
+    def candidates(self, keyword):
+        tokens = tokenize(keyword)
+        if not tokens:
+            return self.names
+        postings = sorted([self.postings.get(token, set()) for token in tokens], key=len)
+        return set.intersection(*postings)
+
+    def match(self, keywords):
+        matched = set()
+        for keyword in keywords:
+            pattern = re.compile(r'\b' + re.escape(keyword) + r'\b', re.IGNORECASE)
+            matched.update([name for name in self.candidates(keyword) if pattern.search(name)])
+        return matched
+
+
+def load_cell_name_index(db):
+    """
+    读取持久化的倒排索引，按数据版本缓存在内存中。
+    只读取，不写入（连接池的读连接是只读的）；索引表还没有建立时直接从 unique_csv_data 的细胞名在内存中生成。
+    """
+    version = db.get_data_version()
+    cached = _index_cache.get(db.dbName)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    if has_cell_name_index(db):
+        db._cur.execute("SELECT cell_name FROM cell_names")
+        names = [row[0] for row in db._cur.fetchall()]
+        db._cur.execute("SELECT token, cell_name FROM cell_name_tokens")
+        token_rows = db._cur.fetchall()
+    else:
+        db._cur.execute("SELECT DISTINCT cell_name FROM unique_csv_data WHERE cell_name IS NOT NULL")
+        names = [row[0] for row in db._cur.fetchall()]
+        token_rows = [(token, name) for name in names for token in tokenize(name)]
+    index = CellNameIndex(names, token_rows)
+    _index_cache[db.dbName] = (version, index)
+    return index
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    build_cell_name_index(db)
+    db.close_connection()
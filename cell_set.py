@@ -0,0 +1,51 @@
+class CellSet():
+    """
+    一组细胞名，保存在当前连接的临时表中（每个名称一行，带主键索引）。
+    查询通过 cell_name IN (SELECT ...) 与临时表连接，不再把名称拼接进 SQL，
+    因此 SQL 文本与细胞类型的数量无关，可以复用预编译语句，名称中的引号也不会破坏查询。
+
+    negated=True 表示“除这些细胞之外的所有细胞”，与原来的未匹配列表等价，但不需要再写入一张大表。
+    """
+    def __init__(self, db, names, table="matched_cells", negated=False, populate=True):
+        self.names = set(names)
+        self.table = table
+        self.negated = negated
+        if populate:
+            db._cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (cell_name TEXT PRIMARY KEY)")
+            db._cur.execute(f"DELETE FROM temp.{table}")
+            db._cur.executemany(f"INSERT OR IGNORE INTO temp.{table} VALUES (?)",
+                                [(name,) for name in self.names])
+            # 让查询规划器知道临时表的实际行数，匹配的细胞较少时按 cell_name 索引查找而不是扫描
+            db._cur.execute(f"ANALYZE temp.{table}")
+            # 临时表的写入不涉及主库，立即提交，避免读事务一直持有共享锁
+            db._conn.commit()
+
+    def complement(self):
+        """
+        返回共用同一张临时表的补集。
+        """
+        return CellSet(None, self.names, self.table, not self.negated, populate=False)
+
+    def condition(self, column="cell_name", compact=False):
+        """
+        返回过滤 column 的 SQL 条件；compact=True 时 column 为 dict_cell_name 中的整数 id。
+        """
+        subquery = f"SELECT cell_name FROM temp.{self.table}"
+        if compact:
+            subquery = f"SELECT id FROM dict_cell_name WHERE value IN ({subquery})"
+        operator = "NOT IN" if self.negated else "IN"
+        return f"{column} {operator} ({subquery})"
+
+    def join(self, table, compact=False):
+        """
+        返回从临时表出发、按 cell_name 索引逐个查找 table 的 FROM ... WHERE 子句，只用于非补集。
+        CROSS JOIN 固定连接顺序，读取的行数只与匹配的细胞有关，不会退化为扫描整个索引
+        （连接条件写在 WHERE 中，DuckDB 的 CROSS JOIN 不接受 ON）；
+        临时表的列改名为 matched_name，查询中的 cell_name 仍指 table 的列。
+        """
+        if compact:
+            names = (f"SELECT dict_cell_name.id AS matched_name FROM temp.{self.table} "
+                     f"JOIN dict_cell_name ON dict_cell_name.value = {self.table}.cell_name")
+        else:
+            names = f"SELECT cell_name AS matched_name FROM temp.{self.table}"
+        return f"({names}) AS matched CROSS JOIN {table} WHERE {table}.cell_name = matched.matched_name"
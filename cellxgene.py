@@ -4,6 +4,7 @@
 # import matplotlib.pyplot as plt
 # from func import unique_group
 # from sqlite_tool import SqliteTool
+from frames import fetch_plot_frame
 # import re
 # import time
 #
@@ -205,10 +206,7 @@ def fetch_data_from_database(db):
     FROM final
     """
     db._cur.execute(query)
-    data = db._cur.fetchall()
-    # Convert to DataFrame
-    df = pd.DataFrame(data, columns=['cell_name', 'tissue_name', 'symbol', 'expr_pct', 'active_expr_mean'])
-    df['cell_label'] = df['cell_name'] + ' # ' + df['tissue_name']
+    df = fetch_plot_frame(db._cur, ['cell_name', 'tissue_name', 'symbol', 'expr_pct', 'active_expr_mean'])
     #df.to_csv("now.csv")
     return df
 
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from sqlite_tool import SqliteTool, get_pool
+from frames import fetch_frame
+from marker_engine import duplicate_cells
+
+# 列式存储中的数值列，每列一个 memmap 文件
+store_metrics = ['expr_mean', 'expr_pct', 'active_expr_mean', 'cell_pct']
+store_dtype = np.float64
+# 扫描时每次读入的组数，内存占用与 atlas 的大小无关
+block_groups = 256
+
+# dbName -> ColumnStore，进程内缓存
+_store_cache = {}
+# 正在后台重新导出的 dbName
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+
+def store_dir(db):
+    return f"{db.dbName}.columns"
+
+
+class ColumnStore():
+    """
+    数据库旁的列式表达存储 <db>.columns/v<数据版本>/：
+
+    - <metric>.f8：每个数值列一个 (组, 基因) 的 float64 memmap 文件，组为 (tissue_name, cell_name)，基因为 symbol；
+      NULL 和不存在的行都是 NaN；
+    - present.u1：该位置是否有一行；
+    - duplicates.npz：同一组同一基因有多行时（与 MarkerEngine 相同），这些行不放入上面的文件，
+      而是以 (组, 基因, 各列的值) 的稀疏形式保存；
+    - labels.json：组和基因的标签，meta.json：形状和数据版本。
+
+    文件以只读方式映射，多个进程共享操作系统的页缓存；扫描只读取用到的列，并按组分块，不会整体读入内存。
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding='utf-8') as file:
+            meta = json.load(file)
+        with open(os.path.join(path, "labels.json"), encoding='utf-8') as file:
+            labels = json.load(file)
+        self.version = meta['version']
+        self.shape = tuple(meta['shape'])
+        self.tissue_names = np.array(labels['tissue_name'], dtype=object)
+        self.group_cell_names = np.array(labels['cell_name'], dtype=object)
+        self.genes = np.array(labels['symbol'], dtype=object)
+        self._maps = {}
+        with np.load(os.path.join(path, "duplicates.npz")) as duplicates:
+            self.duplicates = {name: duplicates[name] for name in duplicates.files}
+
+    def metric(self, name):
+        """
+        返回 name 列的只读 memmap，形状为 (组, 基因)，不包含 duplicates 中的行。
+        """
+        if name not in self._maps:
+            suffix = "u1" if name == "present" else "f8"
+            dtype = np.bool_ if name == "present" else store_dtype
+            self._maps[name] = np.memmap(os.path.join(self.path, f"{name}.{suffix}"), dtype=dtype, mode='r',
+                                         shape=self.shape)
+        return self._maps[name]
+
+    def group_mask(self, cell_names):
+        return np.isin(self.group_cell_names, list(cell_names))
+
+    def gene_ids(self, symbols):
+        return np.flatnonzero(np.isin(self.genes, list(symbols)))
+
+    def values(self, name, group_ids, gene_ids):
+        """
+        读取若干组、若干基因的 name 列，返回 (组, 基因) 的数组；有多行的位置是 NaN，这些行见 self.duplicates。
+        """
+        return self.metric(name)[group_ids][:, gene_ids]
+
+    def count_above(self, mask, threshold_value, name='expr_mean'):
+        """
+        返回每个基因在 mask 选中的组中 name > threshold_value 的行数，以及该基因是否出现过。
+        """
+        values = self.metric(name)
+        present = self.metric("present")
+        above = np.zeros(self.shape[1], dtype=np.int64)
+        seen = np.zeros(self.shape[1], dtype=bool)
+        group_ids = np.flatnonzero(mask)
+        for start in range(0, len(group_ids), block_groups):
+            block = group_ids[start:start + block_groups]
+            above += (values[block] > threshold_value).sum(axis=0)
+            seen |= present[block].any(axis=0)
+
+        # 多行的位置逐行计数
+        duplicates = self.duplicates
+        selected = mask[duplicates['groups']]
+        genes = duplicates['genes'][selected]
+        np.add.at(above, genes, duplicates[name][selected] > threshold_value)
+        seen[genes] = True
+        return above, seen
+
+    def marker_genes(self, matched_cells, target_offset, target_p, other_offset, other_p):
+        """
+        与 MarkerEngine.marker_genes 相同的接口和结果。
+
+        :return: (gene_list1, gene_list2)
+        """
+        names = getattr(matched_cells, 'names', matched_cells)
+        target_mask = self.group_mask(names)
+        other_mask = ~target_mask
+        target_count = int(target_mask.sum())
+        other_count = int(other_mask.sum())
+
+        above, present = self.count_above(target_mask, target_offset)
+        gene_list1 = self.genes[present & (above >= target_p * target_count)].tolist()
+
+        above_other, present_other = self.count_above(other_mask, other_offset)
+        gene_list2 = self.genes[present_other & (other_count - above_other >= other_p * other_count)].tolist()
+        return gene_list1, gene_list2
+
+
+def build_column_store(db):
+    """
+    从 target_table 导出列式存储到 <db>.columns/v<数据版本>/，并删除旧版本的目录。
+    """
+    version = db.get_data_version()
+    db._cur.execute(f"""
+        SELECT tissue_name, cell_name, symbol, {', '.join(store_metrics)}
+        FROM target_table
+        WHERE cell_name IS NOT NULL
+    """)
+    df = fetch_frame(db._cur, ['tissue_name', 'cell_name', 'symbol'] + store_metrics,
+                     ['tissue_name', 'cell_name', 'symbol'], dtype=store_dtype)
+
+    # 组编号：(tissue_name, cell_name) 的编码组合成一个整数再 factorize，NULL 的 tissue_name 编码为 -1
+    tissues = df['tissue_name'].cat.categories
+    cells = df['cell_name'].cat.categories
+    tissue_codes = df['tissue_name'].cat.codes.to_numpy(dtype=np.int64)
+    cell_codes = df['cell_name'].cat.codes.to_numpy(dtype=np.int64)
+    group_codes, group_keys = pd.factorize((tissue_codes + 1) * len(cells) + cell_codes)
+    tissue_labels = [tissues[key // len(cells) - 1] if key // len(cells) > 0 else None for key in group_keys]
+    cell_labels = [cells[key % len(cells)] for key in group_keys]
+
+    # NULL 的 symbol 作为最后一个基因
+    gene_codes = df['symbol'].cat.codes.to_numpy(dtype=np.int64)
+    genes = list(df['symbol'].cat.categories)
+    if (gene_codes < 0).any():
+        gene_codes = np.where(gene_codes < 0, len(genes), gene_codes)
+        genes.append(None)
+    shape = (len(group_keys), len(genes))
+    duplicated = duplicate_cells(group_codes, gene_codes, len(genes))
+    single = ~duplicated
+
+    root = store_dir(db)
+    os.makedirs(root, exist_ok=True)
+    # 先写到临时目录再改名，读取方不会看到写了一半的文件
+    tmp_path = tempfile.mkdtemp(prefix=".build-", dir=root)
+    for name in store_metrics + ["present"]:
+        if name == "present":
+            data = np.memmap(os.path.join(tmp_path, "present.u1"), dtype=np.bool_, mode='w+', shape=shape)
+            data[group_codes[single], gene_codes[single]] = True
+        else:
+            data = np.memmap(os.path.join(tmp_path, f"{name}.f8"), dtype=store_dtype, mode='w+', shape=shape)
+            data[:] = np.nan
+            data[group_codes[single], gene_codes[single]] = df[name].to_numpy()[single]
+        data.flush()
+        del data
+    np.savez(os.path.join(tmp_path, "duplicates.npz"), groups=group_codes[duplicated], genes=gene_codes[duplicated],
+             **{name: df[name].to_numpy()[duplicated] for name in store_metrics})
+    with open(os.path.join(tmp_path, "labels.json"), 'w', encoding='utf-8') as file:
+        json.dump({'tissue_name': tissue_labels, 'cell_name': cell_labels, 'symbol': genes}, file,
+                  ensure_ascii=False)
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        json.dump({'version': version, 'shape': shape, 'metrics': store_metrics}, file)
+
+    path = os.path.join(root, f"v{version}")
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # 另一个进程已经写好了同一版本
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    for name in os.listdir(root):
+        if name != f"v{version}" and not name.startswith("."):
+            # 已映射旧文件的进程不受影响，文件在取消映射后才真正释放
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    print(f"Column store for {shape[0]} groups x {shape[1]} genes has been saved to '{path}'.")
+    store = ColumnStore(path)
+    _store_cache[db.dbName] = store
+    return store
+
+
+def current_column_store(db):
+    """
+    打开与数据库数据版本一致的列式存储（内存缓存或磁盘目录），没有时返回 None。
+    """
+    version = db.get_data_version()
+    store = _store_cache.get(db.dbName)
+    if store is not None and store.version == version:
+        return store
+
+    path = os.path.join(store_dir(db), f"v{version}")
+    # 旧格式（按层存放重复行）的目录没有 duplicates.npz，同样重新导出
+    if os.path.exists(os.path.join(path, "duplicates.npz")):
+        store = ColumnStore(path)
+        _store_cache[db.dbName] = store
+        return store
+    return None
+
+
+def load_column_store(db):
+    """
+    读取列式存储；数据版本不一致时在后台重新导出并返回 None，调用方在新版本就绪前继续使用 SQL 查询。
+    """
+    store = current_column_store(db)
+    if store is None:
+        refresh_column_store(db.dbName)
+    return store
+
+
+def refresh_column_store(db_path):
+    """
+    在后台线程中用连接池的只读连接按最新的数据版本重新导出，不阻塞调用方；
+    写队列在每次提交之后调用（见 WriteQueue.add_commit_listener）。已有导出在进行时不重复启动，
+    那次导出结束时会检查数据版本，期间的提交不会漏掉。
+    """
+    with _refresh_lock:
+        if db_path in _refreshing:
+            return
+        _refreshing.add(db_path)
+    threading.Thread(target=_refresh, args=(db_path,), name="column-store", daemon=True).start()
+
+
+def _refresh(db_path):
+    pool = get_pool(db_path)
+    try:
+        while True:
+            db = pool.reader()
+            try:
+                with _refresh_lock:
+                    if current_column_store(db) is not None:
+                        _refreshing.discard(db_path)
+                        return
+                build_column_store(db)
+            finally:
+                db.close_connection()
+    except Exception as e:
+        with _refresh_lock:
+            _refreshing.discard(db_path)
+        print(f"Column store rebuild failed: {e}")
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    build_column_store(db)
+    db.close_connection()
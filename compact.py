@@ -0,0 +1,115 @@
+import sys
+from sqlite_tool import SqliteTool
+from indexes import create_query_indexes
+
+# 需要做字典编码的文本列，每列对应一张 dict_<列名> 查找表
+dictionary_columns = ['tissue_id', 'cell_type_id', 'gene_id', 'symbol', 'cell_name', 'tissue_name', 'organism',
+                      'disease']
+
+
+def compact_target_table(db):
+    """
+    把 target_table 转为字典编码的紧凑存储：
+    每个文本列建一张 dict_<列名>(id, value) 查找表，数据存入以整数为键的 target_fact，
+    原来的 target_table 变为同名同列的视图，func.py 中的查询无需修改即可使用；
+    视图上的 INSTEAD OF 触发器把写入转发到 target_fact。
+
+    :param db: SqliteTool 实例
+    """
+    if db.is_compact():
+        print("Table 'target_table' is already compact.")
+        return
+
+    columns = db.get_table_column_names('target_table')
+    encoded = [col for col in columns if col in dictionary_columns]
+
+    for col in encoded:
+        db._cur.execute(f"DROP TABLE IF EXISTS dict_{col}")
+        db._cur.execute(f"CREATE TABLE dict_{col} (id INTEGER PRIMARY KEY, value TEXT UNIQUE)")
+        db._cur.execute(f"""
+            INSERT INTO dict_{col} (value)
+            SELECT DISTINCT {col} FROM target_table WHERE {col} IS NOT NULL ORDER BY {col}
+        """)
+
+    # 整数键的事实表，列名与 target_table 保持一致，这样索引定义在两种存储下通用
+    db._cur.execute("DROP TABLE IF EXISTS target_fact")
+    db._cur.execute("PRAGMA table_info(target_table)")
+    column_types = {row[1]: row[2] for row in db._cur.fetchall()}
+    fact_columns = ', '.join([f"{col} INTEGER" if col in encoded else f"{col} {column_types[col]}"
+                              for col in columns])
+    db._cur.execute(f"CREATE TABLE target_fact ({fact_columns})")
+
+    select_columns = ', '.join([f"d_{col}.id" if col in encoded else f"t.{col}" for col in columns])
+    joins = '\n'.join([f"LEFT JOIN dict_{col} AS d_{col} ON d_{col}.value = t.{col}" for col in encoded])
+    db._cur.execute(f"""
+        INSERT INTO target_fact ({', '.join(columns)})
+        SELECT {select_columns}
+        FROM target_table AS t
+        {joins}
+    """)
+
+    db._cur.execute("DROP TABLE target_table")
+    create_target_view(db, columns, encoded)
+    db._conn.commit()
+    db.set_compact(True)
+
+    create_query_indexes(db)
+    db.ensure_tissue_indexes()
+    db._conn.commit()
+
+    db._cur.execute("VACUUM")
+    print(f"Table 'target_table' has been compacted into 'target_fact' with {len(encoded)} dictionary tables.")
+
+
+def create_target_view(db, columns, encoded):
+    """
+    创建 target_table 视图以及转发写入的 INSTEAD OF 触发器。
+    """
+    select_columns = ', '.join([f"d_{col}.value AS {col}" if col in encoded else f"target_fact.{col}"
+                                for col in columns])
+    joins = '\n'.join([f"LEFT JOIN dict_{col} AS d_{col} ON d_{col}.id = target_fact.{col}" for col in encoded])
+    db._cur.execute(f"""
+        CREATE VIEW target_table AS
+        SELECT {select_columns}
+        FROM target_fact
+        {joins}
+    """)
+
+    new_values = ', '.join([f"(SELECT id FROM dict_{col} WHERE value = NEW.{col})" if col in encoded
+                            else f"NEW.{col}" for col in columns])
+    dict_inserts = '\n'.join([f"INSERT OR IGNORE INTO dict_{col} (value) SELECT NEW.{col} WHERE NEW.{col} IS NOT NULL;"
+                              for col in encoded])
+    db._cur.execute(f"""
+        CREATE TRIGGER target_table_insert INSTEAD OF INSERT ON target_table
+        BEGIN
+            {dict_inserts}
+            INSERT INTO target_fact ({', '.join(columns)}) VALUES ({new_values});
+        END
+    """)
+
+    old_match = ' AND '.join([f"{col} IS (SELECT id FROM dict_{col} WHERE value = OLD.{col})" if col in encoded
+                              else f"{col} IS OLD.{col}" for col in columns])
+    db._cur.execute(f"""
+        CREATE TRIGGER target_table_delete INSTEAD OF DELETE ON target_table
+        BEGIN
+            DELETE FROM target_fact WHERE {old_match};
+        END
+    """)
+
+
+def drop_compact_tables(db):
+    """
+    删除紧凑存储的视图、事实表和查找表，供重新预处理前调用。
+    """
+    db._cur.execute("DROP VIEW IF EXISTS target_table")
+    db._cur.execute("DROP TABLE IF EXISTS target_fact")
+    for col in dictionary_columns:
+        db._cur.execute(f"DROP TABLE IF EXISTS dict_{col}")
+    db._conn.commit()
+    db.set_compact(False)
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    compact_target_table(db)
+    db.close_connection()
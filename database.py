@@ -1,10 +1,18 @@
 import sqlite3
 import csv
-from sqlite_tool import SqliteTool
+import os
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from itertools import islice
+from sqlite_tool import SqliteTool, DB_PATH
 from process import process_raw
+from compact import compact_target_table
+from indexes import check_query_plans
 
-db_path = "/usr/src/app/example.db"
-db = SqliteTool(db_path)
+db_path = DB_PATH
+csv_path = "human-normal.csv"
 
 # conn = sqlite3.connect('example.db')
 # cursor = conn.cursor()
@@ -29,43 +37,250 @@ CREATE TABLE IF NOT EXISTS csv_data (
     disease TEXT
 )
 '''
-db._cur.execute(create_table_sql)
-
-with open('human-normal.csv', 'r') as file:
-    csv_reader = csv.reader(file, delimiter=',')
-    next(csv_reader)  # 跳过标题行
-
-    for row in csv_reader:
-        # 根据列标题来解析CSV数据
-        #id_value = row[0].strip()
-        tissue_id = row[1].strip() or 'blank'
-        cell_type_id = row[2].strip() or 'blank'
-        gene_id = row[3].strip() or 'blank'
-        number_nonzero_expression_cells = int(row[4].strip() if row[4].strip().isdigit() else 0)
-        expression_sum = float(row[5].strip().replace(',', '.')) if row[5].strip() else 0.0
-        number_cells = int(row[6].strip() if row[6].strip().isdigit() else 0)
-        symbol = row[7].strip() or 'blank'
-        cell_name = row[8].strip() or 'blank'
-        tissue_name = row[9].strip() or 'blank'
-        expression_sum_QC = float(row[10].strip().replace(',', '.')) if row[10].strip() else 0.0
-        expr_pct = float(row[11].strip().replace(',', '.')) if row[11].strip() else 0.0
-        active_expr_mean = float(row[12].strip().replace(',', '.')) if row[12].strip() else 0.0
-        expr_mean = float(row[13].strip().replace(',', '.')) if row[13].strip() else 0.0
-        organism = row[14].strip() or 'blank'
-        disease = row[15].strip() or 'blank'
-
-        # 插入数据到表中，包括id列
-        db._cur.execute('''INSERT INTO csv_data (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells, 
-                                     expression_sum, number_cells, symbol, cell_name, tissue_name, 
-                                     expression_sum_QC, expr_pct, active_expr_mean, expr_mean, organism, disease)
-                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                       (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells, expression_sum,
-                        number_cells,
-                        symbol, cell_name, tissue_name, expression_sum_QC, expr_pct, active_expr_mean, expr_mean, organism, disease))
-
-
-
-
-db._conn.commit()
-process_raw(db)
-db.close_connection()
\ No newline at end of file
+
+insert_sql = '''INSERT INTO csv_data (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells,
+                             expression_sum, number_cells, symbol, cell_name, tissue_name,
+                             expression_sum_QC, expr_pct, active_expr_mean, expr_mean, organism, disease)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# 批量导入时使用的 PRAGMA：建库过程可以整体重跑，因此牺牲崩溃安全换取写入速度
+bulk_pragmas = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 MB
+    'temp_store': 'MEMORY',
+    'locking_mode': 'EXCLUSIVE',
+}
+
+# 导入完成后恢复的默认设置
+default_pragmas = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'temp_store': 'DEFAULT',
+    'locking_mode': 'NORMAL',
+}
+
+
+def parse_row(row):
+    """
+    根据列标题来解析一行 CSV 数据，返回可直接插入 csv_data 的元组。
+
+    :param row: csv.reader 读出的一行（第 0 列为原始 id，不导入）
+    """
+    tissue_id = row[1].strip() or 'blank'
+    cell_type_id = row[2].strip() or 'blank'
+    gene_id = row[3].strip() or 'blank'
+    number_nonzero_expression_cells = int(row[4].strip() if row[4].strip().isdigit() else 0)
+    expression_sum = float(row[5].strip().replace(',', '.')) if row[5].strip() else 0.0
+    number_cells = int(row[6].strip() if row[6].strip().isdigit() else 0)
+    symbol = row[7].strip() or 'blank'
+    cell_name = row[8].strip() or 'blank'
+    tissue_name = row[9].strip() or 'blank'
+    expression_sum_QC = float(row[10].strip().replace(',', '.')) if row[10].strip() else 0.0
+    expr_pct = float(row[11].strip().replace(',', '.')) if row[11].strip() else 0.0
+    active_expr_mean = float(row[12].strip().replace(',', '.')) if row[12].strip() else 0.0
+    expr_mean = float(row[13].strip().replace(',', '.')) if row[13].strip() else 0.0
+    organism = row[14].strip() or 'blank'
+    disease = row[15].strip() or 'blank'
+
+    return (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells, expression_sum,
+            number_cells, symbol, cell_name, tissue_name, expression_sum_QC, expr_pct, active_expr_mean,
+            expr_mean, organism, disease)
+
+
+def set_pragmas(db, pragmas):
+    for name, value in pragmas.items():
+        db._cur.execute(f"PRAGMA {name} = {value}")
+        db._cur.fetchall()
+
+
+def load_csv_rows(db, path):
+    """
+    逐行读取 CSV 并逐行插入 csv_data（原始导入方式）。
+    """
+    with open(path, 'r') as file:
+        csv_reader = csv.reader(file, delimiter=',')
+        next(csv_reader)  # 跳过标题行
+
+        for row in csv_reader:
+            # 插入数据到表中，包括id列
+            db._cur.execute(insert_sql, parse_row(row))
+
+    db._conn.commit()
+
+
+def load_csv_bulk(db, path, batch_size=50000, commit_every=500000):
+    """
+    分块读取 CSV，每块用 executemany 批量插入 csv_data，
+    每 commit_every 行提交一次事务，并输出导入速度。
+
+    :param db: SqliteTool 实例
+    :param path: CSV 文件路径
+    :param batch_size: 每次 executemany 插入的行数
+    :param commit_every: 每个事务包含的最大行数
+    :return: 导入的总行数
+    """
+    start = time.perf_counter()
+    total = 0
+    uncommitted = 0
+
+    with open(path, 'r', newline='') as file:
+        csv_reader = csv.reader(file, delimiter=',')
+        next(csv_reader)  # 跳过标题行
+
+        while True:
+            batch = [parse_row(row) for row in islice(csv_reader, batch_size)]
+            if not batch:
+                break
+            db._cur.executemany(insert_sql, batch)
+            total += len(batch)
+            uncommitted += len(batch)
+
+            if uncommitted >= commit_every:
+                db._conn.commit()
+                uncommitted = 0
+                elapsed = time.perf_counter() - start
+                print(f"{total} rows loaded ({total / elapsed:.0f} rows/s)")
+
+    db._conn.commit()
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {total} rows into 'csv_data' in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s).")
+    return total
+
+
+def chunk_ranges(path, chunk_bytes):
+    """
+    将 CSV 文件（跳过标题行）按字节切分为 [start, end) 区间。
+    每一行归属于其起始字节所在的区间，区间边界不必对齐到行首。
+    """
+    with open(path, 'rb') as file:
+        file.readline()  # 跳过标题行
+        start = file.tell()
+    size = os.path.getsize(path)
+
+    ranges = []
+    while start < size:
+        end = min(start + chunk_bytes, size)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def parse_chunk(path, start, end):
+    """
+    工作进程：解析起始字节落在 [start, end) 内的所有行，返回清洗后的行元组列表。
+    注意：字段内含换行符的 CSV 无法按字节切分，需使用 bulk 模式导入。
+    """
+    lines = []
+    with open(path, 'rb') as file:
+        # 跳到 start 之后的第一个行首（start-1 为换行符时即 start 本身）
+        file.seek(start - 1)
+        file.readline()
+        pos = file.tell()
+        while pos < end:
+            line = file.readline()
+            if not line:
+                break
+            lines.append(line.decode('utf-8'))
+            pos += len(line)
+
+    return [parse_row(row) for row in csv.reader(lines, delimiter=',')]
+
+
+def load_csv_parallel(db, path, workers=None, chunk_bytes=32 * 1024 * 1024, commit_every=500000):
+    """
+    多进程解析 CSV，主进程作为唯一写入者按文件顺序写入 csv_data，
+    因此写入的行（包括自增 id）与 bulk/row 模式完全一致。
+
+    :param db: SqliteTool 实例
+    :param path: CSV 文件路径
+    :param workers: 解析进程数，默认为 CPU 核数
+    :param chunk_bytes: 每个解析任务的字节数
+    :param commit_every: 每个事务包含的最大行数
+    :return: 导入的总行数
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = chunk_ranges(path, chunk_bytes)
+    start = time.perf_counter()
+    total = 0
+    uncommitted = 0
+
+    with multiprocessing.Pool(workers) as pool:
+        # 同时最多有 2 * workers 个块在解析或等待写入，限制内存占用
+        pending = deque()
+        tasks = iter(ranges)
+        for chunk_start, chunk_end in islice(tasks, 2 * workers):
+            pending.append(pool.apply_async(parse_chunk, (path, chunk_start, chunk_end)))
+
+        while pending:
+            batch = pending.popleft().get()
+            next_range = next(tasks, None)
+            if next_range is not None:
+                pending.append(pool.apply_async(parse_chunk, (path,) + next_range))
+
+            db._cur.executemany(insert_sql, batch)
+            total += len(batch)
+            uncommitted += len(batch)
+
+            if uncommitted >= commit_every:
+                db._conn.commit()
+                uncommitted = 0
+                elapsed = time.perf_counter() - start
+                print(f"{total} rows loaded ({total / elapsed:.0f} rows/s)")
+
+    db._conn.commit()
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {total} rows into 'csv_data' with {workers} workers in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):.0f} rows/s).")
+    return total
+
+
+def build_database(db_file, data_file, mode='bulk', batch_size=50000, commit_every=500000,
+                   workers=None, chunk_bytes=32 * 1024 * 1024, engine='window', compact=False):
+    db = SqliteTool(db_file)
+    if mode != 'row':
+        set_pragmas(db, bulk_pragmas)
+
+    db._cur.execute(create_table_sql)
+
+    if mode == 'parallel':
+        load_csv_parallel(db, data_file, workers, chunk_bytes, commit_every)
+    elif mode == 'bulk':
+        load_csv_bulk(db, data_file, batch_size, commit_every)
+    else:
+        load_csv_rows(db, data_file)
+
+    # 索引在 process_raw 中、数据全部导入之后再创建
+    process_raw(db, engine)
+    if compact:
+        compact_target_table(db)
+    # 热点查询退化为全表扫描时让建库失败
+    check_query_plans(db)
+
+    if mode != 'row':
+        set_pragmas(db, default_pragmas)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the SQLite database from the atlas CSV export.")
+    parser.add_argument('--csv', default=csv_path, help="CSV file to import")
+    parser.add_argument('--db', default=db_path, help="SQLite database file to build")
+    parser.add_argument('--mode', choices=['bulk', 'parallel', 'row'], default='bulk',
+                        help="bulk: batched executemany with build pragmas; "
+                             "parallel: multi-process parsing with a single writer; "
+                             "row: original row-by-row insert")
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--commit-every', type=int, default=500000)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of parsing processes in parallel mode (default: CPU count)")
+    parser.add_argument('--chunk-bytes', type=int, default=32 * 1024 * 1024,
+                        help="bytes of CSV parsed per task in parallel mode")
+    parser.add_argument('--engine', choices=['window', 'legacy'], default='window',
+                        help="preprocessing engine used by process_raw")
+    parser.add_argument('--compact', action='store_true',
+                        help="store target_table dictionary-encoded (see compact.py)")
+    args = parser.parse_args()
+
+    build_database(args.db, args.csv, args.mode, args.batch_size, args.commit_every,
+                   args.workers, args.chunk_bytes, args.engine, args.compact)
@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+from contextlib import contextmanager
+from urllib.parse import quote
+from sqlite_tool import SqliteTool, DB_PATH
+from indexes import check_query_plans
+from cell_index import ensure_cell_name_index
+
+# 发布历史中保留的旧版本数（不含当前版本），用于回滚
+keep_versions = int(os.environ.get("KEEP_VERSIONS", "3"))
+# 发布前必须存在的表
+required_tables = ['csv_data', 'unique_csv_data', 'target_table']
+# 以数据库文件名为前缀的派生文件（expr_index.py、column_store.py、duckdb_tool.py），都按数据版本校验
+artifact_suffixes = ['.expr_index.npz', '.columns', '.parquet']
+
+
+def versions_dir(db_path):
+    return f"{db_path}.versions"
+
+
+def history_path(db_path):
+    return os.path.join(versions_dir(db_path), "published.json")
+
+
+def version_number(name):
+    """
+    v12.db -> 12，不是版本文件时返回 None。
+    """
+    if name.startswith("v") and name.endswith(".db") and name[1:-3].isdigit():
+        return int(name[1:-3])
+    return None
+
+
+def version_files(db_path):
+    """
+    返回 {版本号: 文件路径}，包括尚未发布和已回滚的版本。
+    """
+    root = versions_dir(db_path)
+    if not os.path.isdir(root):
+        return {}
+    return {version_number(name): os.path.join(root, name) for name in os.listdir(root)
+            if version_number(name) is not None}
+
+
+def next_version_path(db_path):
+    os.makedirs(versions_dir(db_path), exist_ok=True)
+    return os.path.join(versions_dir(db_path), f"v{max(version_files(db_path), default=0) + 1}.db")
+
+
+def current_version_path(db_path):
+    """
+    当前发布的版本文件；db_path 还是普通文件（尚未 adopt）时返回它本身。
+    """
+    return os.path.realpath(db_path)
+
+
+def live_data_version(db_path):
+    """
+    当前发布的版本文件中的数据版本号。写队列的提交直接写入当前版本、增加它的数据版本号，
+    发布历史中的 data_version 不会随之更新，可能小于它。
+    """
+    path = current_version_path(db_path)
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+    try:
+        return SqliteTool(db_path, connection=conn).get_data_version()
+    finally:
+        conn.close()
+
+
+def next_data_version(db_path, history):
+    """
+    发布或回滚后使用的最小数据版本号：大于发布过的和当前版本文件中的数据版本号。
+    """
+    return max(history['data_version'], live_data_version(db_path)) + 1
+
+
+def load_history(db_path):
+    """
+    发布历史：published 为依次发布的版本文件名，最后一个是当前版本；
+    data_version 为发布过的最大数据版本号。
+    """
+    try:
+        with open(history_path(db_path), encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'published': [], 'data_version': 0}
+
+
+def save_history(db_path, history):
+    tmp_path = history_path(db_path) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(history, file, indent=2)
+    os.replace(tmp_path, history_path(db_path))
+
+
+def copy_database(source, target):
+    """
+    用 SQLite 的在线备份复制数据库：读取的是一致的快照（包括 WAL 中已提交的内容），复制期间其他连接照常读取。
+    """
+    src = sqlite3.connect(f"file:{os.path.abspath(source)}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def remove_files(paths):
+    for name in paths:
+        if os.path.isdir(name):
+            shutil.rmtree(name, ignore_errors=True)
+        elif os.path.exists(name):
+            os.remove(name)
+
+
+def remove_version(path):
+    remove_files([path, path + "-wal", path + "-shm", path + "-journal"]
+                 + [path + suffix for suffix in artifact_suffixes])
+
+
+def move_artifacts(path, db_path):
+    """
+    把以版本文件命名的派生文件（建库时 build_derived 生成）移到 db_path 的名下，连接池以 db_path 为 dbName 读取它们。
+    目录按数据版本的子目录逐个移入，不影响正在使用其他子目录的读取方；旧数据版本的子目录由各模块下次重建时删除。
+    """
+    for suffix in artifact_suffixes:
+        source, target = path + suffix, db_path + suffix
+        if os.path.isdir(source):
+            os.makedirs(target, exist_ok=True)
+            for name in os.listdir(source):
+                if os.path.exists(os.path.join(target, name)):
+                    shutil.rmtree(os.path.join(target, name))
+                os.replace(os.path.join(source, name), os.path.join(target, name))
+            shutil.rmtree(source)
+        elif os.path.exists(source):
+            os.replace(source, target)
+
+
+def validate_version(path):
+    """
+    发布前检查版本文件：quick_check 通过、必要的表存在且 target_table 不为空、热点查询没有退化为全表扫描。
+    不通过时抛出 ValueError / RuntimeError。
+
+    :return: 版本文件的数据版本号
+    """
+    db = SqliteTool(path)
+    try:
+        db._cur.execute("PRAGMA quick_check")
+        result = [row[0] for row in db._cur.fetchall()]
+        if result != ['ok']:
+            raise ValueError(f"Version '{path}' failed quick_check: {'; '.join(result[:5])}")
+        db._cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")
+        missing = set(required_tables) - {row[0] for row in db._cur.fetchall()}
+        if missing:
+            raise ValueError(f"Version '{path}' is missing table(s): {', '.join(sorted(missing))}")
+        db._cur.execute("SELECT 1 FROM target_table LIMIT 1")
+        if db._cur.fetchone() is None:
+            raise ValueError(f"Version '{path}' has an empty target_table")
+        check_query_plans(db)
+        return db.get_data_version()
+    finally:
+        db.close_connection()
+
+
+def set_data_version(path, minimum):
+    """
+    保证版本文件的数据版本号不小于 minimum 并合并 WAL。
+    连接池以 db_path 为 dbName，内存缓存和派生文件（<db>.columns/v<数据版本> 等）都按数据版本区分，
+    因此每次发布和回滚都让数据版本号增加，不同版本的数据不会混用。
+    """
+    db = SqliteTool(path)
+    try:
+        version = db.get_data_version()
+        if version < minimum:
+            db._cur.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value)")
+            db._cur.execute("""
+                INSERT INTO db_meta (key, value) VALUES ('data_version', ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """, (minimum,))
+            db._conn.commit()
+            version = minimum
+        # 连接池的只读连接要求 WAL 模式；合并后 -wal 为空，发布后只读连接不会读到旧的 WAL
+        db._cur.execute("PRAGMA journal_mode = WAL")
+        db._cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return version
+    finally:
+        db.close_connection()
+
+
+def point_to(db_path, path):
+    """
+    原子地把 db_path（符号链接）指向 path：新链接写好后用 os.replace 替换，读取方只会看到旧版本或新版本。
+    """
+    tmp_link = db_path + ".swap"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(path, os.path.dirname(os.path.abspath(db_path))), tmp_link)
+    os.replace(tmp_link, db_path)
+
+
+def publish(db_path, path):
+    """
+    检查 path 并把它发布为 db_path 的当前版本，然后清理多余的旧版本。
+    连接池在下一次请求时通过 realpath 发现新版本并重新连接，已经在执行的查询继续读取旧版本。
+    """
+    start = time.perf_counter()
+    built_version = validate_version(path)
+    history = load_history(db_path)
+    history['data_version'] = set_data_version(path, next_data_version(db_path, history))
+    if history['data_version'] == built_version:
+        move_artifacts(path, db_path)
+    else:
+        # 数据版本号已改变，建库时生成的派生文件不再对应，首次读取时按新的数据版本重新生成
+        remove_files([path + suffix for suffix in artifact_suffixes])
+    point_to(db_path, path)
+    history['published'].append(os.path.basename(path))
+    save_history(db_path, history)
+    prune_versions(db_path, history)
+    print(f"Version '{os.path.basename(path)}' (data version {history['data_version']}) published as "
+          f"'{db_path}' in {time.perf_counter() - start:.1f}s.")
+
+
+def rollback(db_path, version=None):
+    """
+    把 db_path 指回之前发布的版本：默认为上一个，version 指定时回到该版本最后一次发布的位置。
+    之后发布的版本从历史中移除，下一次发布时删除。
+    """
+    history = load_history(db_path)
+    published = history['published']
+    if version is None:
+        index = len(published) - 2
+    else:
+        names = [version_number(name) for name in published]
+        index = len(names) - 1 - names[::-1].index(version) if version in names else -1
+    if index < 0 or index >= len(published) - 1:
+        raise ValueError(f"No earlier published version to roll back to (history: {', '.join(published)})")
+
+    path = os.path.join(versions_dir(db_path), published[index])
+    validate_version(path)
+    # 回滚也让数据版本号增加，内存中的缓存不会把回滚后的数据当作已缓存的旧版本
+    history['data_version'] = set_data_version(path, next_data_version(db_path, history))
+    point_to(db_path, path)
+    history['published'] = published[:index + 1]
+    save_history(db_path, history)
+    print(f"Rolled back '{db_path}' to '{published[index]}'.")
+
+
+def prune_versions(db_path, history):
+    """
+    删除不再需要的版本文件：保留当前版本和历史中最近的 keep_versions 个版本；
+    编号大于当前版本的文件（回滚掉的版本，或正在生成的版本）留到下一次发布之后再删除。
+    """
+    published = history['published']
+    keep = set(published[-(keep_versions + 1):])
+    current = version_number(published[-1])
+    for number, path in version_files(db_path).items():
+        if os.path.basename(path) not in keep and number < current:
+            # 仍打开旧版本的只读连接不受影响，文件在连接关闭后才真正释放
+            remove_version(path)
+    history['published'] = [name for name in published if name in keep]
+    save_history(db_path, history)
+
+
+def adopt(db_path=DB_PATH, move=False):
+    """
+    把普通文件形式的数据库放入版本目录，db_path 改为指向它的符号链接；已经是符号链接时什么也不做。
+
+    :param move: 为 True 时直接移动文件（只在没有其他连接打开数据库时使用，例如启动时）；
+                 否则在线复制一份，打开旧文件的连接不受影响
+    """
+    if os.path.islink(db_path) or not os.path.exists(db_path):
+        return
+    path = next_version_path(db_path)
+    if move:
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        os.rename(db_path, path)
+        for name in (db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(name):
+                os.remove(name)
+    else:
+        copy_database(db_path, path)
+    # 旧版本建立的数据库可能还没有细胞名索引表，发布前在版本文件上补建
+    db = SqliteTool(path)
+    try:
+        ensure_cell_name_index(db)
+    finally:
+        db.close_connection()
+    history = load_history(db_path)
+    history['data_version'] = set_data_version(path, history['data_version'])
+    point_to(db_path, path)
+    history['published'].append(os.path.basename(path))
+    save_history(db_path, history)
+    print(f"Database '{db_path}' is now version '{os.path.basename(path)}'.")
+
+
+@contextmanager
+def build_version(db_path=DB_PATH):
+    """
+    在当前版本的副本上写入：with build_version() as db: ...，正常退出时提交、检查并发布新版本；
+    出现异常时删除副本，当前版本不受任何影响。调用方需要保证同一时间只有一个写入方（见 ConnectionPool.new_version）。
+    """
+    adopt(db_path)
+    path = next_version_path(db_path)
+    copy_database(current_version_path(db_path), path)
+    db = SqliteTool(path)
+    try:
+        yield db
+        db._conn.commit()
+    except BaseException:
+        db.close_connection()
+        remove_version(path)
+        raise
+    db.close_connection()
+    try:
+        publish(db_path, path)
+    except Exception:
+        remove_version(path)
+        raise
+
+
+def build_new_version(db_path, builder):
+    """
+    用 builder(path) 从头生成一个版本文件（CSV 建库或从快照导入），成功后发布。
+    """
+    adopt(db_path)
+    path = next_version_path(db_path)
+    try:
+        builder(path)
+        publish(db_path, path)
+    except BaseException:
+        remove_version(path)
+        raise
+
+
+def list_versions(db_path=DB_PATH):
+    history = load_history(db_path)
+    current = os.path.basename(current_version_path(db_path))
+    for number, path in sorted(version_files(db_path).items()):
+        name = os.path.basename(path)
+        state = "current" if name == current else "published" if name in history['published'] else "-"
+        print(f"{name:>10}  {os.path.getsize(path) / 1024 / 1024:10.1f} MB  {state}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the versioned database files behind DB_PATH.")
+    parser.add_argument('--db', default=DB_PATH, help="database path (a symlink to the current version)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="build a new version from the CSV export and publish it")
+    build_parser.add_argument('--csv', help="CSV file to import (default: database.py's)")
+    build_parser.add_argument('--compact', action='store_true', help="store target_table dictionary-encoded")
+    restore_parser = subparsers.add_parser('restore', help="build a new version from a Parquet snapshot")
+    restore_parser.add_argument('--snapshot', required=True, help="snapshot directory written by snapshot.py")
+    restore_parser.add_argument('--compact', action='store_true', help="store target_table dictionary-encoded")
+    rollback_parser = subparsers.add_parser('rollback', help="point the database back to an earlier version")
+    rollback_parser.add_argument('--to', type=int, help="version number (default: the previous one)")
+    subparsers.add_parser('adopt', help="move a plain database file into the versions directory (offline)")
+    subparsers.add_parser('list', help="list version files")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from database import build_database, csv_path
+        build_new_version(args.db, lambda path: build_database(path, args.csv or csv_path, compact=args.compact))
+    elif args.command == 'restore':
+        from snapshot import import_snapshot
+        build_new_version(args.db, lambda path: import_snapshot(args.snapshot, path, args.compact))
+    elif args.command == 'rollback':
+        rollback(args.db, args.to)
+    elif args.command == 'adopt':
+        adopt(args.db, move=True)
+    else:
+        list_versions(args.db)
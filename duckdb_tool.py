@@ -0,0 +1,333 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import duckdb
+import numpy as np
+import pandas as pd
+from sqlite_tool import SqliteTool, get_pool
+
+# 不导出到 Parquet 的表：原始数据只在预处理和写入时使用，查询不会读取
+skip_tables = ['csv_data', 'unique_csv_data', 'db_meta']
+# 从 SQLite 读取时每批的行数
+export_batch_size = 100000
+
+
+def parquet_dir(db_path):
+    return f"{db_path}.parquet"
+
+
+def translate_query(query):
+    """
+    把 func.py 中 SQLite 方言的写法改为 DuckDB 的等价写法：
+    a IS b / a IS NOT b 改为 IS [NOT] DISTINCT FROM，VALUES 的列名 column1.. 改为 col0..，
+    sqlite_master 中的表在 DuckDB 中是 Parquet 上的视图，空列表 IN () 改为空的子查询。
+    """
+    query = re.sub(r"\bIS\s+NOT\s+(?!NULL\b|DISTINCT\b)", "IS DISTINCT FROM ", query, flags=re.IGNORECASE)
+    query = re.sub(r"\bIS\s+(?!NOT\b|NULL\b|DISTINCT\b)", "IS NOT DISTINCT FROM ", query, flags=re.IGNORECASE)
+    query = re.sub(r"\.column(\d+)\b", lambda m: f".col{int(m.group(1)) - 1}", query)
+    query = re.sub(r"type\s*=\s*'table'", "type IN ('table', 'view')", query)
+    query = re.sub(r"\bIN\s*\(\s*\)", "IN (SELECT NULL WHERE FALSE)", query, flags=re.IGNORECASE)
+    return query
+
+
+class DuckDbCursor():
+    """
+    替代 sqlite3 游标：执行前翻译 SQL，结果的读取方式与 sqlite3 相同。
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, query, params=()):
+        self._conn.execute(translate_query(query), list(params))
+        return self
+
+    def executemany(self, query, seq_of_params):
+        seq_of_params = [list(params) for params in seq_of_params]
+        # 与 sqlite3 相同，空的参数列表什么也不做（DuckDB 会报错）
+        if seq_of_params:
+            self._conn.executemany(translate_query(query), seq_of_params)
+        return self
+
+    def fetchall(self):
+        return self._conn.fetchall()
+
+    def fetchone(self):
+        return self._conn.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._conn.fetchmany(size)
+
+    def close(self):
+        pass
+
+
+class DuckDbTool(SqliteTool):
+    """
+    只读的 SqliteTool：同样的 _cur 接口，查询在 DuckDB 上执行，数据为 target_table 等表导出的 Parquet 文件。
+    func.py 中的查询函数不需要修改；写入仍然在 SQLite 上进行，提交后由 DuckDbSource 在后台重新导出。
+    """
+    def __init__(self, dbName, connection, version):
+        self.dbName = dbName
+        self._pooled = True
+        self._conn = connection
+        self._cur = DuckDbCursor(connection)
+        self.defer_commit = False
+        self.version = version
+
+    def is_compact(self):
+        # 导出的 target_table 已经解码，DuckDB 的列式存储自带字典编码
+        return False
+
+    def get_data_version(self):
+        return self.version
+
+    def close_connection(self):
+        # 连接属于当前线程，临时表保留到下一次请求，与 SQLite 连接池的只读连接一致
+        pass
+
+
+def sqlite_type(db, table, column, declared):
+    """
+    按 SQLite 的类型亲和性确定 Parquet 列的类型；没有声明类型的列按实际存储的值判断。
+    """
+    declared = declared.upper()
+    if "INT" in declared:
+        return "BIGINT"
+    if any(name in declared for name in ("CHAR", "CLOB", "TEXT")):
+        return "VARCHAR"
+    if any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        return "DOUBLE"
+    db._cur.execute(f"SELECT DISTINCT typeof({column}) FROM {table}")
+    types = {row[0] for row in db._cur.fetchall()} - {'null'}
+    if types <= {'integer'}:
+        return "BIGINT"
+    if types <= {'integer', 'real'}:
+        return "DOUBLE"
+    return "VARCHAR"
+
+
+def export_table(db, con, table, path, batch_size=export_batch_size):
+    """
+    把 SQLite 中的 table（表或视图）分批读入 DuckDB，再写成 ZSTD 压缩的 Parquet 文件。
+    """
+    db._cur.execute(f"PRAGMA table_info({table})")
+    columns = [(row[1], row[2]) for row in db._cur.fetchall()]
+    types = [sqlite_type(db, table, name, declared) for name, declared in columns]
+    con.execute(f"CREATE OR REPLACE TEMP TABLE export ("
+                f"{', '.join(f'{name} {dtype}' for (name, _), dtype in zip(columns, types))})")
+    db._cur.execute(f"SELECT {', '.join(name for name, _ in columns)} FROM {table}")
+    while True:
+        rows = db._cur.fetchmany(batch_size)
+        if not rows:
+            break
+        batch = pd.DataFrame(rows, columns=[name for name, _ in columns], dtype=object)
+        con.register("batch", batch)
+        casts = ', '.join(f"CAST({name} AS {dtype})" for (name, _), dtype in zip(columns, types))
+        con.execute(f"INSERT INTO export SELECT {casts} FROM batch")
+        con.unregister("batch")
+    con.execute(f"COPY export TO '{path}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+    con.execute("DROP TABLE export")
+
+
+def export_parquet(db, keep=None):
+    """
+    把查询用到的表导出到 <db>.parquet/v<数据版本>/<表名>.parquet，并删除旧版本的目录。
+
+    :param keep: 不删除的旧导出目录（仍在查询的版本）
+    :return: 导出目录
+    """
+    version = db.get_data_version()
+    db._cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name")
+    tables = [row[0] for row in db._cur.fetchall()
+              if row[0] not in skip_tables and not row[0].startswith("sqlite_")]
+    if db.is_compact():
+        # target_table 视图按解码后的列导出，事实表和字典表不再需要
+        tables = [table for table in tables if table != "target_fact" and not table.startswith("dict_")]
+
+    root = parquet_dir(db.dbName)
+    os.makedirs(root, exist_ok=True)
+    # 先写到临时目录再改名，读取方不会看到写了一半的文件
+    tmp_path = tempfile.mkdtemp(prefix=".build-", dir=root)
+    con = duckdb.connect()
+    for table in tables:
+        export_table(db, con, table, os.path.join(tmp_path, f"{table}.parquet"))
+    con.close()
+    with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as file:
+        json.dump({'version': version, 'tables': tables}, file)
+
+    path = os.path.join(root, f"v{version}")
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # 另一个进程已经导出了同一版本
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    for name in os.listdir(root):
+        if name != f"v{version}" and not name.startswith(".") and os.path.join(root, name) != keep:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    print(f"Exported {len(tables)} table(s) to '{path}'.")
+    return path
+
+
+class DuckDbSource():
+    """
+    一个 SQLite 数据库对应的 DuckDB 查询端：内存中的 DuckDB 库，表为 Parquet 文件上的视图；
+    每个线程使用自己的游标（临时表互不影响）。
+    SQLite 的数据版本变化后在后台线程中重新导出，导出完成前继续查询上一次导出的版本，之后切换到新的视图；
+    只有还没有任何可用的导出时（第一次启动）才在请求中同步导出。
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # (数据版本, DuckDB 连接)，一起替换，读取方不会拿到不一致的组合
+        self._current = (None, None)
+        # 当前视图所在的导出目录，重新导出时保留
+        self._path = None
+        self._exporting = False
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+    def _open(self, path):
+        with open(os.path.join(path, "meta.json"), encoding='utf-8') as file:
+            meta = json.load(file)
+        con = duckdb.connect()
+        for table in meta['tables']:
+            con.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{os.path.join(path, table)}.parquet')")
+        return meta['version'], con
+
+    def _switch(self, path):
+        self._current = self._open(path)
+        self._path = path
+
+    def _export_path(self, version):
+        path = os.path.join(parquet_dir(self.db_path), f"v{version}")
+        return path if os.path.exists(os.path.join(path, "meta.json")) else None
+
+    def _refresh(self, sqlite_db):
+        version = sqlite_db.get_data_version()
+        if version == self._current[0]:
+            return self._current
+        with self._lock:
+            if version != self._current[0]:
+                path = self._export_path(version)
+                if path is not None:
+                    self._switch(path)
+                elif self._current[1] is None:
+                    self._switch(export_parquet(sqlite_db))
+                else:
+                    # 版本落后：继续使用上一次的导出，新版本在后台导出
+                    self.refresh()
+            return self._current
+
+    def refresh(self):
+        """
+        在后台线程中按 SQLite 最新的数据版本重新导出，完成后切换视图，不阻塞调用方。
+        已有导出在进行时不重复启动，那次导出结束时会检查数据版本，期间的提交不会漏掉。
+        """
+        with self._lock:
+            if self._exporting:
+                return
+            self._exporting = True
+        threading.Thread(target=self._export, name="duckdb-export", daemon=True).start()
+
+    def _export(self):
+        pool = get_pool(self.db_path)
+        try:
+            while True:
+                db = pool.sqlite_reader()
+                try:
+                    with self._lock:
+                        version = db.get_data_version()
+                        path = self._export_path(version)
+                        if path is not None:
+                            if version != self._current[0]:
+                                self._switch(path)
+                            self._exporting = False
+                            return
+                    export_parquet(db, keep=self._path)
+                finally:
+                    db.close_connection()
+        except Exception as e:
+            with self._lock:
+                self._exporting = False
+            print(f"Parquet export failed: {e}")
+
+    def reader(self, sqlite_db):
+        """
+        返回当前线程的 DuckDbTool。
+
+        :param sqlite_db: 同一数据库的只读 SqliteTool，用来读取数据版本和重新导出
+        """
+        version, con = self._refresh(sqlite_db)
+        owner, cursor = getattr(self._local, 'cursor', (None, None))
+        if owner is not con:
+            cursor = con.cursor()
+            self._local.cursor = (con, cursor)
+        return DuckDbTool(self.db_path, cursor, version)
+
+
+def refresh_parquet(db_path):
+    """
+    写队列在每次提交之后调用（见 WriteQueue.add_commit_listener），在后台重新导出 db_path 的 Parquet 文件。
+    """
+    get_pool(db_path).duckdb_source().refresh()
+
+
+def benchmark(db_path, cases):
+    """
+    在 SQLite 和 DuckDB 上依次执行 Gene Filter / Filter 页面的查询，比较结果并输出耗时。
+    """
+    from func import extract_matched_and_unmatched_rows_by_cell_name, unique_group, filter_genes_by_threshold, \
+        filter_genes_by_threshold_other, filter_marker_genes, df_data, extract_matched_rows_from_database
+
+    def run(db, tissue_list, target_offset, target_p, other_offset, other_p):
+        matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(db, "target_table",
+                                                                                         tissue_list)
+        target_count = unique_group(db, matched_cells, "target_table")
+        other_count = unique_group(db, unmatched_cells, "target_table")
+        gene_list1 = {row[0] for row in filter_genes_by_threshold(db, matched_cells, target_offset,
+                                                                  target_p * target_count)}
+        gene_list2 = {row[0] for row in filter_genes_by_threshold_other(db, unmatched_cells, other_offset,
+                                                                        other_count, other_p * other_count)}
+        combined = {row[0] for row in filter_marker_genes(db, matched_cells, target_offset, target_p, other_offset,
+                                                          other_p)}
+        selected_gene = sorted(gene for gene in gene_list1 & gene_list2 if gene != 'blank')
+        df = df_data(db, "target_table", matched_cells, selected_gene, 0.2)
+        df2 = extract_matched_rows_from_database(db, "target_table", matched_cells, selected_gene[:5] or ["blank"],
+                                                 ['Homo sapiens'], ['normal'])
+        return (target_count, other_count, sorted(gene_list1, key=str), sorted(gene_list2, key=str),
+                sorted(combined, key=str), frame_rows(df), frame_rows(df2))
+
+    sqlite_db = SqliteTool(db_path)
+    start = time.perf_counter()
+    source = DuckDbSource(db_path)
+    duck_db = source.reader(sqlite_db)
+    print(f"export + open: {time.perf_counter() - start:.3f}s")
+    for case in cases:
+        timings = []
+        results = []
+        for db in (sqlite_db, duck_db):
+            start = time.perf_counter()
+            results.append(run(db, *case))
+            timings.append(time.perf_counter() - start)
+        print(f"{case}: sqlite {timings[0]:.3f}s, duckdb {timings[1]:.3f}s, "
+              f"identical: {results[0] == results[1]}")
+    sqlite_db.close_connection()
+
+
+def frame_rows(df):
+    # AVG 的求和顺序不同，最后几位可能不同，按 12 位有效数字比较
+    return sorted(tuple(f"{value:.12g}" if isinstance(value, (float, np.floating)) else str(value) for value in row)
+                  for row in df.astype(object).itertuples(index=False, name=None))
+
+
+if __name__ == '__main__':
+    # 用法：python duckdb_tool.py example.db "mast cell" ...，对比 SQLite 和 DuckDB 的结果和耗时
+    tissue_list = sys.argv[2:] or ["mast cell"]
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else "example.db",
+              [(tissue_list, 1, 0.7, 0.1, 0.98), (tissue_list, 0.2, 0.1, 0.2, 0.1), (["cell"], 0.5, 0.3, 1.0, 0.2)])
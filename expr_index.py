@@ -0,0 +1,199 @@
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from sqlite_tool import SqliteTool, get_pool
+
+# dbName -> ExpressionIndex，进程内缓存
+_index_cache = {}
+# 正在后台重建索引的 dbName
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+
+def index_path(db):
+    return f"{db.dbName}.expr_index.npz"
+
+
+class ExpressionIndex():
+    """
+    按基因排序的 expr_mean 索引，用二分查找回答“某基因有多少行 expr_mean > t”。
+
+    所有不同的 expr_mean 值升序保存在 values 中，每行用名次 rank（1..R，NULL 为 0）表示，
+    gene_keys = 基因编号 * (R + 1) + rank 整体排序，一次 searchsorted 就能得到所有基因的计数；
+    另按组保存每行的基因和名次，目标组的计数只需读取目标组的行，
+    其余组的计数 = 全部组的计数 - 目标组的计数，与 atlas 的大小无关。
+    """
+    def __init__(self, genes, gene_null, group_cell_names, values, gene_keys, group_offsets, group_genes,
+                 group_ranks, version):
+        self.genes = np.array([None if null else gene for gene, null in zip(genes.tolist(), gene_null)],
+                              dtype=object)
+        self.group_cell_names = group_cell_names
+        self.values = values
+        self.gene_keys = gene_keys
+        self.group_offsets = group_offsets
+        self.group_genes = group_genes
+        self.group_ranks = group_ranks
+        self.version = int(version)
+
+        self.slot = len(values) + 1
+        gene_starts = np.arange(len(self.genes) + 1) * self.slot
+        bounds = np.searchsorted(gene_keys, gene_starts)
+        self.gene_ends = bounds[1:]
+        self.gene_rows = np.diff(bounds)
+
+    def rank_above(self, threshold_value):
+        """
+        expr_mean > threshold_value 等价于 rank >= 返回值。
+        """
+        return np.searchsorted(self.values, threshold_value, side='right') + 1
+
+    def all_above(self, threshold_value):
+        keys = np.arange(len(self.genes)) * self.slot + self.rank_above(threshold_value)
+        return self.gene_ends - np.searchsorted(self.gene_keys, keys)
+
+    def group_rows(self, group_ids):
+        if len(group_ids) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        rows = np.concatenate([np.arange(self.group_offsets[g], self.group_offsets[g + 1]) for g in group_ids])
+        return self.group_genes[rows], self.group_ranks[rows]
+
+    def marker_genes(self, matched_cells, target_offset, target_p, other_offset, other_p):
+        """
+        与 MarkerEngine.marker_genes 相同的接口和结果。
+
+        :return: (gene_list1, gene_list2)
+        """
+        names = getattr(matched_cells, 'names', matched_cells)
+        target_groups = np.flatnonzero(np.isin(self.group_cell_names, list(names)))
+        target_count = len(target_groups)
+        other_count = len(self.group_cell_names) - target_count
+
+        genes, ranks = self.group_rows(target_groups)
+        minlength = len(self.genes)
+        target_rows = np.bincount(genes, minlength=minlength)
+
+        above = np.bincount(genes[ranks >= self.rank_above(target_offset)], minlength=minlength)
+        gene_list1 = self.genes[(target_rows > 0) & (above >= target_p * target_count)].tolist()
+
+        target_above_other = np.bincount(genes[ranks >= self.rank_above(other_offset)], minlength=minlength)
+        above_other = self.all_above(other_offset) - target_above_other
+        present_other = self.gene_rows - target_rows > 0
+        gene_list2 = self.genes[present_other & (other_count - above_other >= other_p * other_count)].tolist()
+        return gene_list1, gene_list2
+
+
+def build_expression_index(db):
+    """
+    从 target_table 重建表达索引并保存到数据库旁的 <db>.expr_index.npz。
+    """
+    version = db.get_data_version()
+    db._cur.execute("""
+        SELECT tissue_name, cell_name, symbol, expr_mean
+        FROM target_table
+        WHERE cell_name IS NOT NULL
+    """)
+    rows = db._cur.fetchall()
+    df = pd.DataFrame(rows, columns=['tissue_name', 'cell_name', 'symbol', 'expr_mean'], dtype=object)
+
+    group_codes, groups = pd.factorize(pd.Series(list(zip(df['tissue_name'], df['cell_name'])), dtype=object),
+                                       use_na_sentinel=False)
+    gene_codes, genes = pd.factorize(df['symbol'], use_na_sentinel=False)
+    gene_null = np.array([pd.isna(gene) for gene in genes], dtype=bool)
+    genes = np.array(['' if null else gene for gene, null in zip(genes, gene_null)], dtype=str)
+
+    expr_mean = pd.to_numeric(df['expr_mean']).to_numpy(dtype=np.float64)
+    null_expr = np.isnan(expr_mean)
+    values = np.unique(expr_mean[~null_expr])
+    ranks = np.zeros(len(expr_mean), dtype=np.int64)
+    ranks[~null_expr] = np.searchsorted(values, expr_mean[~null_expr]) + 1
+
+    gene_codes = gene_codes.astype(np.int64)
+    gene_keys = np.sort(gene_codes * (len(values) + 1) + ranks)
+    order = np.argsort(group_codes, kind='stable')
+    group_offsets = np.concatenate([[0], np.cumsum(np.bincount(group_codes, minlength=len(groups)))])
+
+    arrays = {
+        'genes': genes,
+        'gene_null': gene_null,
+        'group_cell_names': np.array([cell_name for _, cell_name in groups], dtype=str),
+        'values': values,
+        'gene_keys': gene_keys,
+        'group_offsets': group_offsets.astype(np.int64),
+        'group_genes': gene_codes[order],
+        'group_ranks': ranks[order],
+        'version': np.array(version),
+    }
+    # 先写临时文件再替换，读取方不会看到写了一半的索引
+    tmp_path = index_path(db) + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, index_path(db))
+    print(f"Expression index for {len(groups)} groups x {len(genes)} genes has been saved to '{index_path(db)}'.")
+    index = ExpressionIndex(**arrays)
+    _index_cache[db.dbName] = index
+    return index
+
+
+def current_expression_index(db):
+    """
+    返回与数据库数据版本一致的表达索引（内存缓存或磁盘文件），没有时返回 None。
+    """
+    version = db.get_data_version()
+    index = _index_cache.get(db.dbName)
+    if index is not None and index.version == version:
+        return index
+
+    if os.path.exists(index_path(db)):
+        with np.load(index_path(db)) as data:
+            if int(data['version']) == version:
+                index = ExpressionIndex(**{key: data[key] for key in data.files})
+                _index_cache[db.dbName] = index
+                return index
+    return None
+
+
+def load_expression_index(db):
+    """
+    读取表达索引；数据版本不一致时在后台重建并返回 None，调用方在新索引就绪前继续使用 SQL 查询。
+    """
+    index = current_expression_index(db)
+    if index is None:
+        refresh_expression_index(db.dbName)
+    return index
+
+
+def refresh_expression_index(db_path):
+    """
+    在后台线程中用连接池的只读连接按最新的数据版本重建索引，不阻塞调用方；
+    写队列在每次提交之后调用（见 WriteQueue.add_commit_listener）。已有重建在进行时不重复启动，
+    那次重建结束时会检查数据版本，期间的提交不会漏掉。
+    """
+    with _refresh_lock:
+        if db_path in _refreshing:
+            return
+        _refreshing.add(db_path)
+    threading.Thread(target=_refresh, args=(db_path,), name="expr-index", daemon=True).start()
+
+
+def _refresh(db_path):
+    db = get_pool(db_path).reader()
+    try:
+        while True:
+            with _refresh_lock:
+                if current_expression_index(db) is not None:
+                    _refreshing.discard(db_path)
+                    return
+            build_expression_index(db)
+    except Exception as e:
+        with _refresh_lock:
+            _refreshing.discard(db_path)
+        print(f"Expression index rebuild failed: {e}")
+    finally:
+        db.close_connection()
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    build_expression_index(db)
+    db.close_connection()
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# 每次从游标读取的行数
+batch_size = 50000
+# 数值列的类型，绘图只需要单精度
+value_dtype = np.float32
+
+
+class LabelEncoder():
+    """
+    把文本列编码为整数：取值按第一次出现的顺序编号，None 编码为 -1。
+    每批数据先用 pd.factorize 去重，再用 Index.get_indexer 对应到已有的编号，不逐行经过 Python。
+    """
+    def __init__(self):
+        self.values = pd.Index([], dtype=object)
+
+    def encode(self, column):
+        codes, uniques = pd.factorize(column)
+        mapping = self.values.get_indexer(uniques)
+        new = mapping < 0
+        if new.any():
+            mapping[new] = np.arange(len(self.values), len(self.values) + new.sum())
+            self.values = self.values.append(pd.Index(uniques[new], dtype=object))
+        return np.append(mapping, -1).astype(np.int32)[codes]
+
+
+def fetch_frame(cursor, columns, label_columns, size=batch_size, dtype=value_dtype):
+    """
+    把已执行查询的结果分批读入 DataFrame：label_columns 中的文本列保存为 category，
+    其余列为 dtype 的数值列（None 为 NaN）。数组按容量倍增预先分配，不经过整表的 Python 元组列表。
+
+    :param cursor: 已执行查询的游标
+    :param columns: 查询返回的列名（与 SELECT 的顺序一致）
+    :param label_columns: 作为分类列的列名
+    :param dtype: 数值列的类型，需要与 SQLite 完全一致时使用 np.float64
+    :return: DataFrame
+    """
+    encoders = {column: LabelEncoder() for column in label_columns}
+    capacity = size
+    arrays = {column: np.empty(capacity, dtype=np.int32 if column in encoders else dtype)
+              for column in columns}
+    count = 0
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        n = len(rows)
+        if count + n > capacity:
+            while count + n > capacity:
+                capacity *= 2
+            for column in columns:
+                arrays[column] = np.resize(arrays[column], capacity)
+        block = np.array(rows, dtype=object)
+        for i, column in enumerate(columns):
+            if column in encoders:
+                arrays[column][count:count + n] = encoders[column].encode(block[:, i])
+            else:
+                arrays[column][count:count + n] = block[:, i].astype(dtype)
+        count += n
+
+    return pd.DataFrame({
+        column: categorical(arrays[column][:count], encoders[column].values) if column in encoders
+        else arrays[column][:count]
+        for column in columns
+    })
+
+
+def categorical(codes, values):
+    return pd.Categorical.from_codes(codes, categories=pd.Index(values, dtype=object))
+
+
+def add_cell_label(df):
+    """
+    由 cell_name / tissue_name 的编码计算 cell_label（"cell_name # tissue_name"）：
+    只对不同的 (cell_name, tissue_name) 组合拼接字符串，任一为空时标签为 NaN。
+    """
+    cells = df['cell_name'].cat.categories
+    tissues = df['tissue_name'].cat.categories
+    cell_codes = df['cell_name'].cat.codes.to_numpy(dtype=np.int64)
+    tissue_codes = df['tissue_name'].cat.codes.to_numpy(dtype=np.int64)
+    pairs = pd.array(cell_codes * len(tissues) + tissue_codes, dtype="Int64")
+    pairs[(cell_codes < 0) | (tissue_codes < 0)] = pd.NA
+    codes, uniques = pd.factorize(pairs)
+    labels = np.array([f"{cells[pair // len(tissues)]} # {tissues[pair % len(tissues)]}" for pair in uniques],
+                      dtype=object)
+    # 不同的组合也可能拼出相同的标签，再去重一次
+    label_codes, label_values = pd.factorize(labels)
+    label_codes = np.append(label_codes, -1).astype(np.int32)
+    df['cell_label'] = categorical(label_codes[codes], label_values)
+    return df
+
+
+def fetch_plot_frame(cursor, columns, label_columns=('cell_name', 'tissue_name', 'symbol')):
+    """
+    读取绘图查询的结果并加上 cell_label 列。
+    """
+    df = fetch_frame(cursor, columns, [column for column in columns if column in label_columns])
+    return add_cell_label(df)
@@ -1,9 +1,26 @@
 from sqlite_tool import SqliteTool
-import re
-import pandas as pd
+from cell_index import load_cell_name_index
+from cell_set import CellSet
+from group_summary import has_group_summary
+from frames import fetch_plot_frame
+
+# 绘图查询返回的列
+plot_columns = ['cell_name', 'tissue_name', 'symbol', 'expr_mean', 'expr_pct', 'active_expr_mean']
 
 #db = SqliteTool('example.db')
-def extract_matched_rows_from_database(db, source_table, matched_rows_str, gene_list, organism_list, disease_list):
+def extract_matched_rows_from_database(db, source_table, matched_cells, gene_list, organism_list, disease_list,
+                                       groups=None):
+    """
+    :param groups: 只返回这些 (tissue_name, cell_name) 组的行（分页绘图时的一页），None 表示全部
+    """
+    query, params = matched_rows_query(source_table, matched_cells, gene_list, organism_list, disease_list, groups)
+    # 执行查询
+    db._cur.execute(query, params)
+    # 按批读入分类列和数值列
+    return fetch_plot_frame(db._cur, plot_columns)
+
+
+def matched_rows_query(source_table, matched_cells, gene_list, organism_list, disease_list, groups=None):
     # 构建基因列表的条件
     gene_condition = " OR ".join([f"symbol = ?" for gene in gene_list])
 
@@ -11,104 +28,193 @@ def extract_matched_rows_from_database(db, source_table, matched_rows_str, gene_
     organism_condition = " OR ".join([f"organism = ?" for org in organism_list])
     disease_condition = " OR ".join([f"disease = ?" for dis in disease_list])
 
-    # 构建查询语句的列
-    columns = ['cell_name', 'tissue_name', 'symbol', 'expr_mean', 'expr_pct', 'active_expr_mean']
+    window_condition, window_params = group_window_condition(groups)
 
     # 构建完整的查询语句
     query = f"""
-    SELECT {', '.join(columns)}
+    SELECT {', '.join(plot_columns)}
     FROM {source_table}
-    WHERE cell_name IN ({matched_rows_str}) AND ({gene_condition})
-    AND ({organism_condition}) AND ({disease_condition});
+    WHERE {matched_cells.condition()} AND ({gene_condition})
+    AND ({organism_condition}) AND ({disease_condition})
+    AND {window_condition}
     """
 
     # 参数列表，包含基因列表、organism 列表和 disease 列表
-    params = gene_list + organism_list + disease_list
+    params = gene_list + organism_list + disease_list + window_params
+    return query, params
 
-    # 执行查询
-    db._cur.execute(query, params)
-    filtered_data = db._cur.fetchall()
 
-    # 将结果转换为 DataFrame
-    df_filtered = pd.DataFrame(filtered_data, columns=columns)
-    df_filtered['cell_label'] = df_filtered['cell_name'] + ' # ' + df_filtered['tissue_name']
+def extract_matched_groups(db, source_table, matched_cells, gene_list, organism_list, disease_list, limit=None,
+                           offset=0):
+    """
+    返回 extract_matched_rows_from_database 结果中的 (tissue_name, cell_name) 组，按细胞名排序，用于分页。
 
-    return df_filtered
+    :param limit: 最多返回的组数，None 表示全部；offset 为跳过的组数
+    """
+    query, params = matched_rows_query(source_table, matched_cells, gene_list, organism_list, disease_list)
+    return result_groups(db, query, params, limit, offset)
 
 
 def extract_matched_and_unmatched_rows_by_cell_name(db, source_table, keywords):
-    matched_rows = []
-    unmatched_rows = []
+    # 用持久化的单词倒排索引在不同的细胞名上做集合运算，不再逐行匹配正则
+    index = load_cell_name_index(db)
+    # 匹配的细胞名写入临时表；未匹配的细胞即其补集，不再列出全部名称
+    matched_cells = CellSet(db, index.match(keywords))
+    unmatched_cells = matched_cells.complement()
+    return matched_cells, unmatched_cells
 
-    unique_cell_names = db.get_index_column_values("unique_csv_data", "cell_name")
 
-    for cell_name in unique_cell_names:
-        matched = False
-        for keyword in keywords:
-            pattern = re.compile(r'\b' + re.escape(keyword) + r'\b', re.IGNORECASE)
-            if re.search(pattern, cell_name):
-                matched_rows.append(cell_name)
-                matched = True
-                break
-        if not matched:
-            unmatched_rows.append(cell_name)
-    matched_rows = list(set(matched_rows))
-    matched_rows_str = ', '.join([f"'{row}'" for row in matched_rows])
-    unmatched_rows_str = ', '.join([f"'{row}'" for row in unmatched_rows])
-    #print(matched_rows_str)
-    #print(unmatched_rows_str)
-    return matched_rows_str, unmatched_rows_str
 
+def df_data(db, source_table, matched_cells, combined_gene_list, threshold=0.2, groups=None):
+    """
+    :param groups: 只返回这些 (tissue_name, cell_name) 组的行（分页绘图时的一页），None 表示全部
+    """
+    filter_query, params = df_data_query(db, source_table, matched_cells, combined_gene_list, threshold, groups)
 
+    # Execute the query
+    db._cur.execute(filter_query, params)
+    return fetch_plot_frame(db._cur, plot_columns)
 
-def df_data(db, source_table, matched_rows_str, combined_gene_list, threshold=0.2):
-    columns = ['cell_name', 'tissue_name', 'symbol', 'expr_mean', 'expr_pct', 'active_expr_mean']
 
-    # Convert matched_rows_str to a list of cell names
-    matched_rows_list = matched_rows_str.replace("'", "").split(", ")
+def df_data_query(db, source_table, matched_cells, combined_gene_list, threshold=0.2, groups=None):
+    window_condition, window_params = group_window_condition(groups)
 
     # Construct the filter query
     filter_query = f"""
-    SELECT {', '.join(columns)}
+    SELECT {', '.join(plot_columns)}
     FROM {source_table}
     WHERE symbol IN ({','.join(['?' for _ in combined_gene_list])})
-    AND cell_name IN ({','.join(['?' for _ in matched_rows_list])})
-    AND (tissue_name, cell_name) IN (
-        SELECT tissue_name, cell_name
-        FROM {source_table}
-        GROUP BY tissue_name, cell_name
-        HAVING SUM(CASE WHEN expr_mean > ? THEN 1 ELSE 0 END) > 0
-    )
+    AND {matched_cells.condition()}
+    AND (tissue_name, cell_name) IN ({expressed_groups_query(db, source_table)})
+    AND {window_condition}
     """
 
     # Construct params list
-    params = combined_gene_list + matched_rows_list + [threshold]
+    params = combined_gene_list + [threshold] + window_params
+    return filter_query, params
 
-    # Execute the query
-    db._cur.execute(filter_query, params)
-    filtered_data = db._cur.fetchall()
 
-    # Convert the result to a DataFrame
-    df_filtered = pd.DataFrame(filtered_data, columns=columns)
-    df_filtered['cell_label'] = df_filtered['cell_name'] + ' # ' + df_filtered['tissue_name']
+def df_data_groups(db, source_table, matched_cells, combined_gene_list, threshold=0.2, limit=None, offset=0):
+    """
+    返回 df_data 结果中的 (tissue_name, cell_name) 组，按细胞名排序，用于分页。
+
+    :param limit: 最多返回的组数，None 表示全部；offset 为跳过的组数
+    """
+    query, params = df_data_query(db, source_table, matched_cells, combined_gene_list, threshold)
+    return result_groups(db, query, params, limit, offset)
+
+
+def group_window_condition(groups):
+    """
+    把结果限制在给定 (tissue_name, cell_name) 组上的条件和参数。
+    """
+    if groups is None:
+        return "1", []
+    if not groups:
+        return "0", []
+    values = ', '.join(['(?, ?)'] * len(groups))
+    # 用 IS 比较，tissue_name 为 NULL 的组也能匹配
+    condition = f"""EXISTS (
+        SELECT 1 FROM (VALUES {values}) AS w
+        WHERE w.column1 IS tissue_name AND w.column2 IS cell_name
+    )"""
+    return condition, [value for group in groups for value in group]
+
+
+def result_groups(db, query, params, limit=None, offset=0):
+    """
+    只取出查询结果中不同的 (tissue_name, cell_name) 组，不读取表达数据；limit 不为 None 时只取一页。
+    """
+    page = ""
+    if limit is not None:
+        page = "LIMIT ? OFFSET ?"
+        params = list(params) + [limit, offset]
+    db._cur.execute(f"""
+        SELECT DISTINCT tissue_name, cell_name FROM ({query})
+        ORDER BY cell_name, tissue_name
+        {page}
+    """, params)
+    return [tuple(row) for row in db._cur.fetchall()]
+
+
+def scan_table(db):
+    """
+    返回 GROUP BY 扫描使用的表：紧凑存储时直接扫描整数键的 target_fact，细胞名先转换为 id。
+    """
+    return "target_fact" if db.is_compact() else "target_table"
+
 
-    return df_filtered
+def scan_source(db, cells):
+    """
+    返回 GROUP BY 扫描的 FROM 子句（包含 cell_name 过滤）。
+    目标细胞从临时表出发按索引查找（见 CellSet.join）；补集无法按索引查找，仍用 NOT IN 扫描覆盖索引。
+    """
+    table = scan_table(db)
+    if cells.negated:
+        return f"{table} WHERE {cells.condition(compact=db.is_compact())}"
+    return cells.join(table, compact=db.is_compact())
+
+
+def decode_symbols(db, query, count_column):
+    """
+    紧凑存储时把按整数 symbol 分组的结果翻译回基因名，输出列与原查询相同。
+    """
+    if not db.is_compact():
+        return query
+    return f"""
+    SELECT dict_symbol.value, g.expr_mean, g.expr_pct, g.active_expr_mean, g.tissue_cell_num, g.cell_pct,
+        g.{count_column}
+    FROM ({query}) AS g
+    LEFT JOIN dict_symbol ON dict_symbol.id = g.symbol
+    """
+
+
+def expressed_groups_query(db, source_table):
+    """
+    返回至少有一个基因 expr_mean 超过阈值的 (tissue_name, cell_name) 组合的子查询。
+    有 group_summary 时直接按 max_expr_mean 查索引；
+    否则紧凑存储时在 target_fact 上按整数键分组，再翻译回名称。
+    """
+    if source_table == "target_table" and has_group_summary(db):
+        return "SELECT tissue_name, cell_name FROM group_summary WHERE max_expr_mean > ?"
+    if source_table == "target_table" and db.is_compact():
+        return """
+        SELECT d_tissue_name.value, d_cell_name.value
+        FROM (
+            SELECT tissue_name, cell_name
+            FROM target_fact
+            GROUP BY tissue_name, cell_name
+            HAVING SUM(CASE WHEN expr_mean > ? THEN 1 ELSE 0 END) > 0
+        ) AS g
+        JOIN dict_tissue_name AS d_tissue_name ON d_tissue_name.id = g.tissue_name
+        JOIN dict_cell_name AS d_cell_name ON d_cell_name.id = g.cell_name
+        """
+    return f"""
+        SELECT tissue_name, cell_name
+        FROM {source_table}
+        GROUP BY tissue_name, cell_name
+        HAVING SUM(CASE WHEN expr_mean > ? THEN 1 ELSE 0 END) > 0
+        """
 
 
-def unique_group(db, rows_str, table):
+def unique_group(db, cells, table):
+    if table == "target_table":
+        source = scan_source(db, cells)
+    else:
+        source = f"{table} WHERE {cells.condition()}"
     count_unique_combinations_query = f"""
     SELECT COUNT(*) AS unique_combinations
     FROM (
         SELECT DISTINCT tissue_name, cell_name
-        FROM {table}
-        WHERE cell_name IN ({rows_str})
+        FROM {source}
     )
     """
     db._cur.execute(count_unique_combinations_query)
     unique_combinations = db._cur.fetchone()[0]
     return unique_combinations
 
-def filter_genes_by_threshold(db, matched_rows_str, threshold_value, min_count_value):
+def filter_genes_by_threshold(db, matched_cells, threshold_value, min_count_value):
+    source = scan_source(db, matched_cells)
 
     query = f"""
     SELECT
@@ -120,20 +226,19 @@ def filter_genes_by_threshold(db, matched_rows_str, threshold_value, min_count_v
         AVG(cell_pct) AS cell_pct,
         SUM(CASE WHEN expr_mean > ? THEN 1 ELSE 0 END) AS count_above_threshold
     FROM
-        target_table
-    WHERE
-        cell_name IN ({matched_rows_str})
+        {source}
     GROUP BY
         symbol
     HAVING
-        count_above_threshold >= ?;
+        count_above_threshold >= ?
     """
 
-    db._cur.execute(query, (threshold_value, min_count_value))
+    db._cur.execute(decode_symbols(db, query, "count_above_threshold"), (threshold_value, min_count_value))
     results = db._cur.fetchall()
     return results
 
-def filter_genes_by_threshold_other(db, unmatched_rows_str, threshold_value, rows, min_count_value):
+def filter_genes_by_threshold_other(db, unmatched_cells, threshold_value, rows, min_count_value):
+    source = scan_source(db, unmatched_cells)
 
     query = f"""
     SELECT
@@ -145,19 +250,66 @@ def filter_genes_by_threshold_other(db, unmatched_rows_str, threshold_value, row
         AVG(cell_pct) AS cell_pct,
         SUM(CASE WHEN expr_mean > ? THEN 1 ELSE 0 END) AS opp_count_below_threshold
     FROM
-        target_table
-    WHERE
-        cell_name IN ({unmatched_rows_str})
+        {source}
     GROUP BY
         symbol
     HAVING
-        ?-opp_count_below_threshold >= ?;
+        ?-opp_count_below_threshold >= ?
     """
-    db._cur.execute(query, (threshold_value, rows, min_count_value))
+    db._cur.execute(decode_symbols(db, query, "opp_count_below_threshold"), (threshold_value, rows, min_count_value))
     other_results = db._cur.fetchall()
     return other_results
 
 
+def filter_marker_genes(db, matched_cells, target_offset, target_p, other_offset, other_p):
+    """
+    一次扫描同时完成 filter_genes_by_threshold 和 filter_genes_by_threshold_other 的筛选：
+    按 symbol 顺序读取覆盖索引，每行按是否属于目标细胞用条件聚合分别计数，
+    组数由 totals 在 (tissue_name, cell_name) 的不同组上统计（单行结果），
+    直接返回两者的交集，列与 filter_genes_by_threshold 的结果相同（平均值取目标组）。
+    """
+    table = scan_table(db)
+    cell_condition = matched_cells.condition(compact=db.is_compact())
+
+    query = f"""
+    WITH totals AS (
+        SELECT SUM(is_target) AS target_count, SUM(1 - is_target) AS other_count
+        FROM (
+            SELECT CASE WHEN {cell_condition} THEN 1 ELSE 0 END AS is_target
+            FROM (SELECT DISTINCT tissue_name, cell_name FROM {table} WHERE cell_name IS NOT NULL)
+        )
+    )
+    SELECT
+        symbol,
+        AVG(CASE WHEN is_target = 1 THEN expr_mean END) AS expr_mean,
+        AVG(CASE WHEN is_target = 1 THEN expr_pct END) AS expr_pct,
+        AVG(CASE WHEN is_target = 1 THEN active_expr_mean END) AS active_expr_mean,
+        AVG(CASE WHEN is_target = 1 THEN tissue_cell_num END) AS tissue_cell_num,
+        AVG(CASE WHEN is_target = 1 THEN cell_pct END) AS cell_pct,
+        SUM(CASE WHEN is_target = 1 AND expr_mean > ? THEN 1 ELSE 0 END) AS count_above_threshold
+    FROM
+        (
+            SELECT symbol, expr_mean, expr_pct, active_expr_mean, tissue_cell_num, cell_pct,
+                CASE WHEN {cell_condition} THEN 1 ELSE 0 END AS is_target
+            FROM {table}
+            WHERE cell_name IS NOT NULL
+        ) AS flagged,
+        totals
+    GROUP BY
+        symbol
+    HAVING
+        MAX(is_target) = 1
+        AND count_above_threshold >= ? * MAX(target_count)
+        AND MIN(is_target) = 0
+        AND MAX(other_count) - SUM(CASE WHEN is_target = 0 AND expr_mean > ? THEN 1 ELSE 0 END)
+            >= ? * MAX(other_count)
+    """
+    params = (target_offset, target_p, other_offset, other_p)
+    db._cur.execute(decode_symbols(db, query, "count_above_threshold"), params)
+    results = db._cur.fetchall()
+    return results
+
+
 def insert_rows_with_combined_genes(db, source_table, target_table, combined_gene_list):
     create_table_sql = f"""
     CREATE TABLE IF NOT EXISTS {target_table} AS
@@ -186,18 +338,18 @@ if __name__ == '__main__':
     db.drop_table_if_exists("final")
     tissue_list = ["mast cell"]
     source_table = "target_table"
-    matched_rows_str, unmathed_rows_str = extract_matched_and_unmatched_rows_by_cell_name(db, source_table, tissue_list)
-    print(matched_rows_str)
-    target_count = unique_group(db, matched_rows_str, source_table)
-    other_count = unique_group(db, unmathed_rows_str, source_table)
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(db, source_table, tissue_list)
+    print(matched_cells.names)
+    target_count = unique_group(db, matched_cells, source_table)
+    other_count = unique_group(db, unmatched_cells, source_table)
     threshold_gt = 1
     threshold_lt = 0.1
     target_p = 0.7
     other_p = 0.98
     print(target_count)
     print(other_count)
-    filtered_genes = filter_genes_by_threshold(db, matched_rows_str, threshold_gt, target_p * target_count)
-    filtered_genes_other = filter_genes_by_threshold_other(db, unmathed_rows_str, threshold_lt, other_count,
+    filtered_genes = filter_genes_by_threshold(db, matched_cells, threshold_gt, target_p * target_count)
+    filtered_genes_other = filter_genes_by_threshold_other(db, unmatched_cells, threshold_lt, other_count,
                                                            other_p * other_count)
     gene_list1 = [gene[0] for gene in filtered_genes]
     gene_list2 = [gene[0] for gene in filtered_genes_other]
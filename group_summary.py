@@ -0,0 +1,63 @@
+import sys
+from sqlite_tool import SqliteTool
+
+# group_summary 中按 (tissue_name, cell_name) 汇总的统计列
+summary_columns = """
+    MAX(expr_mean) AS max_expr_mean,
+    MAX(expr_pct) AS max_expr_pct,
+    MAX(active_expr_mean) AS max_active_expr_mean,
+    COUNT(*) AS row_count,
+    COUNT(DISTINCT symbol) AS gene_count
+"""
+
+
+def has_group_summary(db):
+    db._cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='group_summary'")
+    return db._cur.fetchone() is not None
+
+
+def build_group_summary(db):
+    """
+    重建 group_summary：target_table 中每个 (tissue_name, cell_name) 组一行，保存 max_expr_mean 等统计。
+    df_data 中“该组至少有一个基因 expr_mean > t”等价于 max_expr_mean > t，无需再对整张表分组。
+    """
+    db._cur.execute("DROP TABLE IF EXISTS group_summary")
+    db._cur.execute(f"""
+        CREATE TABLE group_summary AS
+        SELECT tissue_name, cell_name, {summary_columns}
+        FROM target_table
+        GROUP BY tissue_name, cell_name
+    """)
+    db._cur.execute("CREATE INDEX idx_group_summary_expr ON group_summary (max_expr_mean, tissue_name, cell_name)")
+    db._cur.execute("CREATE INDEX idx_group_summary_group ON group_summary (tissue_name, cell_name)")
+    db._conn.commit()
+    print("Table 'group_summary' has been built.")
+
+
+def sync_group_summary(db, commit=True):
+    """
+    只重新汇总 temp.affected_group 中列出的组（由 SqliteTool.refresh_tissues 填写），
+    组在 target_table 中已不存在时删除对应的行。
+    """
+    db._cur.execute("""
+        DELETE FROM group_summary
+        WHERE EXISTS (
+            SELECT 1 FROM temp.affected_group AS a
+            WHERE a.tissue_name IS group_summary.tissue_name AND a.cell_name IS group_summary.cell_name
+        )
+    """)
+    db._cur.execute(f"""
+        INSERT INTO group_summary
+        SELECT t.tissue_name, t.cell_name, {summary_columns}
+        FROM (SELECT DISTINCT tissue_name, cell_name FROM temp.affected_group) AS a
+        JOIN target_table AS t ON t.tissue_name IS a.tissue_name AND t.cell_name IS a.cell_name
+        GROUP BY t.tissue_name, t.cell_name
+    """)
+    if commit:
+        db._conn.commit()
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    build_group_summary(db)
+    db.close_connection()
@@ -0,0 +1,149 @@
+import re
+import sys
+from sqlite_tool import SqliteTool
+from cell_set import CellSet
+from func import unique_group, filter_genes_by_threshold, filter_genes_by_threshold_other, df_data, \
+    extract_matched_rows_from_database, filter_marker_genes
+
+# 与 func.py 中热点查询对应的覆盖索引，查询所需的列全部在索引中，不再回表
+query_indexes = {
+    # filter_genes_by_threshold / _other、unique_group、extract_matched_rows_from_database：
+    # 按 cell_name 查找，读取 symbol 及各统计列
+    'idx_cell_symbol_cover': ['cell_name', 'symbol', 'organism', 'disease', 'tissue_name', 'expr_mean', 'expr_pct',
+                              'active_expr_mean', 'tissue_cell_num', 'cell_pct'],
+    # df_data：按 symbol 查找，再按 cell_name 过滤；
+    # 细胞名列表很长时 filter_genes_by_threshold_other 会按 symbol 顺序扫描整个索引
+    'idx_symbol_cell_cover': ['symbol', 'cell_name', 'tissue_name', 'expr_mean', 'expr_pct', 'active_expr_mean',
+                              'tissue_cell_num', 'cell_pct'],
+    # df_data 中按 (tissue_name, cell_name) 分组的子查询
+    'idx_group_expr': ['tissue_name', 'cell_name', 'expr_mean'],
+}
+
+# 被上面的覆盖索引取代的旧单列索引
+legacy_indexes = ['idx_cell_name', 'idx_symbol', 'idx_tissue_name']
+
+
+def create_query_indexes(db):
+    """
+    在 target_table（紧凑存储时为 target_fact）上创建覆盖索引，并删除被取代的单列索引。
+    """
+    table = "target_fact" if db.is_compact() else "target_table"
+    for index_name in legacy_indexes:
+        db._cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+    for index_name, columns in query_indexes.items():
+        db._cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(columns)})")
+    db._cur.execute(f"ANALYZE {table}")
+    db._conn.commit()
+    print(f"Covering indexes {', '.join(query_indexes)} have been created on '{table}'.")
+
+
+class PlanCursor():
+    """
+    替代 db._cur：把执行的查询改为 EXPLAIN QUERY PLAN 并记录计划，返回空结果。
+    """
+    def __init__(self, cur):
+        self._real = cur
+        self.plans = []
+
+    def execute(self, query, params=()):
+        self._real.execute("EXPLAIN QUERY PLAN " + query, params)
+        self.plans.append((query, [row[3] for row in self._real.fetchall()]))
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self, size=None):
+        return []
+
+    def fetchone(self):
+        return (0,)
+
+
+class PlanRecorder():
+    """
+    传给 func.py 中查询函数的 db 替身，其余方法转交给真实的 SqliteTool。
+    """
+    def __init__(self, db):
+        self._db = db
+        self._cur = PlanCursor(db._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def full_scans(plan, tables=("target_table", "target_fact")):
+    """
+    返回计划中读取大表、但没有按等值条件查找的步骤：SCAN（包括扫描整个覆盖索引），
+    以及只有范围条件的 SEARCH（例如 cell_name IS NOT NULL 变成的 cell_name>?，同样会读完整个索引）。
+    """
+    steps = []
+    for detail in plan:
+        words = detail.split()
+        if len(words) < 2 or words[1] not in tables:
+            continue
+        if words[0] == "SEARCH" and re.search(r"\w=\?", detail):
+            continue
+        steps.append(detail)
+    return steps
+
+
+def covering_scans_only(plan, tables=("target_table", "target_fact")):
+    """
+    返回 full_scans 中没有使用覆盖索引的步骤，即需要回表读取整张表的扫描。
+    """
+    return [detail for detail in full_scans(plan, tables) if "COVERING INDEX" not in detail]
+
+
+def check_query_plans(db):
+    """
+    用 EXPLAIN QUERY PLAN 检查 func.py 的热点查询，若有查询读取整个大表或整个索引则抛出异常。
+    补集查询和 filter_marker_genes 按定义要读取几乎所有行，列在 full_scan_queries 中，
+    只要求它们使用覆盖索引；其余查询的每一步都必须是按等值条件的 SEARCH。
+
+    :return: [(查询, 计划)] 列表
+    """
+    db._cur.execute("SELECT cell_name, symbol, organism, disease FROM target_table LIMIT 1")
+    sample = db._cur.fetchone()
+    if sample is None:
+        print("Table 'target_table' is empty, query plan check skipped.")
+        return []
+    cell_name, symbol, organism, disease = sample
+    matched_cells = CellSet(db, [cell_name])
+    unmatched_cells = matched_cells.complement()
+
+    # (名称, 调用, 是否允许扫描覆盖索引)
+    checks = [
+        ("unique_group", lambda r: unique_group(r, matched_cells, "target_table"), False),
+        # 补集是除目标细胞外的所有细胞，没有可以查找的键
+        ("unique_group (unmatched)", lambda r: unique_group(r, unmatched_cells, "target_table"), True),
+        ("filter_genes_by_threshold", lambda r: filter_genes_by_threshold(r, matched_cells, 1, 1), False),
+        ("filter_genes_by_threshold_other",
+         lambda r: filter_genes_by_threshold_other(r, unmatched_cells, 0.1, 1, 1), True),
+        # 同时统计目标细胞和其余所有细胞
+        ("filter_marker_genes", lambda r: filter_marker_genes(r, matched_cells, 1, 0.7, 0.1, 0.98), True),
+        ("df_data", lambda r: df_data(r, "target_table", matched_cells, [symbol], 0.2), False),
+        ("extract_matched_rows_from_database",
+         lambda r: extract_matched_rows_from_database(r, "target_table", matched_cells, [symbol], [organism],
+                                                      [disease]), False),
+    ]
+
+    recorder = PlanRecorder(db)
+    failures = []
+    for name, run, full_scan_allowed in checks:
+        start = len(recorder._cur.plans)
+        run(recorder)
+        for query, plan in recorder._cur.plans[start:]:
+            steps = covering_scans_only(plan) if full_scan_allowed else full_scans(plan)
+            if steps:
+                failures.append(f"{name}: " + ' '.join(query.split())[:200] + ' ...\n    ' + '\n    '.join(plan))
+    if failures:
+        raise RuntimeError("Query plan check failed, unbounded scans found:\n" + '\n'.join(failures))
+    print(f"Query plan check passed for {len(recorder._cur.plans)} queries.")
+    return recorder._cur.plans
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    create_query_indexes(db)
+    check_query_plans(db)
+    db.close_connection()
@@ -1,62 +1,157 @@
 import gradio as gr
 from func import extract_matched_and_unmatched_rows_by_cell_name, unique_group, filter_groups_above_threshold, \
-    filter_genes_by_threshold_other, insert_rows_with_combined_genes, filter_genes_by_threshold, extract_matched_rows_from_database, df_data
-from sqlite_tool import SqliteTool
+    filter_genes_by_threshold_other, insert_rows_with_combined_genes, filter_genes_by_threshold, extract_matched_rows_from_database, df_data, \
+    filter_marker_genes, extract_matched_groups, df_data_groups
+from cell_set import CellSet
+from sqlite_tool import get_pool
 from cellxgene import plot_dotplot, fetch_data_from_database
 from cellxgene_filter import plot_dot, fetch_data
 from plot import plotting
 import os
+import math
 import glob
 import csv
 import pandas as pd
 import tempfile
 import shutil
-from upload import upload_csv_to_db
+from upload import check_csv_columns
+from write_queue import get_write_queue
+from marker_engine import load_marker_engine, refresh_marker_engine
+from expr_index import load_expression_index, refresh_expression_index
+from column_store import load_column_store, refresh_column_store
+from result_cache import ResultCache, normalize_list, normalize_number
+from vocabulary import load_vocabulary
+from autocomplete import suggest
 
 global tmpdir
-db_path = "/usr/src/app/example.db"
-db = SqliteTool(db_path)
+# 所有处理函数共用的连接池：读取使用线程内的只读连接，写入使用唯一的写连接
+pool = get_pool()
+# 插入、删除和上传都交给后台写线程，合并提交
+write_queue = get_write_queue()
+db = pool.reader()
 disease_full = ['normal']
 sex = ['female', 'male', 'unknown']
 self_reported_ethnicity = ['British']
 organism_full = ['Homo sapiens']
-cell_names = db.get_unique_column_values("target_table", "cell_name")
-cell_names = set([c for cell in cell_names for c in cell.split(",")])
-gene_list = db.get_unique_column_values("target_table", "symbol")
+# Gene Filter 的计算方式：numpy 使用内存中的表达矩阵，index 使用按基因排序的表达索引，
+# columns 使用数据库旁的 memmap 列式存储，combined 使用一次扫描的合并查询，sql 使用原来分开的 GROUP BY 查询
+marker_engine = os.environ.get("MARKER_ENGINE", "numpy")
+# 内存引擎、表达索引和列式存储都在后台重建：启动时先建一次，之后每次写入提交后重建
+engine_refreshers = {'numpy': refresh_marker_engine, 'index': refresh_expression_index,
+                     'columns': refresh_column_store}
+if marker_engine in engine_refreshers:
+    write_queue.add_commit_listener(engine_refreshers[marker_engine])
+    engine_refreshers[marker_engine](pool.db_path)
+if pool.backend == "duckdb":
+    # duckdb 是可选依赖，只在使用时导入；写入提交后在后台重新导出 Parquet，导出完成前查询上一次的导出
+    from duckdb_tool import refresh_parquet
+    write_queue.add_commit_listener(refresh_parquet)
+# 两个绘图页面的结果缓存，按数据版本失效
+# 命中率等统计每隔 RESULT_CACHE_STATS_SECONDS 秒输出一次，0 表示不输出
+result_cache = ResultCache(int(os.environ.get("RESULT_CACHE_MB", "256")) * 1024 * 1024,
+                           int(os.environ.get("RESULT_CACHE_STATS_SECONDS", "300")))
+# 分页绘图时每页的细胞组数
+page_size = int(os.environ.get("PAGE_SIZE", "50"))
+# 下拉框的候选值来自 vocabulary 表，随上传和增删同步更新；
+# 细胞和基因只发送前缀搜索的前若干个结果，输入时再由服务端补全
+vocabulary = load_vocabulary(db)
+cell_names = suggest(db, 'cell', '')
+gene_list = suggest(db, 'gene', '')
 db.close_connection()
+organism_choices = vocabulary['organism'] or organism_full
+disease_choices = vocabulary['disease'] or disease_full
+
+
+def refresh_choices():
+    """
+    页面加载时重新读取 vocabulary，让下拉框包含最新上传的数据。
+    """
+    db = pool.reader()
+    vocabulary = load_vocabulary(db)
+    cells = suggest(db, 'cell', '')
+    genes = suggest(db, 'gene', '')
+    db.close_connection()
+    return (gr.update(choices=cells), gr.update(choices=genes),
+            gr.update(choices=cells), gr.update(choices=genes),
+            gr.update(choices=vocabulary['organism'] or organism_full),
+            gr.update(choices=vocabulary['disease'] or disease_full))
+
+
+def suggest_cells(selected, evt: gr.KeyUpData):
+    db = pool.reader()
+    choices = suggest(db, 'cell', evt.input_value, selected)
+    db.close_connection()
+    return gr.update(choices=choices)
+
+
+def suggest_genes(selected, evt: gr.KeyUpData):
+    db = pool.reader()
+    choices = suggest(db, 'gene', evt.input_value, selected)
+    db.close_connection()
+    return gr.update(choices=choices)
 
 
 def filter_plot(tissue_list, add_gene, organism, disease):
     print("You are choosing interface 2!")
     print(add_gene)
-    db = SqliteTool('example.db')
+    db = pool.reader()
     source_table = "target_table"
-    db.drop_table_if_exists("new")
-    matched_rows_str, unmathed_rows_str = extract_matched_and_unmatched_rows_by_cell_name(db, source_table, tissue_list)
-    if not organism:
-        organism = organism_full
-    if not disease:
-        disease = disease_full
-    df = extract_matched_rows_from_database(db, "target_table", matched_rows_str, add_gene, organism, disease)
-    # df = fetch_data(db)
-    fig = plotting(df)
+    if not organism or not disease:
+        # 没有选择时使用全部取值，与下拉框一样来自 vocabulary，数据版本变化后重新读取
+        choices = load_vocabulary(db)
+        organism = organism or choices['organism'] or organism_full
+        disease = disease or choices['disease'] or disease_full
+    key = ("filter_plot", normalize_list(tissue_list), normalize_list(add_gene), normalize_list(organism),
+           normalize_list(disease))
+    version = db.get_data_version()
+    state = result_cache.get(key, version)
+    if state is None:
+        matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(db, source_table,
+                                                                                         tissue_list)
+        # 细胞组和表达数据都在 show_page 中按页读取
+        state = {'view': 'filter', 'key': key, 'version': version, 'cells': sorted(matched_cells.names),
+                 'genes': add_gene, 'organism': organism, 'disease': disease, 'page': 0}
+        result_cache.put(key, version, state)
     db.close_connection()
-    return fig
+    return show_page(state, 0)
 
 def filter_plotting(tissue_list, target_offset, target_p, other_offset, other_p, add_gene):
     print("You are choosing interface 1!")
-    db = SqliteTool('example.db')
+    db = pool.reader()
     source_table = "target_table"
     #db.drop_table_if_exists("final")
     print(tissue_list)
-    matched_rows_str, unmathed_rows_str = extract_matched_and_unmatched_rows_by_cell_name(db, source_table, tissue_list)
-    target_count = unique_group(db, matched_rows_str, source_table)
-    other_count = unique_group(db, unmathed_rows_str, source_table)
-    filtered_genes = filter_genes_by_threshold(db, matched_rows_str, target_offset, target_p * target_count)
-    filtered_genes_other = filter_genes_by_threshold_other(db, unmathed_rows_str, other_offset, other_count,
-                                                           other_p * other_count)
-    gene_list1 = [gene[0] for gene in filtered_genes]
-    gene_list2 = [gene[0] for gene in filtered_genes_other]
+    key = ("filter_plotting", normalize_list(tissue_list), normalize_number(target_offset), normalize_number(target_p),
+           normalize_number(other_offset), normalize_number(other_p), normalize_list(add_gene), marker_engine)
+    version = db.get_data_version()
+    state = result_cache.get(key, version)
+    if state is not None:
+        db.close_connection()
+        return show_page(state, 0)
+
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(db, source_table, tissue_list)
+    # 内存引擎、表达索引和列式存储在后台重建期间为 None，这时使用下面的 SQL 查询
+    engine = None
+    if marker_engine == "numpy":
+        engine = load_marker_engine(db)
+    elif marker_engine == "index":
+        engine = load_expression_index(db)
+    elif marker_engine == "columns":
+        engine = load_column_store(db)
+    if engine is not None:
+        gene_list1, gene_list2 = engine.marker_genes(matched_cells, target_offset, target_p, other_offset, other_p)
+    elif marker_engine == "combined":
+        gene_list1 = [gene[0] for gene in filter_marker_genes(db, matched_cells, target_offset, target_p,
+                                                              other_offset, other_p)]
+        gene_list2 = gene_list1
+    else:
+        target_count = unique_group(db, matched_cells, source_table)
+        other_count = unique_group(db, unmatched_cells, source_table)
+        filtered_genes = filter_genes_by_threshold(db, matched_cells, target_offset, target_p * target_count)
+        filtered_genes_other = filter_genes_by_threshold_other(db, unmatched_cells, other_offset, other_count,
+                                                               other_p * other_count)
+        gene_list1 = [gene[0] for gene in filtered_genes]
+        gene_list2 = [gene[0] for gene in filtered_genes_other]
     intersection_gene_set = set(gene_list1).intersection(gene_list2)
     selected_gene = [gene for gene in intersection_gene_set if gene != 'blank']
     if add_gene:
@@ -65,16 +160,82 @@ def filter_plotting(tissue_list, target_offset, target_p, other_offset, other_p,
     #insert_rows_with_combined_genes(db, "target_table", "final", selected_gene)
     #filter_groups_above_threshold(db)
     #df = fetch_data_from_database(db)
-    df = df_data(db, source_table, matched_rows_str, selected_gene, 0.2)
-    fig = plotting(df)
+    state = {'view': 'gene_filter', 'key': key, 'version': version, 'cells': sorted(matched_cells.names),
+             'genes': selected_gene, 'page': 0}
+    result_cache.put(key, version, state)
     db.close_connection()
-    return fig
+    return show_page(state, 0)
+
+
+def page_groups(db, state, cells, page):
+    """
+    返回第 page 页的 (tissue_name, cell_name) 组；多取一组，用来判断是否还有下一页。
+    """
+    offset = page * page_size
+    if state['view'] == 'filter':
+        return extract_matched_groups(db, "target_table", cells, state['genes'], state['organism'], state['disease'],
+                                      limit=page_size + 1, offset=offset)
+    return df_data_groups(db, "target_table", cells, state['genes'], 0.2, limit=page_size + 1, offset=offset)
+
+
+def show_page(state, page):
+    """
+    绘制分页结果中的一页：只取出这一页的 page_size 个 (tissue_name, cell_name) 组，再读取这些组的行。
+    总组数不预先统计，翻到最后一页时才知道；数据版本与 state 中记录的不同时回到第一页重新读取。
+
+    :param state: filter_plot / filter_plotting 生成的分页状态，保存在 gr.State 中
+    :return: (图表, 新的分页状态, 页码说明)
+    """
+    if not state:
+        return gr.update(), state, ""
+    db = pool.reader()
+    version = db.get_data_version()
+    if state.get('version') != version:
+        # 上传或增删之后旧的分页不再对应，从第一页开始
+        state = dict(state, version=version, total=None)
+        page = 0
+    page = max(page, 0)
+    if state.get('total') is not None:
+        page = min(page, max(1, math.ceil(state['total'] / page_size)) - 1)
+
+    page_key = ("page", state['key'], page)
+    result = result_cache.get(page_key, version)
+    if result is None:
+        cells = CellSet(db, state['cells'])
+        groups = page_groups(db, state, cells, page)
+        window = groups[:page_size]
+        if state['view'] == 'filter':
+            df = extract_matched_rows_from_database(db, "target_table", cells, state['genes'], state['organism'],
+                                                    state['disease'], groups=window)
+        else:
+            df = df_data(db, "target_table", cells, state['genes'], 0.2, groups=window)
+        result = (plotting(df), len(window), len(groups) > page_size)
+        result_cache.put(page_key, version, result)
+    db.close_connection()
+
+    fig, count, has_next = result
+    total = state.get('total')
+    if not has_next:
+        total = page * page_size + count
+    state = dict(state, page=page, has_next=has_next, total=total)
+    if total is None:
+        return fig, state, f"第 {page + 1} 页，后面还有更多细胞组"
+    pages = max(1, math.ceil(total / page_size))
+    return fig, state, f"第 {page + 1} / {pages} 页，共 {total} 个细胞组"
+
+
+def previous_page(state):
+    return show_page(state, state['page'] - 1 if state else 0)
+
+
+def next_page(state):
+    if state and not state.get('has_next'):
+        return show_page(state, state['page'])
+    return show_page(state, state['page'] + 1 if state else 0)
 
 
 def insert_data(tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells, expression_sum,
                 number_cells, symbol, cell_name, tissue_name, expression_sum_QC, expr_pct, active_expr_mean, expr_mean):
-    db_path = "/usr/src/app/example.db"
-    db = SqliteTool(db_path)
     data = {
         'tissue_id': tissue_id,
         'cell_type_id': cell_type_id,
@@ -93,59 +254,43 @@ def insert_data(tissue_id, cell_type_id, gene_id, number_nonzero_expression_cell
 
     # 检查所有必需字段是否有效
     if not all(data.values()):
-        db.close_connection()
         return "Missing required fields"
 
-    db.insert_data('target_table', data)
-    db.close_connection()
-    return f"Data inserted: {data}"
+    # 写入原始表，再只刷新该 tissue 的 tissue_cell_num / cell_pct 和 target_table；
+    # 任一步失败时写线程回滚到该任务的 SAVEPOINT，数据库保持不变
+    try:
+        return write_queue.insert('csv_data', data, tissue_id).result()
+    except Exception as e:
+        return f"插入失败，数据库未做任何修改：{e}"
 
 def delete_data(tissue_id, cell_type_id, gene_id):
-    db_path = "/usr/src/app/example.db"
-    db = SqliteTool(db_path)
-    result = db.delete_data(tissue_id, cell_type_id, gene_id)
-    db.close_connection()
-    return result
+    return write_queue.delete(tissue_id, cell_type_id, gene_id).result()
 
 def check_data(tissue_id, cell_type_id, gene_id):
-    db_path = "/usr/src/app/example.db"
-    db = SqliteTool(db_path)
+    db = pool.reader()
     result = db.print_row_by_ids(tissue_id, cell_type_id, gene_id)
     db.close_connection()
     return result
 
 
 def generate_file(file_obj):
-    required_columns = [
-        'tissue_id', 'cell_type_id', 'gene_id', 'number_nonzero_expression_cells',
-        'expression_sum', 'number_cells', 'symbol', 'cell_name', 'tissue_name',
-        'expression_sum_QC', 'expr_pct', 'active_expr_mean', 'expr_mean', "organism", "disease"
-    ]
-
-    with tempfile.TemporaryDirectory(dir='.') as tmpdir:
-        print('临时文件夹地址：{}'.format(tmpdir))
-        print('上传文件的地址：{}'.format(file_obj.name))
-
-        # Get the file name and construct the new file path
-        file_name = os.path.basename(file_obj.name)
-        uploaded_file_path = os.path.join(tmpdir, file_name)
+    print('上传文件的地址：{}'.format(file_obj.name))
 
-        shutil.copy(file_obj.name, uploaded_file_path)
+    # 只读取标题行检查必要的列，数据由写线程一次流式读取
+    try:
+        missing_columns = check_csv_columns(file_obj.name)
+    except Exception as e:
+        return f"文件读取失败：{e}"
 
-        print('复制到临时文件夹的路径：{}'.format(uploaded_file_path))
-        try:
-            df = pd.read_csv(uploaded_file_path)
-        except Exception as e:
-            return f"文件读取失败：{e}"
+    if missing_columns:
+        return f"文件中缺少以下必要的列：{', '.join(missing_columns)}"
 
-        # Check if required columns are present
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            return f"文件中缺少以下必要的列：{', '.join(missing_columns)}"
+    try:
+        write_queue.upload(file_obj.name).result()
+    except Exception as e:
+        return f"文件导入失败，数据库未做任何修改：{e}"
 
-        upload_csv_to_db(uploaded_file_path)
-
-        return "文件已上传并处理完成"
+    return "文件已上传并处理完成"
 
 with gr.Blocks() as demo:
     with gr.TabItem("Gene Filter"):
@@ -158,9 +303,16 @@ with gr.Blocks() as demo:
             add_gene1 = gr.Dropdown(gene_list, multiselect=True, label="Add Gene")
         plot_btn1 = gr.Button("Plot")
         plot_output1 = gr.Plot()
+        page_state1 = gr.State()
+        with gr.Row():
+            prev_btn1 = gr.Button("Previous")
+            page_info1 = gr.Markdown()
+            next_btn1 = gr.Button("Next")
         plot_btn1.click(filter_plotting,
                         inputs=[tissue_list1, target_offset, target_p, other_offset, other_p, add_gene1],
-                        outputs=plot_output1)
+                        outputs=[plot_output1, page_state1, page_info1])
+        prev_btn1.click(previous_page, inputs=page_state1, outputs=[plot_output1, page_state1, page_info1])
+        next_btn1.click(next_page, inputs=page_state1, outputs=[plot_output1, page_state1, page_info1])
 
 
     with gr.TabItem("Filter"):
@@ -168,11 +320,19 @@ with gr.Blocks() as demo:
             tissue_list2 = gr.Dropdown(cell_names, multiselect=True, label="Select Tissue")
             add_gene2 = gr.Dropdown(gene_list, multiselect=True, label="Add Gene")
             # sex = gr.Dropdown(sex, multiselect=True, label="sex")
-            organism = gr.Dropdown(organism_full, multiselect=True, label="organism")
-            disease = gr.Dropdown(disease_full, multiselect=True, label="disease")
+            organism = gr.Dropdown(organism_choices, multiselect=True, label="organism")
+            disease = gr.Dropdown(disease_choices, multiselect=True, label="disease")
         plot_btn2 = gr.Button("Plot")
         plot_output2 = gr.Plot()
-        plot_btn2.click(filter_plot, inputs=[tissue_list2, add_gene2, organism, disease], outputs=plot_output2)
+        page_state2 = gr.State()
+        with gr.Row():
+            prev_btn2 = gr.Button("Previous")
+            page_info2 = gr.Markdown()
+            next_btn2 = gr.Button("Next")
+        plot_btn2.click(filter_plot, inputs=[tissue_list2, add_gene2, organism, disease],
+                        outputs=[plot_output2, page_state2, page_info2])
+        prev_btn2.click(previous_page, inputs=page_state2, outputs=[plot_output2, page_state2, page_info2])
+        next_btn2.click(next_page, inputs=page_state2, outputs=[plot_output2, page_state2, page_info2])
 
     with gr.TabItem("Database"):
         info_text = """
@@ -211,6 +371,12 @@ with gr.Blocks() as demo:
         check_output = gr.Textbox()
         check_btn.click(check_data, inputs=[tissue_id, cell_type_id, gene_id], outputs=check_output)
 
+    for dropdown in [tissue_list1, tissue_list2]:
+        dropdown.key_up(suggest_cells, inputs=dropdown, outputs=dropdown, show_progress="hidden")
+    for dropdown in [add_gene1, add_gene2]:
+        dropdown.key_up(suggest_genes, inputs=dropdown, outputs=dropdown, show_progress="hidden")
+    demo.load(refresh_choices, outputs=[tissue_list1, add_gene1, tissue_list2, add_gene2, organism, disease])
+
 #demo.launch(server_name="127.0.0.1")
 demo.launch(server_name="0.0.0.0")
 
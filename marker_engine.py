@@ -0,0 +1,224 @@
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from sqlite_tool import SqliteTool, get_pool
+
+# dbName -> (数据版本, MarkerEngine)，进程内缓存
+_engine_cache = {}
+# 正在后台重建引擎的 dbName
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+
+# 计数时每次处理的组数，限制布尔中间结果的大小
+block_groups = 1024
+
+
+def duplicate_cells(group_codes, gene_codes, gene_count):
+    """
+    返回布尔数组：该行所在的 (组, 基因) 是否有不止一行（例如 symbol 为 blank 的重复行）。
+    """
+    cells = np.asarray(group_codes, dtype=np.int64) * gene_count + np.asarray(gene_codes, dtype=np.int64)
+    _, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    return counts[inverse] > 1
+
+
+def float32_bounds(threshold_value):
+    """
+    返回不大于和不小于 threshold_value 的最近的 float32 值。
+    """
+    upper = np.float32(threshold_value)
+    if float(upper) < threshold_value:
+        upper = np.nextafter(upper, np.float32(np.inf))
+    lower = upper if float(upper) == threshold_value else np.nextafter(upper, np.float32(-np.inf))
+    return lower, upper
+
+
+class MarkerEngine():
+    """
+    Gene Filter 的内存计算引擎：把 target_table 的 expr_mean 一次性读成 (组, 基因) 的 float32 稠密矩阵，
+    组为 (tissue_name, cell_name)，基因为 symbol。
+    每次点击只需在矩阵上做布尔运算，结果与 filter_genes_by_threshold / _other 的 SQL 完全一致：
+
+    - NaN 表示该组没有这一行，-inf 表示 expr_mean 为 NULL（存在该行，但永远不大于阈值）；
+    - 同一组同一基因有多行时，这些行不放入矩阵，而是以 (组, 基因, float64 值) 的稀疏形式另外保存，逐行计数与 SQL 相同；
+    - float32 的舍入是单调的，只有取值恰好舍入到阈值两侧最近的 float32 时才无法直接判断。
+      矩阵中每个 float32 值只对应一个 float64 原值（buckets），用原值与阈值比较；
+      多个原值舍入到同一 float32 的行同样放入稀疏部分。
+    """
+    def __init__(self, tissue_names, cell_names, symbols, expr_mean):
+        group_codes, groups = pd.factorize(pd.Series(list(zip(tissue_names, cell_names)), dtype=object),
+                                           use_na_sentinel=False)
+        gene_codes, genes = pd.factorize(pd.Series(symbols, dtype=object), use_na_sentinel=False)
+
+        self.groups = groups
+        self.group_cell_names = np.array([cell_name for _, cell_name in groups], dtype=object)
+        # factorize 会把 NULL 的 symbol 变成 NaN，还原为 None 与 SQL 的结果一致
+        self.genes = np.array([None if pd.isna(gene) else gene for gene in genes], dtype=object)
+        values = np.asarray(expr_mean, dtype=float)
+        values[np.isnan(values)] = -np.inf
+
+        # 多个 float64 原值舍入到同一个 float32 的行
+        finite = np.isfinite(values)
+        originals = np.unique(values[finite])
+        rounded = originals.astype(np.float32)
+        shared = np.zeros(len(rounded), dtype=bool)
+        shared[1:] = rounded[1:] == rounded[:-1]
+        shared[:-1] |= shared[1:]
+        self.bucket_keys = rounded[~shared]
+        self.bucket_values = originals[~shared]
+        ambiguous = np.zeros(len(values), dtype=bool)
+        ambiguous[finite] = np.isin(values[finite].astype(np.float32), rounded[shared])
+
+        sparse = duplicate_cells(group_codes, gene_codes, len(genes)) | ambiguous
+        self.matrix = np.full((len(groups), len(genes)), np.nan, dtype=np.float32)
+        self.matrix[group_codes[~sparse], gene_codes[~sparse]] = values[~sparse]
+        self.sparse_groups = group_codes[sparse].astype(np.int64)
+        self.sparse_genes = gene_codes[sparse].astype(np.int64)
+        self.sparse_values = values[sparse]
+
+    def group_mask(self, cell_names):
+        return np.isin(self.group_cell_names, list(cell_names))
+
+    def count_above(self, mask, threshold_value):
+        """
+        返回每个基因在 mask 选中的组中 expr_mean > threshold_value 的行数，以及该基因是否出现过。
+        """
+        lower, upper = float32_bounds(threshold_value)
+        # 舍入到 lower / upper 的值用对应的原值判断
+        edges = [key for key in {lower, upper}
+                 if key in self.bucket_keys
+                 and self.bucket_values[np.searchsorted(self.bucket_keys, key)] > threshold_value]
+
+        above = np.zeros(len(self.genes), dtype=np.int64)
+        present = np.zeros(len(self.genes), dtype=bool)
+        group_ids = np.flatnonzero(mask)
+        for start in range(0, len(group_ids), block_groups):
+            block = self.matrix[group_ids[start:start + block_groups]]
+            hits = block > upper
+            for key in edges:
+                hits |= block == key
+            above += hits.sum(axis=0)
+            present |= ~np.isnan(block).all(axis=0)
+
+        selected = mask[self.sparse_groups]
+        genes = self.sparse_genes[selected]
+        above += np.bincount(genes[self.sparse_values[selected] > threshold_value], minlength=len(self.genes))
+        present[genes] = True
+        return above, present
+
+    def marker_genes(self, matched_cells, target_offset, target_p, other_offset, other_p):
+        """
+        与 main.filter_plotting 中 SQL 流程相同的筛选：
+        目标组中高于 target_offset 的行数 >= target_p * 目标组数，
+        其余组中不高于 other_offset 的行数 >= other_p * 其余组数。
+
+        :param matched_cells: CellSet 或细胞名集合
+        :return: (gene_list1, gene_list2)，分别对应 filter_genes_by_threshold 和 filter_genes_by_threshold_other
+        """
+        names = getattr(matched_cells, 'names', matched_cells)
+        target_mask = self.group_mask(names)
+        other_mask = ~target_mask
+        target_count = int(target_mask.sum())
+        other_count = int(other_mask.sum())
+
+        above, present = self.count_above(target_mask, target_offset)
+        gene_list1 = self.genes[present & (above >= target_p * target_count)].tolist()
+
+        above_other, present_other = self.count_above(other_mask, other_offset)
+        gene_list2 = self.genes[present_other & (other_count - above_other >= other_p * other_count)].tolist()
+        return gene_list1, gene_list2
+
+
+def build_marker_engine(db):
+    db._cur.execute("""
+        SELECT tissue_name, cell_name, symbol, expr_mean
+        FROM target_table
+        WHERE cell_name IS NOT NULL
+    """)
+    rows = db._cur.fetchall()
+    if rows:
+        tissue_names, cell_names, symbols, expr_mean = zip(*rows)
+    else:
+        tissue_names, cell_names, symbols, expr_mean = (), (), (), ()
+    engine = MarkerEngine(tissue_names, cell_names, symbols, expr_mean)
+    print(f"Marker engine loaded {len(engine.groups)} groups x {len(engine.genes)} genes "
+          f"({len(engine.sparse_values)} rows stored sparse).")
+    return engine
+
+
+def current_marker_engine(db):
+    """
+    返回与数据库数据版本一致的 MarkerEngine，没有时返回 None。
+    """
+    cached = _engine_cache.get(db.dbName)
+    if cached is not None and cached[0] == db.get_data_version():
+        return cached[1]
+    return None
+
+
+def load_marker_engine(db):
+    """
+    返回按数据版本缓存的 MarkerEngine；数据版本不一致时在后台重新加载并返回 None，
+    调用方在新引擎就绪前继续使用 SQL 查询，请求中不会读取整个 target_table。
+    """
+    engine = current_marker_engine(db)
+    if engine is None:
+        refresh_marker_engine(db.dbName)
+    return engine
+
+
+def refresh_marker_engine(db_path):
+    """
+    在后台线程中用连接池的只读连接按最新的数据版本重新加载引擎，不阻塞调用方；
+    写队列在每次提交之后调用（见 WriteQueue.add_commit_listener）。同一时间只有一个线程在加载，
+    那次加载结束时会检查数据版本，期间的提交不会漏掉。
+    """
+    with _refresh_lock:
+        if db_path in _refreshing:
+            return
+        _refreshing.add(db_path)
+    threading.Thread(target=_refresh, args=(db_path,), name="marker-engine", daemon=True).start()
+
+
+def _refresh(db_path):
+    pool = get_pool(db_path)
+    try:
+        while True:
+            db = pool.reader()
+            try:
+                with _refresh_lock:
+                    if current_marker_engine(db) is not None:
+                        _refreshing.discard(db_path)
+                        return
+                version = db.get_data_version()
+                engine = build_marker_engine(db)
+            finally:
+                db.close_connection()
+            # 新引擎就绪后才替换旧的
+            _engine_cache[db_path] = (version, engine)
+    except Exception as e:
+        with _refresh_lock:
+            _refreshing.discard(db_path)
+        print(f"Marker engine rebuild failed: {e}")
+
+
+if __name__ == '__main__':
+    # 用法：python marker_engine.py example.db "mast cell" ...，比较 NumPy 引擎与 SQL 的筛选结果
+    from func import extract_matched_and_unmatched_rows_by_cell_name, unique_group, filter_genes_by_threshold, \
+        filter_genes_by_threshold_other
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    tissue_list = sys.argv[2:] or ["mast cell"]
+    target_offset, target_p, other_offset, other_p = 1, 0.7, 0.1, 0.98
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(db, "target_table", tissue_list)
+    target_count = unique_group(db, matched_cells, "target_table")
+    other_count = unique_group(db, unmatched_cells, "target_table")
+    sql_genes1 = [gene[0] for gene in filter_genes_by_threshold(db, matched_cells, target_offset,
+                                                                 target_p * target_count)]
+    sql_genes2 = [gene[0] for gene in filter_genes_by_threshold_other(db, unmatched_cells, other_offset, other_count,
+                                                                       other_p * other_count)]
+    genes1, genes2 = build_marker_engine(db).marker_genes(matched_cells, target_offset, target_p, other_offset,
+                                                         other_p)
+    print(set(genes1) == set(sql_genes1) and set(genes2) == set(sql_genes2))
+    db.close_connection()
@@ -1,12 +1,26 @@
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 
+# 点数超过该值时改用 WebGL 绘制（Scattergl），坐标以整数编码传给浏览器
+webgl_threshold = 20000
+# WebGL 画布的最大边长（像素），多数浏览器的上限为 16384
+max_canvas_size = 16000
+
 
 def plotting(df):
     df['size'] = df['expr_pct'] * 200  # Adjust size for Plotly
-    num_cells = len(df['cell_label'].unique())
-    num_genes = len(df['symbol'].unique())
+    # 标签只计算一次
+    cell_labels = df['cell_label'].unique()
+    symbols = df['symbol'].unique()
+    num_cells = len(cell_labels)
+    num_genes = len(symbols)
+
+    if len(df) > webgl_threshold:
+        fig = plotting_webgl(df, cell_labels, symbols)
+        add_size_legend(fig)
+        return fig
 
     fig = px.scatter(
         df,
@@ -33,19 +47,86 @@ def plotting(df):
         height=250 + 50 * num_cells,
         yaxis=dict(
             tickmode='array',
-            tickvals=list(range(len(df['cell_label'].unique()))),
-            ticktext=df['cell_label'].unique()
+            tickvals=list(range(num_cells)),
+            ticktext=cell_labels
         ),
         xaxis=dict(
             tickmode='array',
-            tickvals=list(range(len(df['symbol'].unique()))),
-            ticktext=df['symbol'].unique(),
+            tickvals=list(range(num_genes)),
+            ticktext=symbols,
             tickangle=90
         )
     )
 
     fig.update_traces(marker=dict(line=dict(width=0.5, color='White')))
 
+    add_size_legend(fig)
+    #print(fig)
+    return fig
+
+
+def plotting_webgl(df, cell_labels, symbols, size_max=20):
+    """
+    大矩阵的绘制方式：一个 Scattergl trace，x / y 为基因和细胞标签的整数编码，
+    数值保留三位小数，减小图表 JSON 的体积。悬停提示与 px.scatter 相同，显示每个点的细胞标签和基因：
+    标签按整数编码从 cell_labels / symbols 中取出，放在 customdata 中。
+    点的大小与 px.scatter 相同（按面积缩放，最大直径 size_max）。
+    """
+    x = pd.Categorical(df['symbol'], categories=symbols).codes
+    y = pd.Categorical(df['cell_label'], categories=cell_labels).codes
+    size = df['size'].to_numpy(dtype=np.float64)
+    max_size = np.nanmax(size) if len(size) else 0
+    sizeref = 2.0 * max_size / size_max ** 2 if max_size > 0 else 1
+    customdata = np.empty((len(df), 3), dtype=object)
+    # 编码 -1（标签为空）取到末尾追加的 None
+    customdata[:, 0] = np.append(np.asarray(cell_labels, dtype=object), None)[y]
+    customdata[:, 1] = np.append(np.asarray(symbols, dtype=object), None)[x]
+    customdata[:, 2] = np.round(df['expr_pct'].to_numpy(dtype=np.float64), 3)
+
+    fig = go.Figure(go.Scattergl(
+        x=x,
+        y=y,
+        mode='markers',
+        marker=dict(
+            size=np.round(size, 1),
+            sizemode='area',
+            sizeref=sizeref,
+            color=np.round(df['active_expr_mean'].to_numpy(dtype=np.float64), 3),
+            colorscale='viridis',
+            cmin=0,
+            cmax=4,
+            colorbar=dict(title='active_expr_mean'),
+            line=dict(width=0.5, color='White')
+        ),
+        customdata=customdata,
+        hovertemplate=('cell_label=%{customdata[0]}<br>symbol=%{customdata[1]}<br>expr_pct=%{customdata[2]}'
+                       '<br>active_expr_mean=%{marker.color}<extra></extra>'),
+        showlegend=False
+    ))
+    fig.update_layout(
+        title='scRNA_seq',
+        width=min(1000 + 100 * len(symbols), max_canvas_size),
+        height=min(250 + 50 * len(cell_labels), max_canvas_size),
+        yaxis=dict(
+            title='cell_label',
+            tickmode='array',
+            tickvals=list(range(len(cell_labels))),
+            ticktext=cell_labels,
+            showspikes=True
+        ),
+        xaxis=dict(
+            title='symbol',
+            tickmode='array',
+            tickvals=list(range(len(symbols))),
+            ticktext=symbols,
+            tickangle=90,
+            showspikes=True
+        )
+    )
+    return fig
+
+
+def add_size_legend(fig):
     # Add legend for circle sizes
     sizes = [0.2, 0.5, 0.8, 1.0]  # Example sizes
     for size in sizes:
@@ -69,6 +150,4 @@ def plotting(df):
             traceorder="normal",
             font=dict(size=10)
         )
-    )
-    #print(fig)
-    return fig
\ No newline at end of file
+    )
\ No newline at end of file
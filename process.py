@@ -1,8 +1,47 @@
 from sqlite_tool import SqliteTool
+from compact import drop_compact_tables
+from indexes import create_query_indexes
+from cell_index import build_cell_name_index
+from expr_index import build_expression_index
+from column_store import build_column_store
+from group_summary import build_group_summary
+from vocabulary import build_vocabulary
 
 #db = SqliteTool("example.db")
 
-def process_raw(db):
+def process_raw(db, engine='window'):
+    """
+    预处理 csv_data：去重、计算每个 tissue 的细胞总数和 cell_pct，
+    并把 number_cells > 50 的记录写入 target_table。
+
+    :param engine: 'window' 为单次扫描的窗口函数实现；'legacy' 为原来的分步实现
+    """
+    # 已经转为紧凑存储时 target_table 是视图，两种实现都要先删除紧凑存储再重新生成 target_table
+    if db.is_compact():
+        drop_compact_tables(db)
+    if engine == 'window':
+        process_raw_window(db)
+    else:
+        process_raw_legacy(db)
+    build_derived(db)
+
+
+def build_derived(db):
+    """
+    在 target_table 写好之后建立查询用的索引和派生结构，process_raw 和 snapshot.py 的导入共用。
+    """
+    # 与 func.py 查询匹配的覆盖索引，在数据写入之后创建
+    create_query_indexes(db)
+    db.ensure_tissue_indexes()
+    build_cell_name_index(db)
+    build_group_summary(db)
+    build_vocabulary(db)
+    db.bump_data_version()
+    build_expression_index(db)
+    build_column_store(db)
+
+
+def process_raw_legacy(db):
     table = 'csv_data'
     target_table = "target_table"
     new_column = 'tissue_cell_num'
@@ -14,11 +53,63 @@ def process_raw(db):
     db.update_column("unique_csv_data")
     db.update_table_pro("csv_data", "unique_csv_data")
     db.filter_and_insert("csv_data", "target_table", "number_cells", 50)
-    db._cur.execute("CREATE INDEX idx_cell_name ON target_table (cell_name)")
-    db._cur.execute("CREATE INDEX idx_symbol ON target_table (symbol)")
-    db._cur.execute("CREATE INDEX idx_tissue_name ON target_table (tissue_name)")
 
 
+def process_raw_window(db):
+    """
+    与 process_raw_legacy 结果相同（三张表逐行一致），但不再用相关子查询逐行求和：
+    先用分组聚合取每个 (tissue_id, cell_type_id) 的第一行，再用窗口函数求每个 tissue 的细胞总数，
+    然后与 csv_data 连接一次回写 tissue_cell_num / cell_pct（refresh_tissues 和快照导出都读取这两列），
+    最后从 csv_data 筛选写入 target_table。
+    """
+    db.add_column('csv_data', 'tissue_cell_num', "REAL")
+    db.add_column('csv_data', 'cell_pct', "REAL")
+    columns = db.get_table_column_names('csv_data')
+    base_columns = [col for col in columns if col not in ('tissue_cell_num', 'cell_pct')]
+
+    db._cur.execute("DROP TABLE IF EXISTS unique_csv_data")
+    db._cur.execute("DROP TABLE IF EXISTS target_table")
+    # 建立与 csv_data 结构相同的空表，列的类型亲和性与原来的 CREATE TABLE AS 一致
+    db._cur.execute("CREATE TABLE unique_csv_data AS SELECT * FROM csv_data WHERE 0")
+    db._cur.execute("CREATE TABLE target_table AS SELECT * FROM csv_data WHERE 0")
+
+    # 每个 (tissue_id, cell_type_id) 取 rowid 最小的一行；
+    # tissue_id 为 NULL 时与原来的相关子查询一样得到 NULL；按 csv_data 的 rowid 顺序写入，与 remove_duplicates 一致
+    db._cur.execute(f"""
+        INSERT INTO unique_csv_data ({', '.join(columns)})
+        SELECT {', '.join(base_columns)}, tissue_cell_num,
+               CASE WHEN tissue_cell_num != 0 THEN number_cells * 1.0 / tissue_cell_num END
+        FROM (
+            SELECT rowid AS source_rowid, {', '.join(base_columns)},
+                   CASE WHEN tissue_id IS NOT NULL
+                        THEN SUM(number_cells) OVER (PARTITION BY tissue_id) END AS tissue_cell_num
+            FROM csv_data
+            WHERE rowid IN (
+                SELECT MIN(rowid)
+                FROM csv_data
+                GROUP BY tissue_id, cell_type_id
+            )
+        )
+        ORDER BY source_rowid
+    """)
+    db._cur.execute("CREATE INDEX IF NOT EXISTS idx_unique_tissue_id ON unique_csv_data (tissue_id, cell_type_id)")
+
+    # 与 update_table_pro 一致
+    db._cur.execute("""
+        UPDATE csv_data AS c
+        SET tissue_cell_num = u.tissue_cell_num,
+            cell_pct = u.cell_pct
+        FROM unique_csv_data AS u
+        WHERE c.tissue_id = u.tissue_id AND c.cell_type_id = u.cell_type_id
+    """)
+    # 与 filter_and_insert 一致
+    db._cur.execute(f"""
+        INSERT INTO target_table ({', '.join(columns)})
+        SELECT {', '.join(columns)} FROM csv_data WHERE number_cells > 50
+    """)
+    db._conn.commit()
+    print("Table 'target_table' has been created with window-function preprocessing.")
+
 
 if __name__ == '__main__':
    db = SqliteTool("example.db")
@@ -0,0 +1,129 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+def normalize_list(values):
+    """
+    多选框的值与顺序无关，None 和空列表等价。
+    """
+    return tuple(sorted(set(values))) if values else ()
+
+
+def normalize_number(value):
+    return None if value is None else float(value)
+
+
+# 较长的列表和 object 数组只按前若干个元素的平均大小估算
+sample_items = 100
+
+
+def estimate_size(value):
+    """
+    估算缓存对象占用的内存（字节）。
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype == object and value.size:
+            sample = value.ravel()[:sample_items]
+            return value.nbytes + value.size * sum(sys.getsizeof(item) for item in sample) // len(sample)
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (list, tuple, set)):
+        if len(value) > sample_items:
+            sample = list(value)[:sample_items] if isinstance(value, set) else value[:sample_items]
+            return sys.getsizeof(value) + len(value) * sum(estimate_size(item) for item in sample) // len(sample)
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value.values())
+    if hasattr(value, 'data') and hasattr(value, 'layout'):
+        # plotly 图表：按各条 trace 中数组的大小估算，不再把整个图表序列化为 JSON；
+        # _props 是 trace 属性的原始字典，to_plotly_json 会深拷贝所有数组
+        return sum(estimate_size(getattr(trace, '_props', None) or trace.to_plotly_json()) for trace in value.data)
+    return sys.getsizeof(value)
+
+
+class ResultCache():
+    """
+    按内存上限淘汰的 LRU 缓存，缓存 Gene Filter / Filter 页面的分页状态和每一页的图表。
+    每个条目属于某个数据版本（SqliteTool.get_data_version，写入后加一），
+    读取时版本变化则清空全部条目，上传或增删数据之后不会再返回旧结果。
+    数据版本只增不减（回滚也会加一），比当前版本旧的 get / put 来自写入之前开始的请求，直接忽略。
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, stats_interval=None):
+        """
+        :param stats_interval: 每隔多少秒在 get 时输出一次 stats()，None 或 0 表示不输出
+        """
+        self.max_bytes = max_bytes
+        self.stats_interval = stats_interval
+        self._stats_logged = time.monotonic()
+        self.version = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, version):
+        """
+        切换到更新的版本时清空缓存；version 比当前版本旧时返回 False。
+        """
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            self._entries.clear()
+            self._bytes = 0
+            self.version = version
+        return True
+
+    def get(self, key, version):
+        """
+        返回缓存的结果，未命中时返回 None。
+        """
+        with self._lock:
+            entry = self._entries.get(key) if self._check_version(version) else None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        self._log_stats()
+        return None if entry is None else entry[0]
+
+    def _log_stats(self):
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._stats_logged < self.stats_interval:
+                return
+            self._stats_logged = now
+        print(f"Result cache: {self.stats()}")
+
+    def put(self, key, version, value):
+        size = estimate_size(value)
+        with self._lock:
+            if not self._check_version(version) or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'version': self.version,
+            }
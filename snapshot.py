@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import pandas as pd
+from sqlite_tool import SqliteTool, DB_PATH
+from process import build_derived
+from compact import compact_target_table
+from indexes import check_query_plans
+from database import set_pragmas, bulk_pragmas, default_pragmas
+
+# 快照包含的表：target_table 和 unique_csv_data 是 process_raw 的结果，
+# csv_data 是之后上传和增删时 refresh_tissues 重新计算的来源，一并导出副本才能继续写入
+snapshot_tables = ['csv_data', 'unique_csv_data', 'target_table']
+# 按该列分区写入（organism=.../part-*.parquet），分区列同时保留在文件中
+partition_column = 'organism'
+snapshot_batch_size = 500000
+
+# DuckDB 类型与 SQLite 声明类型的对应
+sqlite_types = {'BIGINT': 'INTEGER', 'DOUBLE': 'REAL', 'VARCHAR': 'TEXT'}
+
+
+def export_snapshot(db, snapshot_dir, tables=snapshot_tables, partition_by=partition_column,
+                    batch_size=snapshot_batch_size):
+    """
+    把 tables 写成按 partition_by 分区、ZSTD 压缩的 Parquet 快照，每张表一个目录，另有 manifest.json
+    记录建表语句、列类型和行数。SQLite 的 rowid 以 _rowid 列保存，导入后行的顺序和编号与原库一致。
+
+    :param snapshot_dir: 快照目录，已存在时覆盖
+    :param partition_by: 分区列，None 表示不分区；表中没有该列时也不分区
+    """
+    # duckdb 是可选依赖，只在导出和导入快照时导入
+    import duckdb
+    start = time.perf_counter()
+    tmp_dir = snapshot_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    con = duckdb.connect()
+    con.execute("SET enable_progress_bar = false")
+    manifest = {'version': db.get_data_version(), 'partition_by': partition_by, 'tables': {}}
+    for table in tables:
+        manifest['tables'][table] = export_table_snapshot(db, con, table, os.path.join(tmp_dir, table),
+                                                          partition_by, batch_size)
+    con.close()
+    with open(os.path.join(tmp_dir, "manifest.json"), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+
+    # 写完后再替换，中断的导出不会留下不完整的快照
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.rename(tmp_dir, snapshot_dir)
+    rows = sum(info['rows'] for info in manifest['tables'].values())
+    print(f"Snapshot of {rows} rows written to '{snapshot_dir}' in {time.perf_counter() - start:.1f}s.")
+    return manifest
+
+
+def export_table_snapshot(db, con, table, path, partition_by, batch_size):
+    from duckdb_tool import sqlite_type
+    db._cur.execute("SELECT type, sql FROM sqlite_master WHERE name = ?", (table,))
+    table_type, create_sql = db._cur.fetchone()
+    db._cur.execute(f"PRAGMA table_info({table})")
+    declared = [(row[1], row[2]) for row in db._cur.fetchall()]
+    names = [name for name, _ in declared]
+    types = [sqlite_type(db, table, name, dtype) for name, dtype in declared]
+    if table_type != 'table':
+        # 视图（紧凑存储的 target_table）按解码后的列导出为普通表
+        create_sql = (f"CREATE TABLE {table} "
+                      f"({', '.join(f'{name} {sqlite_types[dtype]}' for name, dtype in zip(names, types))})")
+
+    columns = names
+    casts = [f"CAST({name} AS {dtype}) AS {name}" for name, dtype in zip(names, types)]
+    if table_type == 'table':
+        columns = ['rowid'] + names
+        casts = ["CAST(rowid AS BIGINT) AS _rowid"] + casts
+    partitioned = partition_by in names
+
+    os.makedirs(path)
+    rows = 0
+    part = 0
+    db._cur.execute(f"SELECT {', '.join(columns)} FROM {table}")
+    while True:
+        batch_rows = db._cur.fetchmany(batch_size)
+        if not batch_rows:
+            break
+        batch = pd.DataFrame(batch_rows, columns=columns, dtype=object)
+        con.register("batch", batch)
+        if partitioned:
+            # 每批在各分区目录下写一个新文件
+            target = path
+            options = (f"PARTITION_BY ({partition_by}), WRITE_PARTITION_COLUMNS true, OVERWRITE_OR_IGNORE true, "
+                       f"FILENAME_PATTERN 'part-{part:05d}-{{i}}', ")
+        else:
+            target = os.path.join(path, f"part-{part:05d}.parquet")
+            options = ""
+        con.execute(f"COPY (SELECT {', '.join(casts)} FROM batch) TO '{target}' "
+                    f"({options}FORMAT PARQUET, COMPRESSION ZSTD)")
+        con.unregister("batch")
+        rows += len(batch_rows)
+        part += 1
+    print(f"Table '{table}': {rows} rows exported.")
+    return {'sql': create_sql, 'columns': names, 'types': types, 'rowid': table_type == 'table', 'rows': rows}
+
+
+def import_snapshot(snapshot_dir, db_file, compact=False, batch_size=snapshot_batch_size):
+    """
+    从快照建立新的数据库：批量写入各表，再建立索引和派生结构（与 process_raw 之后的步骤相同），
+    不需要重新解析 CSV 和重跑 process_raw。数据库和派生文件先在 <db_file>.import/ 中生成，完成后再移到 db_file 旁。
+    """
+    import duckdb
+    start = time.perf_counter()
+    with open(os.path.join(snapshot_dir, "manifest.json"), encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    # 派生文件以数据库文件名为前缀（<db>.columns、<db>.expr_index.npz），在同名文件上生成再整体移动
+    staging_dir = db_file + ".import"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    db = SqliteTool(os.path.join(staging_dir, os.path.basename(db_file)))
+    set_pragmas(db, bulk_pragmas)
+    con = duckdb.connect()
+    con.execute("SET enable_progress_bar = false")
+    for table, info in manifest['tables'].items():
+        import_table_snapshot(db, con, table, os.path.join(snapshot_dir, table), info, batch_size)
+    con.close()
+
+    build_derived(db)
+    if compact:
+        compact_target_table(db)
+    check_query_plans(db)
+    set_pragmas(db, default_pragmas)
+    db.close_connection()
+    publish_staging(staging_dir, db_file)
+    print(f"Database '{db_file}' restored from '{snapshot_dir}' in {time.perf_counter() - start:.1f}s.")
+
+
+def publish_staging(staging_dir, db_file):
+    """
+    把 staging_dir 中的数据库和派生文件移到 db_file 旁，数据库最后替换。
+    旧数据库的派生文件和 WAL 文件一并删除：新库的数据版本从 1 开始，旧文件的版本号可能相同。
+    """
+    from duckdb_tool import parquet_dir
+    base = os.path.basename(db_file)
+    for path in (db_file + "-wal", db_file + "-shm", parquet_dir(db_file)):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    for name in sorted(os.listdir(staging_dir), key=lambda name: name == base):
+        target = os.path.join(os.path.dirname(db_file), name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(os.path.join(staging_dir, name), target)
+    os.rmdir(staging_dir)
+
+
+def import_table_snapshot(db, con, table, path, info, batch_size):
+    db._cur.execute(info['sql'])
+    if info['rows'] == 0:
+        return
+    names = info['columns']
+    columns = (['_rowid'] if info['rowid'] else []) + names
+    insert_columns = (['rowid'] if info['rowid'] else []) + names
+    con.execute(f"SELECT {', '.join(columns)} FROM read_parquet('{path}/**/*.parquet', hive_partitioning = false)")
+    insert = (f"INSERT INTO {table} ({', '.join(insert_columns)}) "
+              f"VALUES ({', '.join(['?'] * len(insert_columns))})")
+    rows = 0
+    while True:
+        batch_rows = con.fetchmany(batch_size)
+        if not batch_rows:
+            break
+        db._cur.executemany(insert, batch_rows)
+        rows += len(batch_rows)
+    db._conn.commit()
+    if rows != info['rows']:
+        raise ValueError(f"Snapshot table '{table}' has {rows} rows, manifest says {info['rows']}.")
+    print(f"Table '{table}': {rows} rows imported.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or import a Parquet snapshot of the processed tables.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="write a snapshot of an existing database")
+    export_parser.add_argument('--db', default=DB_PATH, help="SQLite database to export")
+    export_parser.add_argument('--snapshot', required=True, help="snapshot directory to write")
+    export_parser.add_argument('--partition-by', default=partition_column,
+                               help="column used to partition the Parquet files ('' for none)")
+    import_parser = subparsers.add_parser('import', help="build a database from a snapshot")
+    import_parser.add_argument('--snapshot', required=True, help="snapshot directory to read")
+    import_parser.add_argument('--db', default=DB_PATH, help="SQLite database file to build")
+    import_parser.add_argument('--compact', action='store_true',
+                               help="store target_table dictionary-encoded (see compact.py)")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        db = SqliteTool(args.db)
+        export_snapshot(db, args.snapshot, partition_by=args.partition_by or None)
+        db.close_connection()
+    else:
+        import_snapshot(args.snapshot, args.db, args.compact)
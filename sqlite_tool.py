@@ -1,13 +1,44 @@
 import sys
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
 import pandas as pd
 
+# 应用使用的数据库文件，main.py / upload.py 等统一使用这个路径
+DB_PATH = os.environ.get("DB_PATH", "/usr/src/app/example.db")
+# 只读查询使用的引擎：sqlite，或 duckdb（在 target_table 等表导出的 Parquet 文件上查询，见 duckdb_tool.py）
+DB_BACKEND = os.environ.get("DB_BACKEND", "sqlite")
+
+# 连接池中每个连接的设置：内存映射读取 256 MB，页缓存 64 MB（负数单位为 KiB），临时表放在内存中
+connection_pragmas = {
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+# 每个连接缓存的预编译语句数（sqlite3 默认 128）
+cached_statements = 512
+
 class SqliteTool():
-    def __init__(self, dbName="sqlite3Test.db"):
+    def __init__(self, dbName="sqlite3Test.db", connection=None, state=None):
         self.dbName = dbName
-        self._conn = sqlite3.connect(dbName)
+        # 传入 connection 时使用连接池中的连接，close_connection 不会真正关闭它
+        self._pooled = connection is not None
+        self._conn = connection if connection is not None else sqlite3.connect(dbName)
         self._cur = self._conn.cursor()
+        # 按连接缓存的信息（如 is_compact 的结果），连接池为每个连接保存一份，在该连接的各个 SqliteTool 间共享
+        self._state = state if state is not None else {}
+        # 为 True 时 commit() / rollback() 不生效，由 write_queue.py 把多个写入合并成一次提交
+        self.defer_commit = False
+
+    def commit(self):
+        if not self.defer_commit:
+            self._conn.commit()
+
+    def rollback(self):
+        if not self.defer_commit:
+            self._conn.rollback()
     
 
     def print_row_by_ids(self, tissue_id, cell_type_id, gene_id):
@@ -288,6 +319,11 @@ class SqliteTool():
 
     def close_connection(self):
         self._cur.close()  # 先关闭游标
+        if self._pooled:
+            # 连接归还连接池，只回滚未提交的事务，与关闭连接的效果一致
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            return
         self._conn.close()  # 再关闭连接
 
     def update_matched_index(self, cell_name, index):
@@ -326,20 +362,305 @@ class SqliteTool():
         self._conn.commit()
         print(f"Index '{index_name}' has been created on column '{column_name}' of table '{table_name}'.")
 
-    def insert_data(self, table_name, data):
+    def insert_data(self, table_name, data, commit=True):
         # Assuming data is a dictionary with column names as keys
         columns = ', '.join(data.keys())
         placeholders = ', '.join(['?' for _ in data.values()])
         query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-        self._cur.execute(query, list(data.values()))
-        self._conn.commit()
+        try:
+            self._cur.execute(query, list(data.values()))
+            if commit:
+                self.commit()
+        except sqlite3.Error:
+            if commit:
+                self.rollback()
+            raise
 
     def delete_data(self, tissue_id, cell_type_id, gene_id):
-        self._cur.execute( 'DELETE FROM csv_data WHERE tissue_id = ? AND cell_type_id = ? AND gene_id = ?',
-                (tissue_id, cell_type_id, gene_id))
-        self._conn.commit()
+        try:
+            self._cur.execute( 'DELETE FROM csv_data WHERE tissue_id = ? AND cell_type_id = ? AND gene_id = ?',
+                    (tissue_id, cell_type_id, gene_id))
+            self.refresh_tissues([tissue_id], commit=False)
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
         return f"Rows with Tissue ID {tissue_id}, Cell Type ID {cell_type_id}, and Gene ID {gene_id} have been deleted."
 
+    def is_compact(self):
+        """
+        target_table 是否为字典编码存储（见 compact.py），此时它是 target_fact 上的视图。
+        结果按连接缓存；compact.py 转换或删除紧凑存储时通过 set_compact 更新。
+        """
+        if 'compact' not in self._state:
+            self._cur.execute("SELECT type FROM sqlite_master WHERE name = 'target_table'")
+            result = self._cur.fetchone()
+            self._state['compact'] = result is not None and result[0] == 'view'
+        return self._state['compact']
+
+    def set_compact(self, compact):
+        self._state['compact'] = compact
+
+    def ensure_tissue_indexes(self):
+        """
+        创建增量维护所需的 tissue_id 索引（已存在时跳过）。
+        """
+        target = "target_fact" if self.is_compact() else "target_table"
+        self._cur.execute("CREATE INDEX IF NOT EXISTS idx_csv_data_tissue_id ON csv_data (tissue_id, cell_type_id)")
+        self._cur.execute("CREATE INDEX IF NOT EXISTS idx_unique_tissue_id ON unique_csv_data (tissue_id, cell_type_id)")
+        self._cur.execute(f"CREATE INDEX IF NOT EXISTS idx_tissue_id ON {target} (tissue_id)")
+
+    def refresh_tissues(self, tissue_ids, commit=True):
+        """
+        只针对受写入影响的 tissue_id 重新计算 process_raw 的结果：
+        unique_csv_data 中的去重行、tissue_cell_num / cell_pct，
+        target_table 中 number_cells > 50 的筛选结果，以及 group_summary 中受影响的组。
+
+        :param tissue_ids: 受影响的 tissue_id 列表
+        :param commit: 是否在完成后提交事务
+        """
+        self.ensure_tissue_indexes()
+        self._cur.execute("CREATE TEMP TABLE IF NOT EXISTS affected_tissue (tissue_id TEXT PRIMARY KEY)")
+        self._cur.execute("DELETE FROM temp.affected_tissue")
+        self._cur.executemany("INSERT OR IGNORE INTO temp.affected_tissue VALUES (?)",
+                              [(tissue_id,) for tissue_id in tissue_ids])
+        affected = "SELECT tissue_id FROM temp.affected_tissue"
+
+        # 每个 (tissue_id, cell_type_id) 取 rowid 最小的一行，与 remove_duplicates 一致
+        unique_columns = ', '.join(self.get_table_column_names("unique_csv_data"))
+        self._cur.execute(f"DELETE FROM unique_csv_data WHERE tissue_id IN ({affected})")
+        self._cur.execute(f"""
+            INSERT INTO unique_csv_data ({unique_columns})
+            SELECT {unique_columns} FROM csv_data WHERE rowid IN (
+                SELECT MIN(rowid)
+                FROM csv_data
+                WHERE tissue_id IN ({affected})
+                GROUP BY tissue_id, cell_type_id
+            )
+        """)
+
+        # 与 update_sum_column / update_column 一致
+        self._cur.execute(f"""
+            UPDATE unique_csv_data AS u
+            SET tissue_cell_num = s.tissue_cell_num
+            FROM (
+                SELECT tissue_id, SUM(number_cells) AS tissue_cell_num
+                FROM unique_csv_data
+                WHERE tissue_id IN ({affected})
+                GROUP BY tissue_id
+            ) AS s
+            WHERE u.tissue_id = s.tissue_id
+        """)
+        self._cur.execute(f"""
+            UPDATE unique_csv_data
+            SET cell_pct = CASE WHEN tissue_cell_num != 0 THEN number_cells * 1.0 / tissue_cell_num END
+            WHERE tissue_id IN ({affected})
+        """)
+
+        # 与 update_table_pro 一致
+        self._cur.execute(f"""
+            UPDATE csv_data AS t1
+            SET tissue_cell_num = t2.tissue_cell_num,
+                cell_pct = t2.cell_pct
+            FROM unique_csv_data AS t2
+            WHERE t1.tissue_id IN ({affected})
+                AND t1.tissue_id = t2.tissue_id
+                AND t1.cell_type_id = t2.cell_type_id
+        """)
+
+        # 与 filter_and_insert 一致；先记下受影响的 (tissue_name, cell_name) 组，供 group_summary 增量更新
+        target_columns = ', '.join(self.get_table_column_names("target_table"))
+        self._cur.execute("CREATE TEMP TABLE IF NOT EXISTS affected_group (tissue_name TEXT, cell_name TEXT)")
+        self._cur.execute("DELETE FROM temp.affected_group")
+        self._cur.execute(f"""
+            INSERT INTO temp.affected_group
+            SELECT DISTINCT tissue_name, cell_name FROM target_table WHERE tissue_id IN ({affected})
+        """)
+        from vocabulary import has_vocabulary, uncount_vocabulary, sync_vocabulary
+        if has_vocabulary(self):
+            uncount_vocabulary(self)
+        # 只替换由 csv_data 生成的行（id 来自 csv_data.id）；早期版本直接写入 target_table 的行 id 为空，
+        # 在 csv_data 中没有来源，保留不动
+        if self.is_compact():
+            # 紧凑存储时直接按整数键删除，不经过视图上的逐行触发器
+            self._cur.execute(f"""
+                DELETE FROM target_fact WHERE tissue_id IN (
+                    SELECT id FROM dict_tissue_id WHERE value IN ({affected})
+                ) AND id IS NOT NULL
+            """)
+        else:
+            self._cur.execute(f"DELETE FROM target_table WHERE tissue_id IN ({affected}) AND id IS NOT NULL")
+        self._cur.execute(f"""
+            INSERT INTO target_table ({target_columns})
+            SELECT {target_columns} FROM csv_data
+            WHERE tissue_id IN ({affected}) AND number_cells > 50
+        """)
+        self._cur.execute(f"""
+            INSERT INTO temp.affected_group
+            SELECT DISTINCT tissue_name, cell_name FROM csv_data
+            WHERE tissue_id IN ({affected}) AND number_cells > 50
+        """)
+
+        self._cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='cell_names'")
+        if self._cur.fetchone() is not None:
+            from cell_index import sync_cell_name_index
+            sync_cell_name_index(self, commit=False)
+        from group_summary import has_group_summary, sync_group_summary
+        if has_group_summary(self):
+            sync_group_summary(self, commit=False)
+        if has_vocabulary(self):
+            sync_vocabulary(self, commit=False)
+        self.bump_data_version(commit=False)
+
+        if commit:
+            self.commit()
+        print(f"Derived columns refreshed for {len(set(tissue_ids))} tissue(s).")
+
+    def get_data_version(self):
+        """
+        返回数据版本号，每次写入 target_table 后加一，用于让内存中的缓存失效。
+        """
+        try:
+            self._cur.execute("SELECT value FROM db_meta WHERE key = 'data_version'")
+        except sqlite3.OperationalError:
+            return 0
+        result = self._cur.fetchone()
+        return int(result[0]) if result else 0
+
+    def bump_data_version(self, commit=True):
+        self._cur.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value)")
+        self._cur.execute("""
+            INSERT INTO db_meta (key, value) VALUES ('data_version', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """)
+        if commit:
+            self.commit()
+
+
+
+class ConnectionPool():
+    """
+    Gradio 并发处理请求时共享的连接池，数据库使用 WAL 模式：
+    每个线程一个只读连接，读取互不阻塞，写入进行中也可以继续读取；
+    所有写入共用一个写连接，由锁串行化，不会出现 database is locked。
+    db_path 可以是指向当前版本文件的符号链接（见 db_versions.py）：每次取连接时检查它指向的文件，
+    发布新版本后各线程在下一次请求时改为连接新文件，正在执行的查询继续读取旧版本。
+    """
+    def __init__(self, db_path=DB_PATH, backend=DB_BACKEND):
+        self.db_path = db_path
+        self.backend = backend
+        self._duckdb = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        # 先打开写连接，切换到 WAL 后只读连接才能正常打开
+        self._writer_path = os.path.realpath(db_path)
+        self._writer = self._connect(self._writer_path, read_only=False)
+        self._writer_state = {}
+
+    def _connect(self, path, read_only):
+        if read_only:
+            # check_same_thread=False 只是为了 close_all 能在其他线程关闭它，平时只在所属线程中使用
+            conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True,
+                                   check_same_thread=False, cached_statements=cached_statements)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False, cached_statements=cached_statements)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        for name, value in connection_pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def reader(self):
+        """
+        返回当前线程的只读 SqliteTool；backend 为 duckdb 时返回接口相同的 DuckDbTool。
+        dbName 始终为 db_path，按 dbName 和数据版本缓存的结果在版本切换后由数据版本区分。
+        """
+        db = self.sqlite_reader()
+        if self.backend == "duckdb":
+            return self.duckdb_source().reader(db)
+        return db
+
+    def sqlite_reader(self):
+        """
+        返回当前线程的只读 SqliteTool，与 backend 无关（DuckDB 的导出从这里读取）。
+        """
+        path = os.path.realpath(self.db_path)
+        conn_path, conn = getattr(self._local, 'conn', (None, None))
+        if conn_path != path:
+            if conn is not None:
+                # 当前版本已经切换，关闭旧版本的连接
+                with self._readers_lock:
+                    self._readers.remove(conn)
+                conn.close()
+            conn = self._connect(path, read_only=True)
+            self._local.conn = (path, conn)
+            self._local.state = {}
+            with self._readers_lock:
+                self._readers.append(conn)
+        return SqliteTool(self.db_path, connection=conn, state=self._local.state)
+
+    def duckdb_source(self):
+        if self._duckdb is None:
+            # duckdb 是可选依赖，只在使用时导入
+            from duckdb_tool import DuckDbSource
+            self._duckdb = DuckDbSource(self.db_path)
+        return self._duckdb
+
+    @contextmanager
+    def writer(self):
+        """
+        独占写连接：with pool.writer() as db: ...，未提交的修改在退出时回滚。
+        """
+        with self._write_lock:
+            path = os.path.realpath(self.db_path)
+            if path != self._writer_path:
+                self._writer.close()
+                self._writer_path = path
+                self._writer = self._connect(path, read_only=False)
+                self._writer_state = {}
+            db = SqliteTool(self.db_path, connection=self._writer, state=self._writer_state)
+            try:
+                yield db
+            finally:
+                db.close_connection()
+
+    @contextmanager
+    def new_version(self):
+        """
+        在当前版本的副本上写入：with pool.new_version() as db: ...，正常退出时检查并发布为新版本，
+        出现异常时丢弃副本。持有写锁，期间其他写入排队等待；读取继续使用当前版本，不受影响。
+        """
+        # 版本管理只在使用时导入，避免与 indexes.py / func.py 循环导入
+        from db_versions import build_version
+        with self._write_lock:
+            with build_version(self.db_path) as db:
+                yield db
+
+    def close_all(self):
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        with self._write_lock:
+            self._writer.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path=DB_PATH):
+    """
+    返回 db_path 对应的进程内连接池（首次调用时创建）。
+    """
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = ConnectionPool(db_path)
+            _pools[db_path] = pool
+        return pool
 
 
 if __name__ == '__main__':
@@ -2,12 +2,22 @@
 
 # 定义数据库文件路径
 DB_FILE="/usr/src/app/example.db"
+# 有快照时从快照建库（snapshot.py export 生成），不需要重新解析 CSV
+SNAPSHOT_DIR="${SNAPSHOT_DIR:-/usr/src/app/snapshot}"
 
+# 数据库文件是指向 example.db.versions/ 中当前版本的符号链接，建库和恢复都生成新版本再发布（见 db_versions.py）
 if [ ! -f "$DB_FILE" ]; then
-    echo "Initializing database..."
-    python /usr/src/app/database.py
+    if [ -f "$SNAPSHOT_DIR/manifest.json" ]; then
+        echo "Restoring database from snapshot..."
+        python /usr/src/app/db_versions.py --db "$DB_FILE" restore --snapshot "$SNAPSHOT_DIR"
+    else
+        echo "Initializing database..."
+        python /usr/src/app/db_versions.py --db "$DB_FILE" build
+    fi
 else
     echo "Database already initialized."
+    # 旧部署中的普通文件移入版本目录
+    python /usr/src/app/db_versions.py --db "$DB_FILE" adopt
 fi
 
 # 运行 main.py
@@ -0,0 +1,71 @@
+import os
+import sys
+import random
+import sqlite3
+import pytest
+
+# 模块都在仓库根目录下，没有打包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_tool import SqliteTool, _pools
+from database import create_table_sql, insert_sql
+from process import process_raw
+
+cell_types = ["mast cell", "T cell", "B cell", "mast cell progenitor", "fibroblast", "it's cell"]
+tissues = ["lung", "liver", "blood", "skin"]
+genes = [f"GENE{i}" for i in range(1, 25)] + ["blank"]
+
+
+def atlas_rows(seed=0):
+    """
+    生成一个小的 atlas：每个 tissue 中随机若干细胞类型，每个细胞类型所有基因各一行；
+    fibroblast 的细胞数不超过 50，不会进入 target_table；少数 expr_mean 为 NULL。
+    """
+    rng = random.Random(seed)
+    rows = []
+    for t, tissue in enumerate(tissues):
+        for c, cell in enumerate(cell_types):
+            if (t + c) % 4 == 3:
+                continue
+            number_cells = 10 if cell == "fibroblast" else rng.choice([60, 200, 1000])
+            for g, symbol in enumerate(genes):
+                expr_mean = None if rng.random() < 0.03 else round(rng.random() * 2, 2)
+                rows.append((f"UBERON:{t:04d}", f"CL:{c:04d}", f"ENSG{g:05d}", rng.randint(0, 50),
+                             round(rng.random() * 20, 3), number_cells, symbol, cell, tissue,
+                             round(rng.random() * 2, 4), round(rng.random(), 4), round(rng.random() * 3, 4),
+                             expr_mean, rng.choice(["Homo sapiens", "Mus musculus"]),
+                             rng.choice(["normal", "COVID-19"])))
+    return rows
+
+
+def build_atlas(db_path, rows):
+    db = SqliteTool(db_path)
+    db._cur.execute(create_table_sql)
+    db._cur.executemany(insert_sql, rows)
+    db._conn.commit()
+    process_raw(db)
+    db.close_connection()
+
+
+@pytest.fixture
+def atlas_path(tmp_path):
+    """
+    处理好的示例数据库（含索引和派生结构）的路径；测试结束时关闭该路径上的连接池。
+    """
+    db_path = str(tmp_path / "example.db")
+    build_atlas(db_path, atlas_rows())
+    yield db_path
+    pool = _pools.pop(db_path, None)
+    if pool is not None:
+        pool.close_all()
+
+
+def read_target_rows(db_path):
+    """
+    直接读取 target_table 的全部行，作为查询结果的参照。
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute("SELECT * FROM target_table")]
+    conn.close()
+    return rows
@@ -0,0 +1,160 @@
+import re
+import time
+import pytest
+from conftest import read_target_rows
+from sqlite_tool import ConnectionPool
+from func import extract_matched_and_unmatched_rows_by_cell_name, extract_matched_rows_from_database, \
+    extract_matched_groups, df_data, df_data_groups, unique_group, filter_genes_by_threshold, \
+    filter_genes_by_threshold_other, filter_marker_genes
+
+backends = ["sqlite", "duckdb"]
+keywords = ["mast cell", "it's cell"]
+
+
+@pytest.fixture(params=backends)
+def reader(request, atlas_path):
+    if request.param == "duckdb":
+        pytest.importorskip("duckdb")
+    pool = ConnectionPool(atlas_path, backend=request.param)
+    yield pool.reader()
+    pool.close_all()
+
+
+@pytest.fixture
+def reference(atlas_path):
+    rows = read_target_rows(atlas_path)
+    names = {row['cell_name'] for row in rows}
+    matched = {name for name in names
+               if any(re.search(r'\b' + re.escape(keyword) + r'\b', name, re.IGNORECASE) for keyword in keywords)}
+    return rows, matched
+
+
+def above(value, threshold):
+    return value is not None and value > threshold
+
+
+def plot_rows(df):
+    # 绘图的数值列为 float32，按 6 位有效数字比较
+    return sorted((row.cell_name, row.tissue_name, row.symbol, f"{row.expr_mean:.6g}")
+                  for row in df.itertuples(index=False))
+
+
+def expected_plot_rows(rows):
+    return sorted((row['cell_name'], row['tissue_name'], row['symbol'], f"{row['expr_mean']:.6g}")
+                  for row in rows if row['expr_mean'] is not None)
+
+
+def test_cell_sets(reader, reference):
+    rows, matched = reference
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(reader, "target_table",
+                                                                                     keywords)
+    assert matched_cells.names >= matched
+    target_groups = {(row['tissue_name'], row['cell_name']) for row in rows if row['cell_name'] in matched}
+    other_groups = {(row['tissue_name'], row['cell_name']) for row in rows if row['cell_name'] not in matched}
+    assert unique_group(reader, matched_cells, "target_table") == len(target_groups)
+    assert unique_group(reader, unmatched_cells, "target_table") == len(other_groups)
+
+
+@pytest.mark.parametrize("threshold, share", [(0.5, 0.3), (1.0, 0.5), (0.2, 0.9)])
+def test_threshold_filters(reader, reference, threshold, share):
+    rows, matched = reference
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(reader, "target_table",
+                                                                                     keywords)
+    target_count = unique_group(reader, matched_cells, "target_table")
+    other_count = unique_group(reader, unmatched_cells, "target_table")
+    target_rows = [row for row in rows if row['cell_name'] in matched]
+    other_rows = [row for row in rows if row['cell_name'] not in matched]
+
+    expected1 = {symbol for symbol in {row['symbol'] for row in target_rows}
+                 if sum(above(row['expr_mean'], threshold) for row in target_rows if row['symbol'] == symbol)
+                 >= share * target_count}
+    expected2 = {symbol for symbol in {row['symbol'] for row in other_rows}
+                 if other_count - sum(above(row['expr_mean'], threshold) for row in other_rows
+                                      if row['symbol'] == symbol) >= share * other_count}
+
+    gene_list1 = {row[0] for row in filter_genes_by_threshold(reader, matched_cells, threshold,
+                                                              share * target_count)}
+    gene_list2 = {row[0] for row in filter_genes_by_threshold_other(reader, unmatched_cells, threshold, other_count,
+                                                                    share * other_count)}
+    combined = {row[0] for row in filter_marker_genes(reader, matched_cells, threshold, share, threshold, share)}
+    assert gene_list1 == expected1
+    assert gene_list2 == expected2
+    assert combined == expected1 & expected2
+
+
+def test_plot_queries(reader, reference):
+    rows, matched = reference
+    matched_cells, _ = extract_matched_and_unmatched_rows_by_cell_name(reader, "target_table", keywords)
+    selected = ["GENE1", "GENE2", "GENE3"]
+
+    df = extract_matched_rows_from_database(reader, "target_table", matched_cells, selected, ['Homo sapiens'],
+                                            ['normal'])
+    expected = [row for row in rows if row['cell_name'] in matched and row['symbol'] in selected
+                and row['organism'] == 'Homo sapiens' and row['disease'] == 'normal']
+    assert plot_rows(df) == expected_plot_rows(expected)
+    groups = extract_matched_groups(reader, "target_table", matched_cells, selected, ['Homo sapiens'], ['normal'])
+    assert groups == sorted({(row['tissue_name'], row['cell_name']) for row in expected},
+                            key=lambda group: (group[1], group[0]))
+
+    expressed = {(row['tissue_name'], row['cell_name']) for row in rows if above(row['expr_mean'], 1.5)}
+    df = df_data(reader, "target_table", matched_cells, selected, 1.5)
+    expected = [row for row in rows if row['cell_name'] in matched and row['symbol'] in selected
+                and (row['tissue_name'], row['cell_name']) in expressed]
+    assert plot_rows(df) == expected_plot_rows(expected)
+    groups = df_data_groups(reader, "target_table", matched_cells, selected, 1.5)
+    assert groups == sorted({(row['tissue_name'], row['cell_name']) for row in expected},
+                            key=lambda group: (group[1], group[0]))
+
+    # 分页：逐页取出的组与一次取出的相同
+    pages = [df_data_groups(reader, "target_table", matched_cells, selected, 1.5, limit=2, offset=offset)
+             for offset in range(0, len(groups) + 2, 2)]
+    assert [group for page in pages for group in page] == groups
+    page = groups[:2]
+    df = df_data(reader, "target_table", matched_cells, selected, 1.5, groups=page)
+    assert plot_rows(df) == expected_plot_rows([row for row in expected
+                                                if (row['tissue_name'], row['cell_name']) in page])
+
+
+@pytest.mark.parametrize("selection", [[], ["no such cell"]])
+def test_empty_selection(reader, reference, selection):
+    rows, _ = reference
+    matched_cells, unmatched_cells = extract_matched_and_unmatched_rows_by_cell_name(reader, "target_table",
+                                                                                     selection)
+    assert matched_cells.names == set()
+    assert unique_group(reader, matched_cells, "target_table") == 0
+    assert unique_group(reader, unmatched_cells, "target_table") == \
+        len({(row['tissue_name'], row['cell_name']) for row in rows})
+    assert filter_genes_by_threshold(reader, matched_cells, 0.5, 0) == []
+    assert filter_marker_genes(reader, matched_cells, 0.5, 0.3, 0.5, 0.3) == []
+    selected = ["GENE1", "GENE2"]
+    assert len(extract_matched_rows_from_database(reader, "target_table", matched_cells, selected, ['Homo sapiens'],
+                                                  ['normal'])) == 0
+    assert df_data_groups(reader, "target_table", matched_cells, selected, 0.2) == []
+
+
+def test_duckdb_serves_last_export_until_refreshed(atlas_path):
+    pytest.importorskip("duckdb")
+    pool = ConnectionPool(atlas_path, backend="duckdb")
+    source = pool.duckdb_source()
+    version = pool.reader().get_data_version()
+
+    with pool.writer() as db:
+        db._cur.execute("UPDATE target_table SET expr_mean = 99 WHERE symbol = 'GENE1'")
+        db.bump_data_version()
+    # 导出在后台进行，完成之前查询上一次导出的版本
+    source._exporting = True
+    db = pool.reader()
+    assert db.get_data_version() == version
+    db._cur.execute("SELECT MAX(expr_mean) FROM target_table WHERE symbol = 'GENE1'")
+    assert db._cur.fetchone()[0] < 99
+
+    source._exporting = False
+    source.refresh()
+    deadline = time.time() + 60
+    while pool.reader().get_data_version() == version and time.time() < deadline:
+        time.sleep(0.1)
+    db = pool.reader()
+    assert db.get_data_version() == version + 1
+    db._cur.execute("SELECT MAX(expr_mean) FROM target_table WHERE symbol = 'GENE1'")
+    assert db._cur.fetchone()[0] == 99
+    pool.close_all()
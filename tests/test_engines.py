@@ -0,0 +1,42 @@
+import time
+import pytest
+from sqlite_tool import get_pool
+from marker_engine import load_marker_engine
+from column_store import load_column_store
+from expr_index import load_expression_index
+from func import extract_matched_and_unmatched_rows_by_cell_name, filter_marker_genes
+
+
+def wait_for(load, pool, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        db = pool.reader()
+        engine = load(db)
+        db.close_connection()
+        if engine is not None:
+            return engine
+        time.sleep(0.05)
+    raise TimeoutError(f"{load.__name__} did not finish")
+
+
+@pytest.mark.parametrize("load", [load_marker_engine, load_column_store, load_expression_index])
+def test_engines_rebuild_in_background(atlas_path, load):
+    pool = get_pool(atlas_path)
+    wait_for(load, pool)
+
+    with pool.writer() as db:
+        db._cur.execute("UPDATE target_table SET expr_mean = 5 WHERE symbol = 'GENE1'")
+        db.bump_data_version()
+    # 数据版本变化后请求中不重建，返回 None，调用方改用 SQL
+    db = pool.reader()
+    assert load(db) is None
+    db.close_connection()
+
+    engine = wait_for(load, pool)
+    db = pool.reader()
+    matched_cells, _ = extract_matched_and_unmatched_rows_by_cell_name(db, "target_table", ["mast cell"])
+    gene_list1, gene_list2 = engine.marker_genes(matched_cells, 1, 0.5, 1, 0.5)
+    expected = {row[0] for row in filter_marker_genes(db, matched_cells, 1, 0.5, 1, 0.5)}
+    db.close_connection()
+    assert "GENE1" in gene_list1
+    assert set(gene_list1) & set(gene_list2) == expected
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import plot
+from frames import add_cell_label
+
+
+def plot_frame(rows):
+    df = pd.DataFrame(rows, columns=['cell_name', 'tissue_name', 'symbol', 'expr_mean', 'expr_pct',
+                                     'active_expr_mean'])
+    for column in ['cell_name', 'tissue_name', 'symbol']:
+        df[column] = df[column].astype('category')
+    return add_cell_label(df)
+
+
+def test_webgl_hover_shows_labels(monkeypatch):
+    monkeypatch.setattr(plot, "webgl_threshold", 0)
+    df = plot_frame([("mast cell", "lung", "GENE1", 0.5, 0.25, 1.5),
+                     ("T cell", "liver", "GENE2", 0.7, 0.5, 2.0),
+                     ("mast cell", "lung", "GENE2", 0.1, 0.125, 0.5)])
+    fig = plot.plotting(df)
+    trace = fig.data[0]
+    assert trace.type == 'scattergl'
+    assert [tuple(row) for row in trace.customdata] == [("mast cell # lung", "GENE1", 0.25),
+                                                        ("T cell # liver", "GENE2", 0.5),
+                                                        ("mast cell # lung", "GENE2", 0.125)]
+    for i in range(3):
+        assert f"%{{customdata[{i}]}}" in trace.hovertemplate
+    # 坐标轴的编码与标签一致
+    assert [fig.layout.yaxis.ticktext[y] for y in trace.y] == list(np.asarray(trace.customdata)[:, 0])
+    assert [fig.layout.xaxis.ticktext[x] for x in trace.x] == list(np.asarray(trace.customdata)[:, 1])
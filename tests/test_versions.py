@@ -0,0 +1,82 @@
+import db_versions
+from sqlite_tool import get_pool
+from write_queue import WriteQueue, versioned
+from db_versions import rollback, version_files, load_history
+from func import extract_matched_and_unmatched_rows_by_cell_name, extract_matched_groups
+from conftest import genes
+
+
+def new_cell_rows(cell_name, tissue_name="lung", tissue_id="UBERON:0000"):
+    return [{'tissue_id': tissue_id, 'cell_type_id': "CL:0100", 'gene_id': f"ENSG{g:05d}",
+             'number_nonzero_expression_cells': 5, 'expression_sum': 1.0, 'number_cells': 300, 'symbol': symbol,
+             'cell_name': cell_name, 'tissue_name': tissue_name, 'expression_sum_QC': 1.0, 'expr_pct': 0.5,
+             'active_expr_mean': 1.0, 'expr_mean': 0.8, 'organism': "Homo sapiens", 'disease': "normal"}
+            for g, symbol in enumerate(genes)]
+
+
+@versioned
+def add_cells_job(db, rows):
+    for row in rows:
+        db.insert_data("csv_data", row, commit=False)
+    db.refresh_tissues(sorted({row['tissue_id'] for row in rows}), commit=False)
+
+
+def groups(pool, keyword):
+    db = pool.reader()
+    matched_cells, _ = extract_matched_and_unmatched_rows_by_cell_name(db, "target_table", [keyword])
+    result = extract_matched_groups(db, "target_table", matched_cells, genes, ["Homo sapiens", "Mus musculus"],
+                                    ["normal", "COVID-19"])
+    version = db.get_data_version()
+    db.close_connection()
+    return result, version
+
+
+def test_publish_rollback_and_prune(atlas_path, monkeypatch):
+    monkeypatch.setattr(db_versions, "keep_versions", 1)
+    pool = get_pool(atlas_path)
+    write_queue = WriteQueue(pool)
+    versions = []
+    try:
+        result, version = groups(pool, "dendritic cell")
+        assert result == []
+        versions.append(version)
+
+        # 上传类的写入在新版本上执行并发布
+        write_queue.submit(add_cells_job, new_cell_rows("dendritic cell")).result()
+        result, version = groups(pool, "dendritic cell")
+        assert result == [("lung", "dendritic cell")]
+        versions.append(version)
+
+        # 普通写入直接提交到当前版本，当前版本的数据版本号超过发布历史中记录的
+        write_queue.insert("csv_data", new_cell_rows("plasma cell", "liver", "UBERON:0001")[0],
+                           "UBERON:0001").result()
+        result, version = groups(pool, "plasma cell")
+        assert result == [("liver", "plasma cell")]
+        assert version > load_history(atlas_path)['data_version']
+        versions.append(version)
+
+        # 回滚到上一次发布的版本：新加入的细胞都不存在，数据版本号仍然增加，缓存不会混用
+        rollback(atlas_path)
+        assert groups(pool, "dendritic cell")[0] == []
+        result, version = groups(pool, "plasma cell")
+        assert result == []
+        versions.append(version)
+        assert sorted(version_files(atlas_path)) == [1, 2]
+
+        # 之后的发布删除回滚掉的版本，并只保留 keep_versions 个旧版本
+        write_queue.submit(add_cells_job, new_cell_rows("dendritic cell", "blood", "UBERON:0002")).result()
+        result, version = groups(pool, "dendritic cell")
+        assert result == [("blood", "dendritic cell")]
+        versions.append(version)
+        assert sorted(version_files(atlas_path)) == [1, 3]
+
+        with pool.new_version() as db:
+            add_cells_job(db, new_cell_rows("dendritic cell", "skin", "UBERON:0003"))
+        result, version = groups(pool, "dendritic cell")
+        assert result == [("blood", "dendritic cell"), ("skin", "dendritic cell")]
+        versions.append(version)
+        assert sorted(version_files(atlas_path)) == [3, 4]
+        assert load_history(atlas_path)['published'] == ["v3.db", "v4.db"]
+    finally:
+        write_queue.close()
+    assert versions == sorted(set(versions))
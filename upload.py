@@ -2,15 +2,94 @@ import gradio as gr
 import tempfile
 import shutil
 import os
-from sqlite_tool import SqliteTool
+from sqlite_tool import SqliteTool, get_pool
 import os
 import glob
 import csv
-
-def upload_csv_to_db(file_path):
+import time
+import pandas as pd
+
+upload_columns = [
+    'tissue_id', 'cell_type_id', 'gene_id', 'number_nonzero_expression_cells',
+    'expression_sum', 'number_cells', 'symbol', 'cell_name', 'tissue_name',
+    'expression_sum_QC', 'expr_pct', 'active_expr_mean', 'expr_mean', 'organism', 'disease'
+]
+int_columns = ['number_nonzero_expression_cells', 'number_cells']
+float_columns = ['expression_sum', 'expression_sum_QC', 'expr_pct', 'active_expr_mean', 'expr_mean']
+
+
+def check_csv_columns(file_path, required_columns=upload_columns):
+    """
+    只读取 CSV 的标题行，返回缺少的必要列。
+    """
+    with open(file_path, 'r', encoding='utf-8', newline='') as file:
+        header = next(csv.reader(file), [])
+    return [col for col in required_columns if col not in header]
+
+
+def normalize_chunk(chunk):
+    """
+    对一块 CSV 数据做与逐行导入相同的清洗（向量化）：
+    文本列去空格、空值填 'blank'；整数列非纯数字填 0；小数列逗号转小数点、空值填 0.0。
+    """
+    out = pd.DataFrame(index=chunk.index)
+    for col in upload_columns:
+        values = chunk[col].fillna('').str.strip()
+        if col in int_columns:
+            out[col] = values.where(values.str.isdigit(), '0').astype('int64')
+        elif col in float_columns:
+            values = values.str.replace(',', '.', regex=False)
+            out[col] = values.where(values != '', '0').astype('float64')
+        else:
+            out[col] = values.where(values != '', 'blank')
+    return out
+
+
+def upload_csv_to_db(file_path, chunk_size=100000):
+    """
+    分块读取上传的 CSV，向量化清洗后写入临时暂存表，
+    最后在一个事务内合并到 csv_data 并刷新受影响 tissue 的 target_table；
+    任何一步失败都不会留下部分数据。
+
+    :param file_path: 上传的 CSV 文件路径
+    :param chunk_size: 每块读取的行数
+    :return: 写入的行数
+    """
     print(file_path)
-    db_path = "/usr/src/app/example.db"
-    db = SqliteTool(db_path)
+    start = time.perf_counter()
+    # 写入当前版本的副本，检查通过后再发布；上传期间其他页面继续读取当前版本
+    with get_pool().new_version() as db:
+        total = load_upload(db, file_path, chunk_size)
+
+    elapsed = time.perf_counter() - start
+    print(f"Uploaded {total} rows into 'csv_data' in {elapsed:.1f}s.")
+    return total
+
+
+def load_upload(db, file_path, chunk_size):
+    """
+    在给定的写连接上完成暂存和合并，返回写入的行数。
+    """
+    db._cur.execute("DROP TABLE IF EXISTS temp.upload_staging")
+    db._cur.execute("""
+        CREATE TEMP TABLE upload_staging (
+            tissue_id TEXT,
+            cell_type_id TEXT,
+            gene_id TEXT,
+            number_nonzero_expression_cells INTEGER,
+            expression_sum REAL,
+            number_cells INTEGER,
+            symbol TEXT,
+            cell_name TEXT,
+            tissue_name TEXT,
+            expression_sum_QC REAL,
+            expr_pct REAL,
+            active_expr_mean REAL,
+            expr_mean REAL,
+            organism TEXT,
+            disease TEXT
+        )
+    """)
     # with open(file_path, 'r', encoding='utf-8') as file:
     #     csv_reader = csv.reader(file, delimiter=',')
     #     next(csv_reader)  # 跳过标题行
@@ -43,39 +122,31 @@ def upload_csv_to_db(file_path):
 
     # db._conn.commit()
     # db.close_connection()
-    with open(file_path, 'r', encoding='utf-8') as file:
-        csv_reader = csv.DictReader(file, delimiter=',')
-
-        for row in csv_reader:
-            tissue_id = row['tissue_id'].strip() or 'blank'
-            cell_type_id = row['cell_type_id'].strip() or 'blank'
-            gene_id = row['gene_id'].strip() or 'blank'
-            number_nonzero_expression_cells = int(row['number_nonzero_expression_cells'].strip() if row['number_nonzero_expression_cells'].strip().isdigit() else 0)
-            expression_sum = float(row['expression_sum'].strip().replace(',', '.')) if row[
-                'expression_sum'].strip() else 0.0
-            number_cells = int(row['number_cells'].strip() if row['number_cells'].strip().isdigit() else 0)
-            symbol = row['symbol'].strip() or 'blank'
-            cell_name = row['cell_name'].strip() or 'blank'
-            tissue_name = row['tissue_name'].strip() or 'blank'
-            expression_sum_QC = float(row['expression_sum_QC'].strip().replace(',', '.')) if row[
-                'expression_sum_QC'].strip() else 0.0
-            expr_pct = float(row['expr_pct'].strip().replace(',', '.')) if row['expr_pct'].strip() else 0.0
-            active_expr_mean = float(row['active_expr_mean'].strip().replace(',', '.')) if row[
-                'active_expr_mean'].strip() else 0.0
-            expr_mean = float(row['expr_mean'].strip().replace(',', '.')) if row['expr_mean'].strip() else 0.0
-            organism = row['organism'].strip() or 'blank'
-            disease = row['disease'].strip() or 'blank'
-
-            db._cur.execute('''INSERT INTO target_table (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells,
-                                         expression_sum, number_cells, symbol, cell_name, tissue_name,
-                                         expression_sum_QC, expr_pct, active_expr_mean, expr_mean, organism, disease)
-                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                           (tissue_id, cell_type_id, gene_id, number_nonzero_expression_cells, expression_sum,
-                            number_cells, symbol, cell_name, tissue_name, expression_sum_QC, expr_pct, active_expr_mean,
-                            expr_mean, organism, disease))
-
-    db._conn.commit()
-    db.close_connection()
+    try:
+        total = 0
+        for chunk in pd.read_csv(file_path, dtype=str, keep_default_na=False, na_filter=False,
+                                 usecols=upload_columns, chunksize=chunk_size, encoding='utf-8'):
+            chunk = normalize_chunk(chunk)
+            db._cur.executemany(f"INSERT INTO temp.upload_staging ({', '.join(upload_columns)}) "
+                                f"VALUES ({', '.join(['?'] * len(upload_columns))})",
+                                chunk.itertuples(index=False, name=None))
+            total += len(chunk)
+
+        # 暂存表写满后，在一个事务内合并到 csv_data，并只刷新受影响 tissue 的 target_table
+        db._cur.execute(f"""
+            INSERT INTO csv_data ({', '.join(upload_columns)})
+            SELECT {', '.join(upload_columns)} FROM temp.upload_staging
+        """)
+        db._cur.execute("SELECT DISTINCT tissue_id FROM temp.upload_staging")
+        tissue_ids = [row[0] for row in db._cur.fetchall()]
+        db.refresh_tissues(tissue_ids, commit=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db._cur.execute("DROP TABLE IF EXISTS temp.upload_staging")
+    return total
 
 def generate_file(file_obj):
     global tmpdir
@@ -0,0 +1,109 @@
+import sys
+from sqlite_tool import SqliteTool
+
+# 页面下拉框使用的列，每列的不同取值保存在 vocabulary 表中
+vocabulary_columns = ['cell_name', 'symbol', 'organism', 'disease']
+
+# dbName -> (数据版本, {列名: 取值列表})，进程内缓存
+_vocabulary_cache = {}
+
+
+def has_vocabulary(db):
+    db._cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='vocabulary'")
+    return db._cur.fetchone() is not None
+
+
+def has_row_counts(db):
+    db._cur.execute("PRAGMA table_info(vocabulary)")
+    return 'row_count' in [row[1] for row in db._cur.fetchall()]
+
+
+def build_vocabulary(db, commit=True):
+    """
+    重建 vocabulary 表：target_table 中 cell_name / symbol / organism / disease 的不同取值及其行数，
+    main.py 启动时直接读取，不再对 target_table 做 DISTINCT 全表扫描；行数用于写入后的增量维护。
+    """
+    db._cur.execute("DROP TABLE IF EXISTS vocabulary")
+    db._cur.execute("""
+        CREATE TABLE vocabulary (
+            kind TEXT,
+            value TEXT,
+            row_count INTEGER,
+            PRIMARY KEY (kind, value)
+        ) WITHOUT ROWID
+    """)
+    for column in vocabulary_columns:
+        db._cur.execute(f"""
+            INSERT INTO vocabulary (kind, value, row_count)
+            SELECT '{column}', {column}, COUNT(*) FROM target_table WHERE {column} IS NOT NULL GROUP BY {column}
+        """)
+    if commit:
+        db._conn.commit()
+    print("Table 'vocabulary' has been built.")
+
+
+def count_vocabulary(db, source, condition, sign):
+    """
+    把 source 中满足 condition 的行按取值计入 vocabulary.row_count，sign 为 -1 时减去。
+    """
+    for column in vocabulary_columns:
+        db._cur.execute(f"""
+            INSERT INTO vocabulary (kind, value, row_count)
+            SELECT '{column}', {column}, {sign} * COUNT(*) FROM {source}
+            WHERE {condition} AND {column} IS NOT NULL
+            GROUP BY {column}
+            ON CONFLICT (kind, value) DO UPDATE SET row_count = row_count + excluded.row_count
+        """)
+
+
+def uncount_vocabulary(db):
+    """
+    在 SqliteTool.refresh_tissues 删除受影响 tissue（temp.affected_tissue）的 target_table 行之前调用，
+    减去这些行的计数；旧版本建立的 vocabulary 没有行数时什么也不做，由 sync_vocabulary 重建。
+    """
+    if has_row_counts(db):
+        count_vocabulary(db, "target_table",
+                         "tissue_id IN (SELECT tissue_id FROM temp.affected_tissue) AND id IS NOT NULL", -1)
+
+
+def sync_vocabulary(db, commit=True):
+    """
+    写入后更新 vocabulary：加上受影响 tissue 重新生成的行的计数，删除计数归零的取值。
+    只读取受影响 tissue 的行（csv_data 和 target_table 上都有 tissue_id 索引），不再逐个取值检查整张 target_table。
+    """
+    if not has_row_counts(db):
+        build_vocabulary(db, commit=False)
+    else:
+        count_vocabulary(db, "csv_data",
+                         "tissue_id IN (SELECT tissue_id FROM temp.affected_tissue) AND number_cells > 50", 1)
+        db._cur.execute("DELETE FROM vocabulary WHERE row_count <= 0")
+    if commit:
+        db._conn.commit()
+
+
+def load_vocabulary(db):
+    """
+    返回 {列名: 排序后的取值列表}，按数据版本缓存（调用方不要修改）；
+    vocabulary 表不存在时退回到 target_table 上的 DISTINCT 查询。
+    """
+    version = db.get_data_version()
+    cached = _vocabulary_cache.get(db.dbName)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    if not has_vocabulary(db):
+        vocabulary = {column: sorted([value for value in db.get_unique_column_values("target_table", column)
+                                      if value is not None])
+                      for column in vocabulary_columns}
+    else:
+        vocabulary = {column: [] for column in vocabulary_columns}
+        db._cur.execute("SELECT kind, value FROM vocabulary ORDER BY kind, value")
+        for kind, value in db._cur.fetchall():
+            vocabulary.setdefault(kind, []).append(value)
+    _vocabulary_cache[db.dbName] = (version, vocabulary)
+    return vocabulary
+
+
+if __name__ == '__main__':
+    db = SqliteTool(sys.argv[1] if len(sys.argv) > 1 else "example.db")
+    build_vocabulary(db)
+    db.close_connection()
@@ -0,0 +1,214 @@
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from sqlite_tool import DB_PATH, get_pool
+from cell_index import ensure_cell_name_index
+from upload import load_upload
+
+
+def insert_job(db, table_name, data, tissue_id):
+    db.insert_data(table_name, data, commit=False)
+    db.refresh_tissues([tissue_id], commit=False)
+    return f"Data inserted: {data}"
+
+
+def delete_job(db, tissue_id, cell_type_id, gene_id):
+    return db.delete_data(tissue_id, cell_type_id, gene_id)
+
+
+def versioned(job):
+    """
+    标记在新版本数据库上执行的任务（见 ConnectionPool.new_version）：单独执行，不与其他任务合并提交。
+    """
+    job.versioned = True
+    return job
+
+
+@versioned
+def upload_job(db, file_path, chunk_size=100000):
+    return load_upload(db, file_path, chunk_size)
+
+
+class WriteQueue():
+    """
+    后台写线程：所有写入作为任务放入队列，由一个线程在连接池的写连接上依次执行。
+    队列中积压的任务合并为一个事务提交（group commit），每个任务用 SAVEPOINT 隔开，
+    单个任务失败只回滚它自己的修改。submit 返回 Future，提交成功后才会得到结果。
+    上传这类大批量写入在当前版本的副本上单独执行，检查通过后才发布（见 db_versions.py），
+    写入期间读取不受影响，失败时当前版本保持不变。
+    """
+    def __init__(self, pool, max_batch=256, max_wait=0.005):
+        """
+        :param pool: ConnectionPool
+        :param max_batch: 一次提交最多合并的任务数
+        :param max_wait: 收到第一个任务后等待更多任务的时间（秒）
+        """
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        # 合并批次时遇到的版本任务，留到下一批单独执行
+        self._pending = None
+        # 每次提交成功后调用的 listener(db_path)，用于在后台重建派生文件，不能阻塞写线程
+        self._commit_listeners = []
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, job, *args, **kwargs):
+        """
+        提交写任务 job(db, *args, **kwargs)；job 中不要自行提交事务。
+
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        self._queue.put((future, job, args, kwargs))
+        return future
+
+    def insert(self, table_name, data, tissue_id):
+        return self.submit(insert_job, table_name, data, tissue_id)
+
+    def delete(self, tissue_id, cell_type_id, gene_id):
+        return self.submit(delete_job, tissue_id, cell_type_id, gene_id)
+
+    def upload(self, file_path, chunk_size=100000):
+        return self.submit(upload_job, file_path, chunk_size)
+
+    def add_commit_listener(self, listener):
+        """
+        注册 listener(db_path)，在每次提交成功、发布新版本之后由写线程调用；listener 需要自行在后台完成耗时的工作。
+        """
+        self._commit_listeners.append(listener)
+
+    def _committed(self):
+        for listener in self._commit_listeners:
+            try:
+                listener(self.pool.db_path)
+            except Exception as e:
+                print(f"Commit listener failed: {e}")
+
+    def close(self):
+        """
+        处理完队列中已有的任务后停止写线程。
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+        else:
+            item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.max_batch and not is_versioned(batch[0]):
+            try:
+                item = self._queue.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            if item is None:
+                # 先写完这一批，再由下一次 _next_batch 处理停止信号
+                self._queue.put(None)
+                break
+            if is_versioned(item):
+                self._pending = item
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        self._ensure_derived()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if is_versioned(batch[0]):
+                self._write_version(batch[0])
+            else:
+                self._write_batch(batch)
+
+    def _ensure_derived(self):
+        """
+        在写连接上补建读取路径需要、但旧数据库中可能没有的派生表；读连接是只读的，不能自己建立。
+        """
+        try:
+            with self.pool.writer() as db:
+                ensure_cell_name_index(db)
+        except sqlite3.Error as e:
+            print(f"Derived tables were not built: {e}")
+
+    def _write_version(self, item):
+        future, job, args, kwargs = item
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            with self.pool.new_version() as db:
+                result = job(db, *args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.batches += 1
+        self.jobs += 1
+        self._committed()
+        future.set_result(result)
+
+    def _write_batch(self, batch):
+        results = []
+        with self.pool.writer() as db:
+            db.defer_commit = True
+            try:
+                db._cur.execute("BEGIN")
+                for future, job, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    db._cur.execute("SAVEPOINT write_job")
+                    try:
+                        result = job(db, *args, **kwargs)
+                    except Exception as e:
+                        db._cur.execute("ROLLBACK TO write_job")
+                        db._cur.execute("RELEASE write_job")
+                        results.append((future, None, e))
+                        continue
+                    db._cur.execute("RELEASE write_job")
+                    results.append((future, result, None))
+                db._conn.commit()
+            except Exception as e:
+                db._conn.rollback()
+                for future, _, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                db.defer_commit = False
+
+        self.batches += 1
+        self.jobs += len(results)
+        self._committed()
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def is_versioned(item):
+    return getattr(item[1], 'versioned', False)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(db_path=DB_PATH):
+    """
+    返回 db_path 对应的进程内写队列（首次调用时启动写线程）。
+    """
+    with _queues_lock:
+        write_queue = _queues.get(db_path)
+        if write_queue is None:
+            write_queue = WriteQueue(get_pool(db_path))
+            _queues[db_path] = write_queue
+        return write_queue